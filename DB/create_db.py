@@ -2,10 +2,451 @@
 # -*- coding: utf-8 -*-
 # coding: utf-8
 import sys, os, json
-import pandas as pd
+import bz2
+import collections
+import csv
+import gc
+import gzip
+import hashlib
+import io
+import itertools
+import lzma
+import queue
+import re
 import sqlite3
+import threading
+import time
+import urllib.parse
 
-def main(project_folder="./", data_folder = None, output_folder = None, db_path = None):
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+from shared_snapshot import snapshot_is_current, snapshot_path, write_snapshot
+
+# Pragmas only used while the database is being built. The database
+# is not in a consistent state until the build has finished
+BUILD_PRAGMAS = [
+	('locking_mode', 'EXCLUSIVE'),
+	('journal_mode', 'MEMORY'),
+	('synchronous', 'OFF'),
+	# Negative values are in KiB, so 1GiB of page cache
+	('cache_size', -1048576),
+]
+
+# ioctl request cloning a whole file (linux/fs.h)
+FICLONE = 0x40049409
+
+# Size of the blocks read ahead from the compressed datafiles
+READ_AHEAD_BLOCK_SIZE = 1048576
+
+# Approximate size of the text parsed into each batch of inserted rows
+BATCH_BYTES = 4194304
+
+# Number of blocks each decompression thread can have in flight
+QUEUE_BLOCKS = 16
+
+# The same missing value markers recognized by pandas.read_csv
+NA_VALUES = frozenset([
+	'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+	'1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None',
+	'n/a', 'nan', 'null'
+])
+
+TABLE_CONSTRAINTS = ('PRIMARY', 'UNIQUE', 'FOREIGN', 'CHECK', 'CONSTRAINT')
+
+COMPRESSED_OPENERS = {
+	'.xz': lzma.open,
+	'.gz': gzip.open,
+	'.bz2': bz2.open,
+}
+
+def compressed_opener(fname):
+	for ext, opener in COMPRESSED_OPENERS.items():
+		if fname.endswith(ext):
+			return opener
+	
+	return None
+
+def open_datafile(fname):
+	opener = compressed_opener(fname)
+	if opener is None:
+		opener = open
+	
+	return opener(fname,mode='rt',encoding='utf-8',newline='')
+
+def numeric_columns(sql_ddl,columns):
+	'''Whether all the columns are declared with a numeric (INTEGER or REAL) SQLite affinity'''
+	decl_types = {}
+	for column_def in sql_ddl:
+		tokens = re.split(r'[\s(]+',column_def.strip(),maxsplit=2)
+		if tokens[0].upper() not in TABLE_CONSTRAINTS:
+			decl_types[tokens[0]] = tokens[1].upper()  if len(tokens) > 1  else ''
+	
+	for column in columns:
+		decl_type = decl_types.get(column)
+		if decl_type is None or 'CHAR' in decl_type or 'CLOB' in decl_type or 'TEXT' in decl_type:
+			return False
+		if 'INT' not in decl_type and 'REAL' not in decl_type and 'FLOA' not in decl_type and 'DOUB' not in decl_type:
+			return False
+	
+	return True
+
+def parse_rows(rows):
+	'''The parsed rows, where the missing values are None. The values are kept
+	as strings, and SQLite converts them following the column affinities'''
+	na_values = NA_VALUES
+	return [ row  if na_values.isdisjoint(row)  else [ None  if value in na_values  else value for value in row ] for row in rows ]
+
+def parse_numeric_rows(lines,num_columns):
+	'''When the lines only hold numbers, the whole block is parsed at once by the
+	JSON decoder (written in C), and the rows are built by zip, without any
+	per-value Python code. Blocks with missing values, quoting or anything else
+	which is not a JSON number make it return None'''
+	block = ''.join(lines).rstrip('\r\n')
+	if '"' in block:
+		return None
+	
+	try:
+		values = json.loads('[' + block.replace('\r\n','\n').replace('\t',',').replace('\n',',') + ']')
+	except ValueError:
+		return None
+	
+	if len(values) != num_columns * len(lines):
+		return None
+	
+	return list(zip(*[ iter(values) ] * num_columns))
+
+def datafile_batches(fh,sql_ddl,batch_bytes=BATCH_BYTES):
+	'''It yields the column names of a tabular datafile, and then batches of its rows'''
+	columns = next(csv.reader([ fh.readline() ],delimiter='\t'))
+	yield columns
+	
+	if not numeric_columns(sql_ddl,columns):
+		# Quoted values could span several lines, so the whole file is parsed as a stream
+		reader = csv.reader(fh,delimiter='\t')
+		while True:
+			batch = parse_rows(itertools.islice(reader,batch_bytes // 64))
+			if len(batch) == 0:
+				break
+			yield batch
+	else:
+		while True:
+			lines = fh.readlines(batch_bytes)
+			if len(lines) == 0:
+				break
+			batch = parse_numeric_rows(lines,len(columns))
+			yield batch  if batch is not None  else parse_rows(csv.reader(lines,delimiter='\t'))
+
+# This raw stream decompresses a datafile in a background thread. The
+# decompressors release the GIL, so the decompression runs along with
+# the parsing and insertion of the rows, without any serialization
+class ReadAheadStream(io.RawIOBase):
+	def __init__(self,fname,opener):
+		self._queue = queue.Queue(QUEUE_BLOCKS)
+		self._block = memoryview(b'')
+		self._eof = False
+		self._stopped = False
+		self._thread = threading.Thread(target=self._decompress,args=(fname,opener),name='decompress-'+os.path.basename(fname),daemon=True)
+		self._thread.start()
+	
+	def _decompress(self,fname,opener):
+		try:
+			with opener(fname,mode='rb') as fh:
+				while not self._stopped:
+					block = fh.read(READ_AHEAD_BLOCK_SIZE)
+					self._queue.put(block)
+					if len(block) == 0:
+						break
+		except Exception as e:
+			self._queue.put(e)
+	
+	def readable(self):
+		return True
+	
+	def readinto(self,buf):
+		while len(self._block) == 0:
+			if self._eof:
+				return 0
+			block = self._queue.get()
+			if isinstance(block,Exception):
+				raise block
+			self._eof = len(block) == 0
+			self._block = memoryview(block)
+		
+		size = min(len(buf),len(self._block))
+		buf[0:size] = self._block[0:size]
+		self._block = self._block[size:]
+		return size
+	
+	def close(self):
+		# The decompression thread could be waiting for room in the queue
+		self._stopped = True
+		while self._thread.is_alive():
+			try:
+				self._queue.get(timeout=0.1)
+			except queue.Empty:
+				pass
+		super().close()
+
+# This class opens the datafiles in the same order the tables are loaded.
+# When there are several of them and more than one worker, the compressed
+# ones are decompressed ahead by up to max_workers background threads
+class DatafileReader(object):
+	def __init__(self,max_workers=None):
+		self.max_workers = max_workers  if max_workers  else os.cpu_count() or 1
+		self._pending = collections.deque()
+		self._streams = {}
+	
+	def submit(self,tab_name,fname,sql_ddl):
+		self._pending.append((tab_name,fname,sql_ddl))
+	
+	def _startReadAhead(self):
+		if self.max_workers <= 1 or len(self._pending) + len(self._streams) <= 1:
+			return
+		
+		for tab_name, fname, _ in self._pending:
+			if len(self._streams) >= self.max_workers:
+				break
+			opener = compressed_opener(fname)
+			if opener is not None and tab_name not in self._streams:
+				self._streams[tab_name] = ReadAheadStream(fname,opener)
+	
+	def read(self,tab_name):
+		'''It yields the column names of the datafile, and then the batches of rows'''
+		self._startReadAhead()
+		pending_tab_name, fname, sql_ddl = self._pending.popleft()
+		if pending_tab_name != tab_name:
+			raise ValueError('Datafile of table {0} is read before the one of {1}'.format(tab_name,pending_tab_name))
+		
+		stream = self._streams.pop(tab_name,None)
+		if stream is not None:
+			fh = io.TextIOWrapper(io.BufferedReader(stream,READ_AHEAD_BLOCK_SIZE),encoding='utf-8',newline='')
+		else:
+			fh = open_datafile(fname)
+		
+		with fh:
+			yield from datafile_batches(fh,sql_ddl)
+	
+	def close(self):
+		self._pending.clear()
+		for stream in self._streams.values():
+			stream.close()
+		self._streams.clear()
+
+# This table keeps the hashes of the inputs used to build each table,
+# so later runs only rebuild the tables whose inputs have changed
+BUILD_METADATA_TABLE = 'build_metadata'
+BUILD_METADATA_DDL = [
+	'table_name TEXT PRIMARY KEY',
+	'ddl_hash TEXT NOT NULL',
+	'input_hash TEXT',
+	'num_rows INTEGER',
+	'built_at TEXT NOT NULL'
+]
+
+FOREIGN_KEY_RE = re.compile(r'REFERENCES\s+(\w+)',re.IGNORECASE)
+WORD_RE = re.compile(r'\w+')
+
+def table_dependencies(table_decls):
+	'''It returns, for each table, the set of declared tables it depends on:
+	the ones referenced by its foreign keys, and for derived tables,
+	the ones used by its populating query'''
+	tab_names = set(map(lambda table: table['table'],table_decls))
+	dependencies = {}
+	for table in table_decls:
+		tab_name = table['table']
+		deps = set()
+		for column_def in table['sql_ddl']:
+			deps.update(FOREIGN_KEY_RE.findall(column_def))
+		if 'sql_populate' in table:
+			deps.update(WORD_RE.findall(table['sql_populate']))
+		
+		deps.discard(tab_name)
+		dependencies[tab_name] = deps & tab_names
+	
+	return dependencies
+
+def dependency_order(table_decls,dependencies):
+	'''It sorts the table declarations so every table comes after the ones
+	it depends on, keeping the declaration order whenever it is possible'''
+	ordered = []
+	placed = set()
+	remaining = list(table_decls)
+	while len(remaining) > 0:
+		for i, table in enumerate(remaining):
+			if dependencies[table['table']] <= placed:
+				ordered.append(table)
+				placed.add(table['table'])
+				del remaining[i]
+				break
+		else:
+			raise ValueError('Circular dependency among tables {0}'.format(', '.join(map(lambda table: table['table'],remaining))))
+	
+	return ordered
+
+def file_hash(fname,block_size=1048576):
+	h = hashlib.sha256()
+	with open(fname,mode='rb') as fh:
+		while True:
+			block = fh.read(block_size)
+			if len(block) == 0:
+				break
+			h.update(block)
+	
+	return h.hexdigest()
+
+def ddl_hash(table):
+	'''The hash of everything but the datafile contents which defines how a table is built'''
+	decl = { key: table[key] for key in ('table','sql_ddl','indexes','sql_populate','datafile') if key in table }
+	return hashlib.sha256(json.dumps(decl,sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_build_metadata(cursor):
+	cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+	existing_tables = set(map(lambda row: row[0],cursor.fetchall()))
+	
+	build_metadata = {}
+	if BUILD_METADATA_TABLE in existing_tables:
+		cursor.execute("SELECT table_name, ddl_hash, input_hash FROM {0};".format(BUILD_METADATA_TABLE))
+		for tab_name, table_ddl_hash, input_hash in cursor.fetchall():
+			build_metadata[tab_name] = (table_ddl_hash, input_hash)
+	
+	return existing_tables, build_metadata
+
+def report_rate(num_rows,elapsed):
+	rate = num_rows / elapsed  if elapsed > 0  else float('inf')
+	print("\t- {0} rows in {1:.2f}s ({2:.0f} rows/s)".format(num_rows,elapsed,rate))
+
+def connect_read_only(db_path):
+	return sqlite3.connect('file:'+urllib.parse.quote(db_path)+'?mode=ro',uri=True)
+
+def clone_file(fname,dest_fname):
+	'''It makes a copy-on-write clone of the file, which takes no time nor
+	space on filesystems sharing extents (btrfs, XFS). It returns False when
+	the filesystem (or the platform) does not support it'''
+	if fcntl is None:
+		return False
+	
+	with open(fname,'rb') as src, open(dest_fname,'wb') as dest:
+		try:
+			fcntl.ioctl(dest.fileno(),FICLONE,src.fileno())
+		except OSError:
+			return False
+	
+	return True
+
+def copy_database(db_path,dest_path):
+	'''It takes a consistent copy of the database, even when it is being read'''
+	con_src = connect_read_only(db_path)
+	try:
+		# The read transaction keeps any writer away while the file is cloned
+		con_src.execute("BEGIN")
+		con_src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+		if clone_file(db_path,dest_path):
+			return
+		
+		con_dest = sqlite3.connect(dest_path)
+		try:
+			con_src.backup(con_dest)
+		finally:
+			con_dest.close()
+	finally:
+		con_src.close()
+
+def sync_file(fname):
+	fd = os.open(fname,os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
+
+def build_tables(db_path,data_folder,rebuild_decls,existing_tables,hashes,workers=None):
+	'''It (re)builds the tables from rebuild_decls, which must be sorted by their dependencies'''
+	con_db = sqlite3.connect(db_path, check_same_thread = False)
+	for pragma, value in BUILD_PRAGMAS:
+		con_db.execute("PRAGMA {0} = {1}".format(pragma,value))
+	
+	reader = DatafileReader(workers)
+	# The parsed rows hold no reference cycles, and the collections
+	# triggered by so many allocations slow down the load
+	gc.disable()
+	try:
+		with con_db:
+			cursor = con_db.cursor()
+			# Table drops and creations are also part of the transaction
+			cursor.execute("BEGIN")
+			cursor.execute("CREATE TABLE IF NOT EXISTS {0} ( {1} );".format(BUILD_METADATA_TABLE,", ".join(BUILD_METADATA_DDL)))
+			
+			# We have to drop the tables to be rebuilt before starting
+			dropped = False
+			for table in reversed(rebuild_decls):
+				tab_name = table['table']
+				if tab_name in existing_tables:
+					if not dropped:
+						print("Dropping old tables")
+						dropped = True
+					print("* Drop table {0} (if exists)".format(tab_name))
+					cursor.execute("DROP TABLE IF EXISTS {0};".format(tab_name))
+			
+			# Compressed datafiles are decompressed ahead, meanwhile
+			# the rows already parsed are inserted in the database
+			for table in rebuild_decls:
+				if 'datafile' in table:
+					reader.submit(table['table'],os.path.join(data_folder,table['datafile']),table['sql_ddl'])
+			
+			print("Creating tables")
+			build_start = time.perf_counter()
+			total_rows = 0
+			for table in rebuild_decls:
+				tab_name = table['table']
+				print("* Creating table %s" % tab_name)
+				
+				sql_creation_arr = table['sql_ddl']
+				cursor.execute("CREATE TABLE {0} ( {1} );".format(tab_name,", ".join(sql_creation_arr)))
+				
+				table_start = time.perf_counter()
+				num_rows = 0
+				if 'datafile' in table:
+					print("\t- Reading file {0}".format(os.path.join(data_folder,table['datafile'])))
+					batches = reader.read(tab_name)
+					columns = next(batches)
+					insert_sql = "INSERT INTO {0} ({1}) VALUES ({2});".format(tab_name,", ".join(columns),", ".join(['?'] * len(columns)))
+					print("\t- Inserting data into {0}".format(tab_name))
+					for batch in batches:
+						cursor.executemany(insert_sql,batch)
+						num_rows += len(batch)
+				else:
+					# Derived tables are populated from the previously loaded ones
+					print("\t- Populating derived table {0}".format(tab_name))
+					cursor.execute("INSERT INTO {0} {1};".format(tab_name,table['sql_populate']))
+					num_rows = cursor.rowcount
+				
+				report_rate(num_rows,time.perf_counter() - table_start)
+				total_rows += num_rows
+				
+				table_ddl_hash, input_hash = hashes[tab_name]
+				cursor.execute("INSERT OR REPLACE INTO {0} (table_name, ddl_hash, input_hash, num_rows, built_at) VALUES (?, ?, ?, ?, datetime('now'));".format(BUILD_METADATA_TABLE),(tab_name,table_ddl_hash,input_hash,num_rows))
+			
+			# Indexes are built once all the tables are loaded
+			print("Creating indexes")
+			for table in rebuild_decls:
+				tab_name = table['table']
+				indexes = table.get('indexes',[])
+				for index in indexes:
+					indexCommas = ', '.join(index)
+					print("* Indexing {0} column(s): {1}".format(tab_name,indexCommas))
+					index_ddl = "CREATE INDEX {0} ON {1} ({2});".format(tab_name+'_fk_'+'_'.join(index),tab_name,indexCommas)
+					cursor.execute(index_ddl)
+			
+			print("* Loaded {0} rows".format(total_rows))
+			report_rate(total_rows,time.perf_counter() - build_start)
+	finally:
+		gc.enable()
+		reader.close()
+		con_db.close()
+
+def main(project_folder="./", data_folder = None, output_folder = None, db_path = None, workers = None, full_rebuild = False, shared_snapshot = True):
 	
 	if data_folder is None:
 		data_folder = os.path.join(project_folder,'data')
@@ -22,7 +463,7 @@ def main(project_folder="./", data_folder = None, output_folder = None, db_path
 
 		db_path = os.path.join(output_folder,'net_comorbidity.db')
 	else:
-		output_folder = os.path.dirname(db_path)
+		output_folder = os.path.dirname(os.path.abspath(db_path))
 
 	os.makedirs(output_folder,exist_ok=True)
 	
@@ -32,52 +473,81 @@ def main(project_folder="./", data_folder = None, output_folder = None, db_path
 	with open(sql_creates_fname) as fh:
 		table_decls = json.load(fh)
 	
-	con_db = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES, check_same_thread = False)
-	con_db.execute("""PRAGMA locking_mode = NORMAL""")
-	con_db.execute("""PRAGMA journal_mode = WAL""")
-	with con_db:
-		cursor = con_db.cursor()
-		cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table';")
-		numTablesRes = cursor.fetchone()
+	dependencies = table_dependencies(table_decls)
+	table_decls = dependency_order(table_decls,dependencies)
+	
+	# The rebuild plan is computed from the current database, only opened for reading
+	existing_tables = set()
+	build_metadata = {}
+	if not full_rebuild and os.path.exists(db_path):
+		con_cur = connect_read_only(db_path)
+		try:
+			existing_tables, build_metadata = read_build_metadata(con_cur.cursor())
+		finally:
+			con_cur.close()
+	
+	# A table is rebuilt when it does not exist, when its declaration
+	# or its datafile has changed, or when it is a derived table
+	# populated from a rebuilt one
+	print("Checking datafiles")
+	hashes = {}
+	rebuild = set()
+	for table in table_decls:
+		tab_name = table['table']
+		input_hash = file_hash(os.path.join(data_folder,table['datafile']))  if 'datafile' in table  else None
+		hashes[tab_name] = (ddl_hash(table), input_hash)
+		if tab_name not in existing_tables or build_metadata.get(tab_name) != hashes[tab_name]:
+			rebuild.add(tab_name)
+		elif 'sql_populate' in table and len(dependencies[tab_name] & rebuild) > 0:
+			rebuild.add(tab_name)
+	
+	rebuild_decls = [ table for table in table_decls if table['table'] in rebuild ]
+	if len(rebuild_decls) == 0:
+		print("* All the tables are up to date")
+		if shared_snapshot and not snapshot_is_current(db_path):
+			print("Writing shared snapshot")
+			write_snapshot(db_path)
+		return
+	
+	print("* Tables to be rebuilt: {0}".format(", ".join(map(lambda table: table['table'],rebuild_decls))))
+	
+	# The database is built in a temporary file next to the current one,
+	# which is atomically replaced at the end. This way, readers never
+	# see a partially built database. The current one is only copied
+	# when any of its tables is kept
+	tmp_db_path = '{0}.tmp-{1}'.format(db_path,os.getpid())
+	if len((existing_tables & hashes.keys()) - rebuild) > 0:
+		print("Copying current database")
+		copy_database(db_path,tmp_db_path)
+	else:
+		existing_tables = set()
+	
+	try:
+		build_tables(tmp_db_path,data_folder,rebuild_decls,existing_tables,hashes,workers)
 		
-		# We have to drop all the tables with the same name as the new ones before starting
-		if numTablesRes and numTablesRes[0] > 0:
-			print("Dropping old tables")
-			for table in reversed(table_decls):
-				tab_name = table['table']
-				print("* Drop table {0} (if exists)".format(tab_name))
-				cursor.execute("DROP TABLE IF EXISTS {0};".format(tab_name))
-				
-		print("Creating tables")
+		print("Optimizing database")
+		con_db = sqlite3.connect(tmp_db_path)
+		try:
+			con_db.execute("ANALYZE")
+			con_db.execute("PRAGMA optimize")
+			con_db.execute("""PRAGMA journal_mode = DELETE""")
+		finally:
+			con_db.close()
 		
-		for table in table_decls:
-			tab_name = table['table']
-			print("* Creating table %s" % tab_name)
-			
-			sql_creation_arr = table['sql_ddl']
-			cursor.execute("CREATE TABLE {0} ( {1} );".format(tab_name,", ".join(sql_creation_arr)))
-			
-			fname = os.path.join(data_folder,table['datafile'])
-			print("\t- Reading file {0}".format(fname))
-			idf = pd.read_csv(fname, sep='\t', chunksize=100000)
-			#df_id = df.set_index('id')
-			print("\t- Inserting data into {0}".format(tab_name))
-			#df_id.to_sql(tab_name, con_db, if_exists='append')
-			for chunk in idf:
-				chunk.to_sql(tab_name, con_db, if_exists='append',index=False)
-			
-			indexes = table.get('indexes',[])
-			for index in indexes:
-				indexCommas = ', '.join(index)
-				print("\t- Indexing column(s): {0}".format(indexCommas))
-				index_ddl = "CREATE INDEX {0} ON {1} ({2});".format(tab_name+'_fk_'+'_'.join(index),tab_name,indexCommas)
-				cursor.execute(index_ddl)
-			
-			print("\t- Done!")
-	con_db.execute("""PRAGMA journal_mode = DELETE""")
+		sync_file(tmp_db_path)
+		
+		# The snapshot is tied to the final database file (its inode, size and
+		# modification time are kept by the rename), so it is written first
+		if shared_snapshot:
+			print("Writing shared snapshot")
+			write_snapshot(tmp_db_path,snapshot_path(db_path))
+		os.replace(tmp_db_path,db_path)
+	except:
+		if os.path.exists(tmp_db_path):
+			os.unlink(tmp_db_path)
+		raise
 	
 	print("Tables Ready")        
-	con_db.close()
 
 if __name__ == "__main__":
 	if hasattr(sys, 'frozen'):
@@ -87,17 +557,32 @@ if __name__ == "__main__":
 
 	project_folder = os.path.split(basis)[0]
 
+	# The whole database is rebuilt, whatever the recorded hashes
+	args = sys.argv[1:]
+	full_rebuild = '--full' in args
+	if full_rebuild:
+		args.remove('--full')
+	
+	# Skipping the shared snapshot used by the REST API workers
+	shared_snapshot = '--no-snapshot' not in args
+	if not shared_snapshot:
+		args.remove('--no-snapshot')
+	
 	data_folder = None
 	output_folder = None
 	db_path = None
-	if len(sys.argv) > 1:
-		data_folder = sys.argv[1]
+	workers = None
+	if len(args) > 0:
+		data_folder = args[0]
 
-		if len(sys.argv) > 2:
-			a_path = sys.argv[2]
+		if len(args) > 1:
+			a_path = args[1]
 			if os.path.isdir(a_path):
 				output_folder = a_path
 			else:
 				db_path = a_path
+			
+			if len(args) > 2:
+				workers = int(args[2])
 
-	main(project_folder=project_folder, data_folder=data_folder, output_folder=output_folder, db_path=db_path)
+	main(project_folder=project_folder, data_folder=data_folder, output_folder=output_folder, db_path=db_path, workers=workers, full_rebuild=full_rebuild, shared_snapshot=shared_snapshot)
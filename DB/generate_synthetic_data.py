@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+'''
+It writes a synthetic dataset following sql_create_tables.json, where the
+patient subgroups, the patients and all the tables depending on them
+(patient graph, patient subgroup digraph, gene and drug maps and
+intersections) are scaled by an integer factor. The reference tables
+(diseases, genes, drugs, studies, ...) are copied as they are.
+
+The first copy of each scaled table is the source one, so scale 1
+reproduces the source dataset. Every row from the source is a template
+for the other copies, so the degree distributions are kept: the entity
+of the row is moved to the copy, the other end of the graph edges goes
+to a random copy, and a fraction of the referenced genes and drugs are
+rewired, following their popularity in the source.
+
+Tables whose source datafile is missing are synthesized, when they relate
+a scaled table with a reference one (like the patient gene maps), with
+log-normal degrees and Zipf distributed item popularity.
+
+The scaled tables are written as plain TSV files, and the datafile names
+in the generated sql_create_tables.json are updated accordingly.
+
+Usage: python generate_synthetic_data.py [--scale N] [--seed S] [--source data] output_folder
+'''
+
+import argparse
+import csv
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shutil
+import time
+
+from create_db import TABLE_CONSTRAINTS, open_datafile, table_dependencies, dependency_order
+
+# The tables whose rows are multiplied. Any table referencing them is also scaled
+SCALED_TABLES = ('patient_subgroup','patient')
+
+COMPRESSION_EXTENSIONS = ('.xz','.gz','.bz2')
+
+FOREIGN_KEY_DECL_RE = re.compile(r'FOREIGN\s+KEY\s*\(\s*(\w+)\s*\)\s*REFERENCES\s+(\w+)',re.IGNORECASE)
+
+def table_columns(sql_ddl):
+	columns = []
+	for column_def in sql_ddl:
+		tokens = re.split(r'[\s(]+',column_def.strip(),maxsplit=1)
+		if tokens[0].upper() not in TABLE_CONSTRAINTS:
+			columns.append(tokens[0])
+	
+	return columns
+
+def foreign_keys(sql_ddl):
+	'''The referenced table of each foreign key column'''
+	fks = {}
+	for column_def in sql_ddl:
+		for column, ref_table in FOREIGN_KEY_DECL_RE.findall(column_def):
+			fks[column] = ref_table
+	
+	return fks
+
+def read_rows(fname):
+	with open_datafile(fname) as fh:
+		reader = csv.reader(fh,delimiter='\t')
+		header = next(reader)
+		yield header
+		yield from reader
+
+def plain_datafile(datafile):
+	for ext in COMPRESSION_EXTENSIONS:
+		if datafile.endswith(ext):
+			return datafile[0:-len(ext)]
+	
+	return datafile
+
+def report(tab_name,num_rows,t0):
+	elapsed = time.perf_counter() - t0
+	print("* {0}: {1} rows in {2:.2f}s".format(tab_name,num_rows,elapsed))
+
+class SyntheticDataset(object):
+	def __init__(self,source_folder,output_folder,scale=1,seed=None,rewire=0.05,mean_degree=5.0):
+		self.source_folder = source_folder
+		self.output_folder = output_folder
+		self.scale = scale
+		self.rewire = rewire
+		self.mean_degree = mean_degree
+		self.rng = random.Random(seed)
+		
+		# For each scaled table, the offset between the ids of consecutive copies,
+		# and all the generated ids
+		self.offsets = {}
+		self.scaled_ids = {}
+	
+	def _sourcePath(self,table):
+		return os.path.join(self.source_folder,table['datafile'])
+	
+	def _writer(self,fh):
+		return csv.writer(fh,delimiter='\t',lineterminator='\n')
+	
+	def _isScaled(self,table):
+		return table['table'] in SCALED_TABLES or any(ref_table in self.offsets for ref_table in foreign_keys(table['sql_ddl']).values())
+	
+	def _referenceIds(self,ref_table,table_decls):
+		'''The ids of a reference (not scaled) table, read from its source datafile'''
+		for table in table_decls:
+			if table['table'] == ref_table:
+				rows = read_rows(self._sourcePath(table))
+				id_col = next(rows).index('id')
+				return [ row[id_col] for row in rows ]
+		
+		raise KeyError('Table {} is not declared'.format(ref_table))
+	
+	def _scaleRoot(self,table,out_path):
+		'''The rows of the root scaled tables are replicated, with their ids shifted'''
+		rows = read_rows(self._sourcePath(table))
+		header = next(rows)
+		rows = list(rows)
+		id_col = header.index('id')
+		fks = foreign_keys(table['sql_ddl'])
+		fk_cols = [ (i, self.offsets[fks[column]]) for i, column in enumerate(header) if fks.get(column) in self.offsets ]
+		name_col = header.index('name')  if 'name' in header  else None
+		
+		offset = max(map(lambda row: int(row[id_col]),rows))  if len(rows) > 0  else 0
+		ids = []
+		with open(out_path,'w',encoding='utf-8',newline='') as fh:
+			writer = self._writer(fh)
+			writer.writerow(header)
+			for copy in range(self.scale):
+				for row in rows:
+					new_row = list(row)
+					new_row[id_col] = str(int(row[id_col]) + copy * offset)
+					ids.append(new_row[id_col])
+					# The copies of the patients belong to the copies of their subgroups
+					for i, fk_offset in fk_cols:
+						if row[i] != '':
+							new_row[i] = str(int(row[i]) + copy * fk_offset)
+					if copy > 0 and name_col is not None:
+						new_row[name_col] = '{}.{}'.format(row[name_col],copy)
+					writer.writerow(new_row)
+		
+		self.offsets[table['table']] = offset
+		self.scaled_ids[table['table']] = ids
+		return len(ids)
+	
+	def _scaleDependent(self,table,out_path):
+		'''Each source row is a template for the rows of every copy'''
+		fname = self._sourcePath(table)
+		rows = read_rows(fname)
+		header = next(rows)
+		fks = foreign_keys(table['sql_ddl'])
+		id_col = header.index('id')  if 'id' in header  else None
+		scaled_cols = [ (i, self.offsets[fks[column]]) for i, column in enumerate(header) if fks.get(column) in self.offsets ]
+		reference_cols = [ i for i, column in enumerate(header) if column in fks and fks[column] not in self.offsets ]
+		
+		# The rewired references follow the popularity of the referenced items
+		popularity = {}
+		if self.scale > 1 and self.rewire > 0:
+			for i in reference_cols:
+				popularity[i] = []
+			for row in rows:
+				for i in reference_cols:
+					popularity[i].append(row[i])
+		
+		rng = self.rng
+		num_rows = 0
+		with open(out_path,'w',encoding='utf-8',newline='') as fh:
+			writer = self._writer(fh)
+			writer.writerow(header)
+			for copy in range(self.scale):
+				rows = read_rows(fname)
+				next(rows)
+				for row in rows:
+					num_rows += 1
+					if copy > 0:
+						row = list(row)
+						# The first scaled reference is the owner of the row, and the
+						# other ones (the other end of the edges) go to any copy
+						for j, (i, fk_offset) in enumerate(scaled_cols):
+							if row[i] != '':
+								row[i] = str(int(row[i]) + (copy  if j == 0  else rng.randrange(self.scale)) * fk_offset)
+						for i in reference_cols:
+							if rng.random() < self.rewire:
+								row[i] = rng.choice(popularity[i])
+					if id_col is not None:
+						row[id_col] = str(num_rows)
+					writer.writerow(row)
+		
+		return num_rows
+	
+	def _synthesize(self,table,out_path,table_decls):
+		'''It generates the rows relating each scaled entity with a log-normal
+		number of reference items, chosen following a Zipf distribution'''
+		header = table_columns(table['sql_ddl'])
+		fks = foreign_keys(table['sql_ddl'])
+		entity_cols = [ column for column in header if fks.get(column) in self.offsets ]
+		item_cols = [ column for column in header if column in fks and fks[column] not in self.offsets ]
+		sign_cols = [ column for column in header if column.endswith('_sign') ]
+		if len(entity_cols) != 1 or len(item_cols) != 1 or len(header) != 2 + len(sign_cols) + (1  if 'id' in header  else 0):
+			raise ValueError('Table {} cannot be synthesized, as its datafile {} is missing'.format(table['table'],self._sourcePath(table)))
+		
+		rng = self.rng
+		items = self._referenceIds(fks[item_cols[0]],table_decls)
+		rng.shuffle(items)
+		cum_weights = list(itertools.accumulate(1.0 / rank for rank in range(1,len(items) + 1)))
+		sigma = 1.0
+		mu = math.log(self.mean_degree) - sigma * sigma / 2
+		
+		num_rows = 0
+		with open(out_path,'w',encoding='utf-8',newline='') as fh:
+			writer = self._writer(fh)
+			writer.writerow(header)
+			for entity_id in self.scaled_ids[fks[entity_cols[0]]]:
+				degree = min(len(items),max(1,int(round(rng.lognormvariate(mu,sigma)))))
+				for item_id in set(rng.choices(items,cum_weights=cum_weights,k=degree)):
+					num_rows += 1
+					values = {
+						'id': str(num_rows),
+						entity_cols[0]: entity_id,
+						item_cols[0]: item_id
+					}
+					for column in sign_cols:
+						values[column] = rng.choice(('1','-1'))
+					writer.writerow([ values[column] for column in header ])
+		
+		return num_rows
+	
+	def generate(self):
+		with open(os.path.join(self.source_folder,'sql_create_tables.json'),encoding='utf-8') as fh:
+			table_decls = json.load(fh)
+		
+		os.makedirs(self.output_folder,exist_ok=True)
+		print("Generating a {0}x synthetic dataset at {1}".format(self.scale,self.output_folder))
+		out_decls = []
+		ordered_decls = dependency_order(table_decls,table_dependencies(table_decls))
+		generated = {}
+		for table in ordered_decls:
+			if 'datafile' not in table:
+				continue
+			
+			t0 = time.perf_counter()
+			tab_name = table['table']
+			source_path = self._sourcePath(table)
+			if not self._isScaled(table):
+				if not os.path.exists(source_path):
+					raise FileNotFoundError('Datafile {} of reference table {} is missing'.format(source_path,tab_name))
+				shutil.copyfile(source_path,os.path.join(self.output_folder,table['datafile']))
+				generated[tab_name] = table['datafile']
+				continue
+			
+			datafile = plain_datafile(table['datafile'])
+			out_path = os.path.join(self.output_folder,datafile)
+			if tab_name in SCALED_TABLES:
+				num_rows = self._scaleRoot(table,out_path)
+			elif os.path.exists(source_path):
+				num_rows = self._scaleDependent(table,out_path)
+			else:
+				num_rows = self._synthesize(table,out_path,table_decls)
+			generated[tab_name] = datafile
+			report(tab_name,num_rows,t0)
+		
+		# The declarations keep their original order
+		for table in table_decls:
+			out_table = dict(table)
+			if table['table'] in generated:
+				out_table['datafile'] = generated[table['table']]
+			out_decls.append(out_table)
+		
+		with open(os.path.join(self.output_folder,'sql_create_tables.json'),'w',encoding='utf-8') as fh:
+			json.dump(out_decls,fh,indent='\t')
+			fh.write('\n')
+
+def main():
+	ap = argparse.ArgumentParser(description='Synthetic scale-out dataset generator')
+	ap.add_argument('-s','--scale',type=int,default=1,help='How many times the patient subgroups, patients and their related tables are replicated')
+	ap.add_argument('--seed',type=int,default=None,help='Seed of the random generator, for reproducible datasets')
+	ap.add_argument('--rewire',type=float,default=0.05,help='Fraction of the gene and drug references which are rewired in the copies')
+	ap.add_argument('--mean-degree',type=float,default=5.0,help='Mean number of items of each entity in the synthesized tables')
+	ap.add_argument('--source',default=os.path.join(os.path.dirname(os.path.abspath(__file__)),'data'),help='The source dataset directory')
+	ap.add_argument('output_folder',help='The directory where the synthetic dataset is written')
+	args = ap.parse_args()
+	
+	if args.scale < 1:
+		ap.error('The scale must be at least 1')
+	
+	SyntheticDataset(args.source,args.output_folder,scale=args.scale,seed=args.seed,rewire=args.rewire,mean_degree=args.mean_degree).generate()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+'''
+It writes the shared snapshot of a comorbidities network database: a
+binary file, next to the database, which the REST API workers memory map
+read-only, so the structures it holds are kept once in the page cache
+whatever the number of workers.
+
+File layout (all the numbers are little-endian):
+  - 8 bytes magic: b'DPSNAP' followed by the format version (2 bytes)
+  - 8 bytes: length of the JSON header
+  - the UTF-8 JSON header, with the version of the database file it was
+    built from, its table names, the entity sets definitions and, for each
+    array, its type code (from the array module), offset and length
+  - the arrays, from offset HEADER_SIZE, each one aligned to 64 bytes
+
+String columns are stored as a '.offsets' array of n+1 positions, relative
+to the '.data' bytes array. Nullable columns get a '.null' flags array.
+
+Usage: python shared_snapshot.py path/to/net_comorbidity.db
+'''
+
+import sys, os, json
+import array
+import sqlite3
+import struct
+import urllib.parse
+
+SNAPSHOT_MAGIC = b'DPSNAP'
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_SUFFIX = '.snapshot'
+
+# The arrays start at this offset, so the header can be written at the end
+HEADER_SIZE = 65536
+ALIGNMENT = 64
+
+# The entity sets answered by the REST API in-memory engine: the table and its
+# entity and item columns (along with regulation_sign)
+ENTITY_SET_TABLES = {
+	'patient_subgroup_drugs': ('patient_subgroup_drug_intersect','patient_subgroup_id','drug_id'),
+	'patient_subgroup_genes': ('patient_subgroup_gene_intersect','patient_subgroup_id','gene_id'),
+	'patient_drugs': ('patient_drug_maps','patient_id','drug_id'),
+	'patient_genes': ('patient_gene_maps','patient_id','gene_id'),
+}
+
+FETCH_SIZE = 100000
+
+def snapshot_path(db_path):
+	return os.path.splitext(db_path)[0] + SNAPSHOT_SUFFIX
+
+def file_version(path):
+	'''The same identifier of the database file contents the REST API uses'''
+	st = os.stat(path)
+	return '{:x}-{:x}-{:x}'.format(st.st_ino,st.st_size,st.st_mtime_ns)
+
+def read_header(path):
+	with open(path,'rb') as fh:
+		magic = fh.read(len(SNAPSHOT_MAGIC) + 2)
+		if len(magic) < len(SNAPSHOT_MAGIC) + 2 or magic[0:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+			return None
+		if struct.unpack('<H',magic[len(SNAPSHOT_MAGIC):])[0] != SNAPSHOT_FORMAT:
+			return None
+		header_len = struct.unpack('<Q',fh.read(8))[0]
+		return json.loads(fh.read(header_len).decode('utf-8'))
+
+def snapshot_is_current(db_path):
+	path = snapshot_path(db_path)
+	if not os.path.exists(path) or not os.path.exists(db_path):
+		return False
+	
+	header = read_header(path)
+	return header is not None and header['db_version'] == file_version(db_path)
+
+def fetch_rows(cur,query,params=()):
+	cur.execute(query,params)
+	while True:
+		rows = cur.fetchmany(FETCH_SIZE)
+		if len(rows) == 0:
+			break
+		
+		yield from rows
+
+def cumulative(counts):
+	'''CSR index pointers from the counts'''
+	indptr = array.array('q',[0]) * (len(counts) + 1)
+	total = 0
+	for i, count in enumerate(counts):
+		total += count
+		indptr[i + 1] = total
+	
+	return indptr
+
+class SnapshotWriter(object):
+	def __init__(self,path):
+		self.path = path
+		self.fh = open(path,'wb')
+		self.fh.truncate(HEADER_SIZE)
+		self.fh.seek(HEADER_SIZE)
+		self.arrays = {}
+	
+	def add_array(self,name,values):
+		'''values is an array.array, stored little-endian'''
+		offset = self.fh.tell()
+		padding = -offset % ALIGNMENT
+		if padding > 0:
+			self.fh.write(b'\0' * padding)
+			offset += padding
+		
+		if sys.byteorder != 'little' and values.itemsize > 1:
+			values = array.array(values.typecode,values)
+			values.byteswap()
+		values.tofile(self.fh)
+		self.arrays[name] = {'type': values.typecode, 'offset': offset, 'length': len(values)}
+	
+	def add_column(self,name,typecode,values):
+		'''An integer or real column, which can hold NULL values'''
+		values = list(values)
+		nulls = array.array('b',map(lambda value: value is None,values))
+		self.add_array(name,array.array(typecode,map(lambda value: 0  if value is None  else value,values)))
+		if any(nulls):
+			self.add_array(name + '.null',nulls)
+	
+	def add_strings(self,name,values):
+		offsets = array.array('q',[0])
+		nulls = array.array('b')
+		data = bytearray()
+		for value in values:
+			nulls.append(value is None)
+			if value is not None:
+				data.extend(value.encode('utf-8'))
+			offsets.append(len(data))
+		
+		self.add_array(name + '.offsets',offsets)
+		self.add_array(name + '.data',array.array('B',data))
+		if any(nulls):
+			self.add_array(name + '.null',nulls)
+	
+	def close(self,header):
+		header = dict(header)
+		header['arrays'] = self.arrays
+		header_bytes = json.dumps(header).encode('utf-8')
+		if len(SNAPSHOT_MAGIC) + 10 + len(header_bytes) > HEADER_SIZE:
+			raise ValueError('The snapshot header does not fit in {} bytes'.format(HEADER_SIZE))
+		
+		self.fh.seek(0)
+		self.fh.write(SNAPSHOT_MAGIC + struct.pack('<H',SNAPSHOT_FORMAT))
+		self.fh.write(struct.pack('<Q',len(header_bytes)))
+		self.fh.write(header_bytes)
+		self.fh.flush()
+		os.fsync(self.fh.fileno())
+		self.fh.close()
+
+def add_reference_tables(writer,cur,tables):
+	'''The reference tables, in the same order the REST API reads them'''
+	if not { 'gene', 'drug', 'study', 'disease_group_wide', 'disease_wide' } <= tables:
+		return False
+	
+	genes = list(fetch_rows(cur,'SELECT gene_symbol, ensembl_id, uniprot_id FROM gene'))
+	writer.add_strings('gene.symbol',map(lambda gene: gene[0],genes))
+	writer.add_strings('gene.ensembl_id',map(lambda gene: gene[1],genes))
+	writer.add_strings('gene.uniprot_id',map(lambda gene: gene[2],genes))
+	by_symbol = sorted(filter(lambda i: genes[i][0] is not None,range(len(genes))),key=lambda i: genes[i][0])
+	writer.add_array('gene.by_symbol',array.array('q',by_symbol))
+	del genes
+	
+	drugs = list(fetch_rows(cur,'SELECT id, name FROM drug'))
+	writer.add_column('drug.id','q',map(lambda drug: drug[0],drugs))
+	writer.add_strings('drug.name',map(lambda drug: drug[1],drugs))
+	writer.add_array('drug.by_id',array.array('q',sorted(range(len(drugs)),key=lambda i: drugs[i][0])))
+	
+	writer.add_strings('study.code',map(lambda study: study[0],fetch_rows(cur,'SELECT geo_arrayexpress_code FROM study')))
+	
+	disease_groups = list(fetch_rows(cur,'SELECT id, name, properties FROM disease_group_wide ORDER BY 1'))
+	writer.add_column('disease_group.id','q',map(lambda dg: dg[0],disease_groups))
+	writer.add_strings('disease_group.name',map(lambda dg: dg[1],disease_groups))
+	writer.add_strings('disease_group.properties',map(lambda dg: dg[2],disease_groups))
+	
+	diseases = list(fetch_rows(cur,'SELECT id, name, disease_group_id, properties FROM disease_wide ORDER BY 1'))
+	writer.add_column('disease.id','q',map(lambda d: d[0],diseases))
+	writer.add_strings('disease.name',map(lambda d: d[1],diseases))
+	writer.add_column('disease.disease_group_id','q',map(lambda d: d[2],diseases))
+	writer.add_strings('disease.properties',map(lambda d: d[3],diseases))
+	
+	return True
+
+def add_patient_graph(writer,cur,tables):
+	'''The patient interaction graph in CSR form, the same one the REST API
+	in-memory engine builds. Unknown subgroups and signs are stored as -1'''
+	if not { 'patient', 'patient_graph' } <= tables:
+		return False
+	
+	edges_query = 'FROM patient_graph WHERE patient_a_id >= 0 AND patient_b_id >= 0'
+	max_patient_id = cur.execute('SELECT MAX(id) FROM patient').fetchone()[0]
+	max_a_id, max_b_id = cur.execute('SELECT MAX(patient_a_id), MAX(patient_b_id) ' + edges_query).fetchone()
+	max_id = max(0,*filter(lambda value: value is not None,(max_patient_id, max_a_id, max_b_id)))
+	num_nodes = max_id + 1
+	
+	patient_subgroup = array.array('i',[-1]) * num_nodes
+	for patient_id, patient_subgroup_id in fetch_rows(cur,'SELECT id, IFNULL(patient_subgroup_id,-1) FROM patient'):
+		patient_subgroup[patient_id] = patient_subgroup_id
+	writer.add_array('patient_graph.patient_subgroup',patient_subgroup)
+	del patient_subgroup
+	
+	degrees = array.array('q',[0]) * num_nodes
+	indices = array.array('i'  if max_id < 2**31  else 'q')
+	signs = array.array('b')
+	for a_id, b_id, sign in fetch_rows(cur,'SELECT patient_a_id, patient_b_id, IFNULL(interaction_sign,-1) ' + edges_query + ' ORDER BY patient_a_id, patient_b_id, id'):
+		degrees[a_id] += 1
+		indices.append(b_id)
+		signs.append(sign)
+	
+	writer.add_array('patient_graph.indptr',cumulative(degrees))
+	del degrees
+	writer.add_array('patient_graph.indices',indices)
+	del indices
+	writer.add_array('patient_graph.signs',signs)
+	
+	return True
+
+def add_entity_sets(writer,cur,tables,name,table,entity_column,item_column):
+	'''The entity sets in CSR form, along with their transposed relation, the
+	same ones the REST API in-memory engine builds. Each element is the item
+	id * 2 + (regulation_sign > 0)'''
+	if table not in tables:
+		return False
+	
+	pairs_query = 'SELECT DISTINCT {1} AS entity, {2} * 2 + (IFNULL(regulation_sign,-1) > 0) AS element FROM {0} WHERE {1} >= 0 AND {2} >= 0'.format(table,entity_column,item_column)
+	max_entity, max_element = cur.execute('SELECT MAX(entity), MAX(element) FROM ({})'.format(pairs_query)).fetchone()
+	num_entities = max_entity + 1  if max_entity is not None  else 0
+	stride = max_element + 1  if max_element is not None  else 1
+	
+	degrees = array.array('q',[0]) * num_entities
+	elements = array.array('q')
+	for entity, element in fetch_rows(cur,pairs_query + ' ORDER BY entity, element'):
+		degrees[entity] += 1
+		elements.append(element)
+	writer.add_array(name + '.indptr',cumulative(degrees))
+	writer.add_array(name + '.elements',elements)
+	del degrees, elements
+	
+	element_degrees = array.array('q',[0]) * (stride + 1)
+	entities = array.array('q')
+	for entity, element in fetch_rows(cur,pairs_query + ' ORDER BY element, entity'):
+		element_degrees[element] += 1
+		entities.append(entity)
+	writer.add_array(name + '.element_indptr',cumulative(element_degrees))
+	writer.add_array(name + '.entities',entities)
+	
+	return True
+
+def write_snapshot(db_path,path=None):
+	'''It writes the snapshot of the database, atomically replacing the previous one.
+	It must be called once the database file is not going to be modified anymore'''
+	if path is None:
+		path = snapshot_path(db_path)
+	
+	version = file_version(db_path)
+	tmp_path = '{0}.tmp-{1}'.format(path,os.getpid())
+	con_db = sqlite3.connect('file:'+urllib.parse.quote(db_path)+'?mode=ro',uri=True)
+	try:
+		cur = con_db.cursor()
+		tables = frozenset(map(lambda table: table[0],cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")))
+		
+		writer = SnapshotWriter(tmp_path)
+		try:
+			header = {
+				'db_version': version,
+				'tables': sorted(tables),
+				'reference': add_reference_tables(writer,cur,tables),
+				'patient_graph': add_patient_graph(writer,cur,tables),
+				'entity_sets': {},
+			}
+			for name, (table, entity_column, item_column) in ENTITY_SET_TABLES.items():
+				if add_entity_sets(writer,cur,tables,name,table,entity_column,item_column):
+					header['entity_sets'][name] = [ table, entity_column, item_column ]
+			writer.close(header)
+		except:
+			writer.fh.close()
+			os.unlink(tmp_path)
+			raise
+		finally:
+			cur.close()
+	finally:
+		con_db.close()
+	
+	if file_version(db_path) != version:
+		os.unlink(tmp_path)
+		raise RuntimeError('Database {} was modified while its snapshot was being written'.format(db_path))
+	
+	os.replace(tmp_path,path)
+	return path
+
+if __name__ == "__main__":
+	if len(sys.argv) != 2:
+		print("Usage: {0} path/to/net_comorbidity.db".format(sys.argv[0]),file=sys.stderr)
+		sys.exit(1)
+	
+	print("Shared snapshot written at {0}".format(write_snapshot(sys.argv[1])))
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+'''
+End-to-end load benchmark of every API route. For each scale factor, it
+generates a synthetic dataset with DB/generate_synthetic_data.py, builds
+its database with DB/create_db.py and requests all the routes registered
+in the application, with random ids, either through the Flask test client
+or against a running server. The latency percentiles and throughput of
+each route, and of a concurrent mixed workload, are written as JSON.
+
+Usage: python benchmarks/load.py [--scales 1,10,100] [-n requests] [-t threads] [-o report.json] workdir
+       python benchmarks/load.py --db path/to/database.db [--url http://localhost:5000] [-n requests]
+'''
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+REST_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_DIR = os.path.join(os.path.dirname(REST_DIR),'DB')
+
+sys.path.insert(0,REST_DIR)
+
+# The id pool used to fill each path argument, chosen by the static path
+# segment before it
+ID_POOL_QUERIES = {
+	'diseases': 'SELECT id FROM disease',
+	'path': 'SELECT id FROM disease',
+	'groups': 'SELECT id FROM disease_group',
+	'drugs': 'SELECT id FROM drug',
+	'genes': 'SELECT gene_symbol FROM gene',
+	'studies': 'SELECT geo_arrayexpress_code FROM study',
+	'patients': 'SELECT id FROM patient',
+	'subgroups': 'SELECT id FROM patient_subgroup',
+}
+
+MIN_SIZES = (1, 2, 5, 10)
+
+# How many ids are put in list arguments
+LIST_SIZES = (1, 2, 5, 10)
+
+PATH_ARGUMENT_RE = re.compile(r'^<(?:([^:>(]+)(?:\(([^)]*)\))?:)?(\w+)>$')
+
+def percentile(sorted_values,fraction):
+	'''Nearest-rank percentile'''
+	if len(sorted_values) == 0:
+		return None
+	
+	rank = max(0,min(len(sorted_values) - 1,int(round(fraction * len(sorted_values) + 0.5)) - 1))
+	return sorted_values[rank]
+
+def summarize(samples,elapsed):
+	'''samples are (seconds, status, bytes) tuples'''
+	latencies = sorted(map(lambda sample: sample[0] * 1000.0,samples))
+	num_requests = len(samples)
+	return {
+		'requests': num_requests,
+		'errors': sum(1 for sample in samples if sample[1] >= 500),
+		'statuses': { str(status): sum(1 for sample in samples if sample[1] == status) for status in sorted(set(map(lambda sample: sample[1],samples))) },
+		'p50_ms': percentile(latencies,0.50),
+		'p95_ms': percentile(latencies,0.95),
+		'p99_ms': percentile(latencies,0.99),
+		'mean_ms': sum(latencies) / num_requests  if num_requests > 0  else None,
+		'max_ms': latencies[-1]  if num_requests > 0  else None,
+		'throughput_rps': num_requests / elapsed  if elapsed > 0  else None,
+		'mean_bytes': sum(map(lambda sample: sample[2],samples)) / num_requests  if num_requests > 0  else None,
+	}
+
+class RequestGenerator(object):
+	'''It builds random request paths for a route, using ids from the database'''
+	def __init__(self,dbpath,seed=None):
+		self.rng = random.Random(seed)
+		db = sqlite3.connect('file:{}?mode=ro'.format(dbpath),uri=True)
+		try:
+			self.pools = {}
+			for segment, query in ID_POOL_QUERIES.items():
+				self.pools[segment] = [ row[0] for row in db.execute(query) ]
+			
+			# A threshold keeping around 1% of the comorbidities, for the subgraph route
+			num_comorbidities = db.execute('SELECT COUNT(*) FROM disease_digraph').fetchone()[0]
+			row = db.execute('SELECT relative_risk FROM disease_digraph WHERE relative_risk IS NOT NULL ORDER BY relative_risk DESC LIMIT 1 OFFSET ?',(num_comorbidities // 100,)).fetchone()
+			self.min_rr = row[0]  if row is not None  else 1.0
+		finally:
+			db.close()
+	
+	def query_string(self,endpoint):
+		if endpoint == 'api.diseases_comorbidities_subgraph':
+			return 'min_rr={}'.format(self.min_rr)
+		
+		return None
+	
+	def _argument(self,converter,converter_args,segment):
+		rng = self.rng
+		if converter == 'any':
+			return rng.choice(re.findall(r'\w+',converter_args))
+		if segment == 'min_size':
+			return str(rng.choice(MIN_SIZES))
+		
+		pool = self.pools[segment]
+		if converter == 'list':
+			return ','.join(map(str,rng.sample(pool,min(len(pool),rng.choice(LIST_SIZES)))))
+		
+		return str(rng.choice(pool))
+	
+	def path_factory(self,rule):
+		'''It returns a function which builds a random path for the rule,
+		or None when the rule arguments cannot be filled'''
+		parts = []
+		segment = None
+		for part in rule.rule.split('/'):
+			match = PATH_ARGUMENT_RE.match(part)
+			if match is None:
+				parts.append(part)
+				segment = part
+				continue
+			
+			converter, converter_args, _ = match.groups()
+			if converter not in ('any',) and segment != 'min_size' and segment not in self.pools:
+				return None
+			parts.append((converter, converter_args, segment))
+		
+		query_string = self.query_string(rule.endpoint)
+		
+		def build_path():
+			path = '/'.join(part  if isinstance(part,str)  else self._argument(*part) for part in parts)
+			return path  if query_string is None  else path + '?' + query_string
+		
+		return build_path
+
+class TestClientTransport(object):
+	def __init__(self,app):
+		self.app = app
+		self.local = threading.local()
+	
+	def request(self,path):
+		client = getattr(self.local,'client',None)
+		if client is None:
+			client = self.local.client = self.app.test_client()
+		
+		t0 = time.perf_counter()
+		response = client.get(path,headers={'Accept-Encoding': 'gzip'})
+		body = response.get_data()
+		# The response on close hooks (metrics, slow log) are also accounted
+		response.close()
+		return time.perf_counter() - t0, response.status_code, len(body)
+
+class HTTPTransport(object):
+	def __init__(self,base_url):
+		self.base_url = base_url.rstrip('/')
+	
+	def request(self,path):
+		req = urllib.request.Request(self.base_url + path,headers={'Accept-Encoding': 'gzip'})
+		t0 = time.perf_counter()
+		try:
+			with urllib.request.urlopen(req) as response:
+				body = response.read()
+				status = response.status
+		except urllib.error.HTTPError as e:
+			body = e.read()
+			status = e.code
+		return time.perf_counter() - t0, status, len(body)
+
+def run_requests(transport,path_factories,num_requests,threads=1):
+	samples = []
+	
+	def worker(path_factory):
+		return transport.request(path_factory())
+	
+	t0 = time.perf_counter()
+	if threads <= 1:
+		for path_factory in path_factories[0:num_requests]:
+			samples.append(worker(path_factory))
+	else:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+			samples.extend(executor.map(worker,path_factories[0:num_requests]))
+	
+	return summarize(samples,time.perf_counter() - t0)
+
+def benchmark_database(args):
+	from libs.app import init_comorbidities_app
+	
+	app = init_comorbidities_app({'db': args.db, 'metrics': False, 'server_timing': False})
+	transport = HTTPTransport(args.url)  if args.url is not None  else TestClientTransport(app)
+	generator = RequestGenerator(args.db,seed=args.seed)
+	
+	routes = {}
+	skipped = []
+	for rule in sorted(app.url_map.iter_rules(),key=lambda rule: rule.rule):
+		if not rule.endpoint.startswith('api.') or 'GET' not in rule.methods:
+			continue
+		path_factory = generator.path_factory(rule)
+		if path_factory is None:
+			skipped.append(rule.rule)
+		else:
+			routes[rule.rule] = path_factory
+	
+	# Warm-up, so the lazily built structures (snapshot, caches) are not measured
+	for path_factory in routes.values():
+		transport.request(path_factory())
+	
+	report = {
+		'db': os.path.abspath(args.db),
+		'db_bytes': os.path.getsize(args.db),
+		'transport': 'http'  if args.url is not None  else 'test_client',
+		'routes': {},
+		'skipped_routes': skipped,
+	}
+	for route, path_factory in routes.items():
+		report['routes'][route] = run_requests(transport,[ path_factory ] * args.requests,args.requests)
+		print('{:<100} p50 {:>9.2f} ms  p99 {:>9.2f} ms'.format(route,report['routes'][route]['p50_ms'],report['routes'][route]['p99_ms']),file=sys.stderr)
+	
+	# The mixed workload requests every route with the same frequency
+	route_factories = list(routes.values())
+	num_mixed = args.requests * len(route_factories)
+	mixed_factories = [ generator.rng.choice(route_factories) for _ in range(num_mixed) ]
+	report['mixed'] = run_requests(transport,mixed_factories,num_mixed,threads=args.threads)
+	report['mixed']['threads'] = args.threads
+	
+	return report
+
+def run_script(script,script_args,cwd):
+	t0 = time.perf_counter()
+	subprocess.run([ sys.executable, script ] + script_args,cwd=cwd,check=True,stdout=sys.stderr)
+	return time.perf_counter() - t0
+
+def benchmark_scales(args):
+	report = {
+		'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'requests_per_route': args.requests,
+		'threads': args.threads,
+		'seed': args.seed,
+		'scales': [],
+	}
+	for scale in args.scales:
+		scale_dir = os.path.join(os.path.abspath(args.workdir),'scale_{}'.format(scale))
+		data_dir = os.path.join(scale_dir,'data')
+		dbpath = os.path.join(scale_dir,'net_comorbidity.db')
+		scale_report = { 'scale': scale }
+		if args.rebuild or not os.path.exists(dbpath):
+			if os.path.exists(dbpath):
+				os.unlink(dbpath)
+			generate_args = [ '--scale', str(scale), data_dir ]
+			if args.seed is not None:
+				generate_args[0:0] = [ '--seed', str(args.seed) ]
+			scale_report['generate_seconds'] = run_script('generate_synthetic_data.py',generate_args,DB_DIR)
+			scale_report['build_seconds'] = run_script('create_db.py',[ data_dir, dbpath ],DB_DIR)
+		
+		# Each database is benchmarked in its own process, as the
+		# application can only be instantiated once per process
+		bench_args = [ sys.executable, os.path.abspath(__file__), '--db', dbpath, '-n', str(args.requests), '-t', str(args.threads) ]
+		if args.seed is not None:
+			bench_args.extend([ '--seed', str(args.seed) ])
+		completed = subprocess.run(bench_args,check=True,stdout=subprocess.PIPE)
+		scale_report.update(json.loads(completed.stdout))
+		report['scales'].append(scale_report)
+	
+	return report
+
+def main():
+	ap = argparse.ArgumentParser(description='End-to-end load benchmark over synthetic datasets of several scales')
+	ap.add_argument('--scales',type=lambda value: [ int(scale) for scale in value.split(',') ],default=[ 1, 10, 100 ],help='Comma separated scale factors of the synthetic datasets')
+	ap.add_argument('-n','--requests',type=int,default=50,help='Number of requests per route')
+	ap.add_argument('-t','--threads',type=int,default=4,help='Number of concurrent clients in the mixed workload')
+	ap.add_argument('--seed',type=int,default=None,help='Seed used both to generate the datasets and to choose the requested ids')
+	ap.add_argument('--rebuild',action='store_true',help='Regenerate the datasets and databases already in the work directory')
+	ap.add_argument('-o','--output',help='Where the JSON report is written (default: standard output)')
+	ap.add_argument('--db',help='Benchmark only this database, instead of generating them')
+	ap.add_argument('--url',help='Base URL of a running server to benchmark, instead of using the Flask test client')
+	ap.add_argument('workdir',nargs='?',help='Directory where the synthetic datasets and databases are kept')
+	args = ap.parse_args()
+	
+	if args.db is not None:
+		report = benchmark_database(args)
+	elif args.workdir is not None:
+		report = benchmark_scales(args)
+	else:
+		ap.error('Either a work directory or a database (--db) is needed')
+	
+	if args.output is not None:
+		with open(args.output,'w',encoding='utf-8') as fh:
+			json.dump(report,fh,indent=1)
+	else:
+		json.dump(report,sys.stdout,indent=1)
+		print()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+'''
+Micro-benchmark of the ComorbiditiesNetwork query methods, against a fixed
+database and without any Flask request context. Each method is called in
+several rounds (each one long enough to be measured), and the median and
+best times per call are reported, along with the peak and retained memory
+allocated by a call (through tracemalloc, in a separate pass).
+
+The results can be saved as a baseline. Later runs are compared against
+it, and the program exits with an error when any method is slower, or
+allocates more memory, than the baseline beyond the tolerances.
+
+Usage: python benchmarks/methods.py [--save-baseline] [-b baseline.json] [-k pattern] path/to/database.db
+'''
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import re
+import statistics
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.cm_queries import ComorbiditiesNetwork
+from libs.query_audit import AUDITED_CALLS, AuditAPI, AuditAbort, sample_parameters
+
+# The calls from the query audit, along with the ones answered from the
+# in-memory structures (disease graph, entity sets, similarities)
+BENCHMARKED_CALLS = AUDITED_CALLS + [
+	('disease_groups', lambda cmn, p: cmn.disease_groups()),
+	('disease', lambda cmn, p: cmn.disease(p['disease_id'])),
+	('disease_comorbidities_neighbourhood', lambda cmn, p: cmn.disease_comorbidities_neighbourhood(p['disease_id'],hops=2)),
+	('top_disease_comorbidities', lambda cmn, p: cmn.top_disease_comorbidities(100)),
+	('top_disease_comorbidities(id)', lambda cmn, p: cmn.top_disease_comorbidities(10,p['disease_id'])),
+	('disease_comorbidities_subgraph', lambda cmn, p: cmn.disease_comorbidities_subgraph(2.0)),
+	('disease_comorbidity_path', lambda cmn, p: cmn.disease_comorbidity_path(p['disease_ids'][0],p['disease_ids'][-1])),
+	('patient_subgroups_gene_set', lambda cmn, p: cmn.patient_subgroups_gene_set(p['patient_subgroup_ids'],'union')),
+	('patient_subgroups_drug_set', lambda cmn, p: cmn.patient_subgroups_drug_set(p['patient_subgroup_ids'],'intersection')),
+	('patients_gene_set', lambda cmn, p: cmn.patients_gene_set(p['patient_ids'],'union')),
+	('patients_drug_set', lambda cmn, p: cmn.patients_drug_set(p['patient_ids'],'difference')),
+	('similar_patient_subgroups', lambda cmn, p: cmn.similar_patient_subgroups(p['patient_subgroup_id'])),
+	('similar_patients', lambda cmn, p: cmn.similar_patients(p['patient_id'])),
+]
+
+def consume(result):
+	'''Lazy results (generators from the iter_ methods) are fully fetched'''
+	if result is not None and not isinstance(result,(list, tuple, dict, str, bytes)) and hasattr(result,'__iter__'):
+		return list(result)
+	
+	return result
+
+def timed_rounds(func,rounds,min_round_time):
+	'''The number of calls per round is calibrated, so each round lasts at least
+	min_round_time seconds. It returns the time per call of each round'''
+	number = 1
+	while True:
+		t0 = time.perf_counter()
+		for _ in range(number):
+			func()
+		elapsed = time.perf_counter() - t0
+		if elapsed >= min_round_time:
+			break
+		number *= 2
+	
+	per_call = [ elapsed / number ]
+	for _ in range(rounds - 1):
+		t0 = time.perf_counter()
+		for _ in range(number):
+			func()
+		per_call.append((time.perf_counter() - t0) / number)
+	
+	return per_call, number
+
+def allocations(func):
+	'''Peak bytes allocated during a call, and bytes still held by its result'''
+	gc.collect()
+	tracemalloc.start()
+	try:
+		start, _ = tracemalloc.get_traced_memory()
+		tracemalloc.reset_peak()
+		result = func()
+		current, peak = tracemalloc.get_traced_memory()
+		del result
+	finally:
+		tracemalloc.stop()
+	
+	return peak - start, current - start
+
+def benchmark(dbpath,pattern=None,rounds=7,min_round_time=0.05):
+	cmn = ComorbiditiesNetwork(dbpath,AuditAPI(),result_cache_bytes=0)
+	try:
+		params = sample_parameters(cmn.db)
+		results = {}
+		for label, call in BENCHMARKED_CALLS:
+			if pattern is not None and re.search(pattern,label) is None:
+				continue
+			
+			func = lambda: consume(call(cmn,params))
+			try:
+				# Warm-up, which also builds the lazily loaded structures
+				func()
+			except AuditAbort as e:
+				print('* {}: skipped ({})'.format(label,e),file=sys.stderr)
+				continue
+			
+			per_call, number = timed_rounds(func,rounds,min_round_time)
+			peak_bytes, retained_bytes = allocations(func)
+			results[label] = {
+				'median_us': statistics.median(per_call) * 1e6,
+				'best_us': min(per_call) * 1e6,
+				'stdev_us': statistics.stdev(per_call) * 1e6  if len(per_call) > 1  else 0.0,
+				'calls_per_round': number,
+				'rounds': len(per_call),
+				'alloc_peak_bytes': peak_bytes,
+				'alloc_retained_bytes': retained_bytes,
+			}
+	finally:
+		cmn.close()
+	
+	return results
+
+def compare(results,baseline,time_tolerance,alloc_tolerance,alloc_slack):
+	'''It returns the regressions against the baseline'''
+	regressions = []
+	for label, result in results.items():
+		base = baseline.get(label)
+		if base is None:
+			continue
+		
+		if result['median_us'] > base['median_us'] * (1.0 + time_tolerance):
+			regressions.append((label,'time','{:.1f}us -> {:.1f}us'.format(base['median_us'],result['median_us'])))
+		if result['alloc_peak_bytes'] > base['alloc_peak_bytes'] * (1.0 + alloc_tolerance) + alloc_slack:
+			regressions.append((label,'memory','{} -> {} bytes'.format(base['alloc_peak_bytes'],result['alloc_peak_bytes'])))
+	
+	return regressions
+
+def main():
+	ap = argparse.ArgumentParser(description='Micro-benchmark of the ComorbiditiesNetwork query methods with regression gating')
+	ap.add_argument('-b','--baseline',help='The baseline file (by default, next to the database)')
+	ap.add_argument('--save-baseline',action='store_true',help='Save the results as the new baseline, instead of comparing against it')
+	ap.add_argument('-k','--pattern',help='Only benchmark the calls whose label matches this regular expression')
+	ap.add_argument('-r','--rounds',type=int,default=7,help='Number of timed rounds of each call (the median is compared)')
+	ap.add_argument('--min-round-time',type=float,default=0.05,help='Minimum duration of each round, in seconds')
+	ap.add_argument('--time-tolerance',type=float,default=0.25,help='Allowed relative slowdown of the median time per call')
+	ap.add_argument('--alloc-tolerance',type=float,default=0.10,help='Allowed relative growth of the allocation peak per call')
+	ap.add_argument('--alloc-slack',type=int,default=4096,help='Allowed absolute growth of the allocation peak per call, in bytes')
+	ap.add_argument('dbpath',help='The comorbidities network database')
+	args = ap.parse_args()
+	
+	baseline_path = args.baseline  if args.baseline  else os.path.splitext(args.dbpath)[0] + '.methods_baseline.json'
+	results = benchmark(args.dbpath,pattern=args.pattern,rounds=args.rounds,min_round_time=args.min_round_time)
+	
+	baseline = {}
+	if not args.save_baseline and os.path.exists(baseline_path):
+		with open(baseline_path,encoding='utf-8') as bh:
+			baseline = json.load(bh)['methods']
+	
+	print('{:<64} {:>12} {:>12} {:>9} {:>12} {:>12}'.format('method','median us','best us','vs base','peak KiB','retained KiB'))
+	for label, result in results.items():
+		base = baseline.get(label)
+		ratio = '{:>8.2f}x'.format(result['median_us'] / base['median_us'])  if base is not None and base['median_us'] > 0  else '{:>9}'.format('-')
+		print('{:<64} {:>12.1f} {:>12.1f} {} {:>12.1f} {:>12.1f}'.format(label,result['median_us'],result['best_us'],ratio,result['alloc_peak_bytes'] / 1024,result['alloc_retained_bytes'] / 1024))
+	
+	if args.save_baseline:
+		with open(baseline_path,mode='w',encoding='utf-8') as bh:
+			json.dump({
+				'database': os.path.abspath(args.dbpath),
+				'database_bytes': os.path.getsize(args.dbpath),
+				'generated': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+				'python': platform.python_version(),
+				'platform': platform.platform(),
+				'methods': results
+			},bh,indent=4)
+		print('Baseline saved at {}'.format(baseline_path))
+		return
+	
+	if len(baseline) == 0:
+		print('No baseline at {} (use --save-baseline to create it)'.format(baseline_path))
+		return
+	
+	regressions = compare(results,baseline,args.time_tolerance,args.alloc_tolerance,args.alloc_slack)
+	for label, kind, detail in regressions:
+		print('* REGRESSION {} ({}): {}'.format(label,kind,detail))
+	if len(regressions) > 0:
+		sys.exit(1)
+	
+	print('No regressions against {}'.format(baseline_path))
+
+if __name__ == '__main__':
+	main()
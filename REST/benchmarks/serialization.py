@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+'''
+It compares, for the list endpoints, the serialization through flask_restx
+marshal and the json module against the compiled model encoders.
+
+Usage: python benchmarks/serialization.py [-n repetitions] path/to/database.db
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask_restx import marshal
+
+from libs.cm_queries import ComorbiditiesNetwork
+from libs.res import api_models
+from libs.res.model_encoder import ModelEncoder, orjson
+
+class BenchmarkAPI(object):
+	'''Minimal replacement of the flask_restx Api, as only abort is used'''
+	def abort(self,code,message):
+		raise RuntimeError('{}: {}'.format(code,message))
+
+def endpoints(cmn):
+	snapshot = cmn.snapshot
+	patient_subgroup_ids = list(map(lambda ps: ps['id'],cmn.patient_subgroups()))[0:50]
+	patient_ids = list(map(lambda p: p['id'],cmn.patients()))[0:500]
+	disease_ids = list(snapshot.diseases_by_id.keys())
+	
+	return [
+		('/genes',api_models.gene_model,cmn.genes),
+		('/drugs',api_models.drug_model,cmn.drugs),
+		('/diseases',api_models.disease_model,cmn.diseases),
+		('/diseases/comorbidities',api_models.disease_comorbidity_model,cmn.disease_comorbidities),
+		('/diseases/<ids>/patients/subgroups/comorbidities',api_models.disease_patient_subgroup_comorbidity_model,lambda: cmn.diseases_patient_subgroups_comorbidities(disease_ids)),
+		('/patients',api_models.patient_model,cmn.patients),
+		('/patients/subgroups',api_models.patient_subgroup_model,cmn.patient_subgroups),
+		('/patients/subgroups/<ids>/genes',api_models.patient_subgroup_intersect_genes_model,lambda: cmn.patient_subgroup_intersect_genes(patient_subgroup_ids=patient_subgroup_ids)),
+		('/patients/<ids>/genes',api_models.patient_map_genes_model,lambda: cmn.patient_map_genes(patient_ids=patient_ids)),
+		('/patients/<ids>/interaction',api_models.patients_interaction_model,lambda: cmn.patients_interactions(patient_ids=patient_ids)),
+	]
+
+def best_time(func,repetitions):
+	best = None
+	for _ in range(repetitions):
+		t0 = time.perf_counter()
+		res = func()
+		elapsed = time.perf_counter() - t0
+		if best is None or elapsed < best:
+			best = elapsed
+	
+	return best, res
+
+def main():
+	ap = argparse.ArgumentParser(description='Serialization benchmark of the list endpoints')
+	ap.add_argument('-n','--repetitions',type=int,default=5,help='Number of repetitions (the best one is reported)')
+	ap.add_argument('dbpath',help='The comorbidities network database')
+	args = ap.parse_args()
+	
+	cmn = ComorbiditiesNetwork(args.dbpath,BenchmarkAPI(),result_cache_bytes=0)
+	
+	print('JSON encoder: {}'.format('orjson' if orjson is not None else 'json'))
+	print('{:<52} {:>8} {:>10} {:>10} {:>8}'.format('endpoint','entries','marshal ms','encoder ms','speedup'))
+	for path, model, query in endpoints(cmn):
+		try:
+			data = query()
+		except RuntimeError as e:
+			print('{:<52} skipped ({})'.format(path,e))
+			continue
+		
+		encoder = ModelEncoder(model)
+		marshal_time, marshal_body = best_time(lambda: json.dumps(marshal(data,model),separators=(',',':')).encode('utf-8'),args.repetitions)
+		encoder_time, encoder_body = best_time(lambda: encoder.dumps(data),args.repetitions)
+		
+		if json.loads(marshal_body) != json.loads(encoder_body):
+			print('{:<52} MISMATCH between both serializations'.format(path))
+			continue
+		
+		print('{:<52} {:>8} {:>10.2f} {:>10.2f} {:>7.1f}x'.format(path,len(data),marshal_time*1000,encoder_time*1000,marshal_time / encoder_time))
+	
+	cmn.close()
+
+if __name__ == '__main__':
+	main()
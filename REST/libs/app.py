@@ -3,6 +3,7 @@
 # coding: utf-8
 
 import sys, os
+import gc
 
 from flask import Flask, Blueprint, redirect
 from flask_restx import Api, Namespace, Resource
@@ -10,6 +11,9 @@ from flask_cors import CORS
 from flask_compress import Compress
 
 from .cm_queries import ComorbiditiesNetwork
+from .body_cache import PrecomputedBodies
+from .metrics import Metrics, default_spool_dir, instrument_network
+from .request_timing import RequestTiming
 
 from .res.ns import ROUTES as ROOT_ROUTES
 from .res.genes import ROUTES as GENE_ROUTES
@@ -55,6 +59,16 @@ def init_comorbidities_app(local_config):
 		#return redirect('./index.html')
 
 
+	# Per request phase timings and slow requests log. It is attached before
+	# CORS and compression, so the compression time is also accounted
+	request_timing = RequestTiming(
+		server_timing=local_config.get('server_timing',True),
+		slow_threshold_ms=local_config.get('slow_query_threshold_ms'),
+		slow_log=local_config.get('slow_query_log')
+	)
+	if request_timing.enabled:
+		request_timing.instrument_app(app)
+	
 	# This enables CORS along all the app
 	cors = CORS(app)
 	
@@ -74,9 +88,51 @@ def init_comorbidities_app(local_config):
 	
 	# This is the singleton instance shared by all the resources
 	dbpath = local_config['db']
-	CMNetwork = ComorbiditiesNetwork(dbpath, api)
+	CMNetwork = ComorbiditiesNetwork(
+		dbpath,
+		api,
+		pragmas=local_config.get('db_pragmas'),
+		result_cache_bytes=local_config.get('result_cache_bytes',64*1024*1024),
+		patient_graph_engine=local_config.get('patient_graph_engine',False),
+		sql_json_grouping=local_config.get('sql_json_grouping',False),
+		entity_sets_engine=local_config.get('entity_sets_engine',True),
+		shared_snapshot=local_config.get('shared_snapshot',True)
+	)
+	if local_config.get('preload',True):
+		CMNetwork.preload()
+		# The objects loaded before the workers are forked are moved out of
+		# the garbage collector reach, so it does not write on their pages
+		gc.freeze()
+	
+	# The bodies of the full list endpoints are kept serialized and compressed
+	bodies = PrecomputedBodies(lambda: CMNetwork.db_version, brotli_quality=local_config.get('brotli_quality',5))
+	
+	res_kwargs = {
+		'cmnetwork': CMNetwork,
+		'bodies': bodies
+	}
+	
+	# A database file replaced by a new build is picked up on the next request,
+	# while the requests in flight finish with the previous one
+	@blueprint.before_request
+	def pin_db_generation():
+		CMNetwork.begin_request()
+	
+	# Latencies, fetched rows and response sizes, aggregated among all the
+	# worker processes through a spool directory
+	if local_config.get('metrics',True):
+		metrics = Metrics(local_config.get('metrics_dir') or default_spool_dir(dbpath),flush_interval=local_config.get('metrics_flush_interval',5.0))
+		# The metrics from previous runs of the server are discarded, unless
+		# workers of this run (started on their own, without fork) are alive
+		metrics.reset()
+		metrics.instrument_network(CMNetwork)
+		metrics.instrument_blueprint(blueprint)
+		blueprint.add_url_rule('/metrics','metrics',metrics.response)
+	elif request_timing.enabled:
+		instrument_network(CMNetwork)
 	
-	res_kwargs = {'cmnetwork': CMNetwork}
+	if request_timing.enabled:
+		request_timing.instrument_blueprint(blueprint,CMNetwork)
 	
 	_register_cm_namespaces(api,res_kwargs)
 	
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+import gzip
+import hashlib
+import threading
+
+from flask import Response
+
+# Brotli is an optional dependency (it is pulled by Flask-Compress)
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+# This class holds a serialized response body, along with its
+# pre-compressed variants and their strong ETags
+class PrecomputedBody(object):
+	ENCODINGS = ('br','gzip') if brotli is not None else ('gzip',)
+	
+	def __init__(self,version,body,mimetype='application/json',compresslevel=9,brotli_quality=5):
+		self.version = version
+		self.mimetype = mimetype
+		self.compresslevel = compresslevel
+		self.brotli_quality = brotli_quality
+		
+		self.digest = hashlib.sha1(body).hexdigest()[0:20]
+		
+		# Each encoding is a different representation, so it gets its own strong ETag.
+		# Compressed variants are computed the first time they are requested, each
+		# one under its own lock, so a slow Brotli compression does not hold gzip
+		self.variants = {
+			'identity': (body, self.digest)
+		}
+		self._locks = { encoding: threading.Lock() for encoding in self.ENCODINGS }
+	
+	def _variant(self,encoding):
+		variant = self.variants.get(encoding)
+		if variant is None:
+			with self._locks[encoding]:
+				variant = self.variants.get(encoding)
+				if variant is None:
+					body = self.variants['identity'][0]
+					if encoding == 'br':
+						variant = (brotli.compress(body,quality=self.brotli_quality), self.digest + '-br')
+					else:
+						variant = (gzip.compress(body,compresslevel=self.compresslevel,mtime=0), self.digest + '-gzip')
+					self.variants[encoding] = variant
+		
+		return variant
+	
+	def _chooseEncoding(self,request):
+		accept_encodings = request.accept_encodings
+		for encoding in self.ENCODINGS:
+			if accept_encodings[encoding] > 0:
+				return encoding
+		
+		return 'identity'
+	
+	def _isKnownETag(self,if_none_match):
+		if if_none_match.star_tag:
+			return True
+		
+		# Any representation known by the client means it is up to date
+		for etag in if_none_match.as_set():
+			if etag == self.digest or etag.startswith(self.digest + '-'):
+				return True
+		
+		return False
+	
+	def response(self,request):
+		encoding = self._chooseEncoding(request)
+		
+		if request.if_none_match and self._isKnownETag(request.if_none_match):
+			resp = Response(status=304)
+			etag = self.digest if encoding == 'identity' else self.digest + '-' + encoding
+		else:
+			body, etag = self._variant(encoding)
+			resp = Response(body,mimetype=self.mimetype)
+			if encoding != 'identity':
+				resp.headers['Content-Encoding'] = encoding
+		
+		resp.set_etag(etag)
+		resp.headers['Vary'] = 'Accept-Encoding'
+		# Clients must revalidate, as the database can be replaced
+		resp.headers['Cache-Control'] = 'no-cache'
+		
+		return resp
+
+# This class keeps the precomputed bodies, which are
+# recomputed when the database version changes
+class PrecomputedBodies(object):
+	def __init__(self,version_getter,compresslevel=9,brotli_quality=5):
+		self.version_getter = version_getter
+		self.compresslevel = compresslevel
+		self.brotli_quality = brotli_quality
+		self._bodies = {}
+		self._key_locks = {}
+		self._lock = threading.Lock()
+	
+	def _keyLock(self,key):
+		with self._lock:
+			key_lock = self._key_locks.get(key)
+			if key_lock is None:
+				key_lock = threading.Lock()
+				self._key_locks[key] = key_lock
+		
+		return key_lock
+	
+	def get(self,key,producer):
+		version = self.version_getter()
+		entry = self._bodies.get(key)
+		if entry is None or entry.version != version:
+			# Only the requests of the same key wait for its body to be built
+			with self._keyLock(key):
+				entry = self._bodies.get(key)
+				if entry is None or entry.version != version:
+					entry = PrecomputedBody(version,producer(),compresslevel=self.compresslevel,brotli_quality=self.brotli_quality)
+					self._bodies[key] = entry
+		
+		return entry
+	
+	def clear(self):
+		with self._lock:
+			self._bodies = {}
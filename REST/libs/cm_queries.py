@@ -4,115 +4,335 @@
 
 #import sys, os
 
+import json
+import os
 import sqlite3
-import urllib
+import threading
+import urllib.parse
+import weakref
 
+from .ref_snapshot import ReferenceSnapshot, MappedReferenceSnapshot
+from .shared_snapshot import SharedSnapshot, snapshot_path
+from .result_cache import ResultCache, cached_result
+from .patient_graph import PatientGraph
+from .disease_graph import DiseaseGraph
+from .entity_sets import EntitySets, ENGINE_AVAILABLE as ENTITY_SETS_ENGINE_AVAILABLE, SET_OPERATIONS, SIMILARITY_METRICS, similarity, numpy
+
+
+# This class holds the in-memory structures loaded from one version of the
+# database file. Each request keeps using the generation it started with,
+# even when the file is replaced meanwhile
+class DatabaseGeneration(object):
+	def __init__(self,version):
+		self.version = version
+		# The shared snapshot written along with this version of the database, if any
+		self.shared = None
+		self.snapshot = None
+		self.patient_graph = None
+		self.disease_graph = None
+		self.entity_sets = {}
+		self.lock = threading.Lock()
+
+# This class holds the read-only connection of a thread. It is only referenced
+# by the thread local storage (and weakly by the pool), so the connection is
+# closed as soon as its thread finishes
+class PooledConnection(object):
+	def __init__(self,db,version):
+		self.db = db
+		self.version = version
+		self.close = weakref.finalize(self,db.close)
 
 # This class manages all the database queries
 class ComorbiditiesNetwork(object):
-	def __init__(self,dbpath,api,itersize=100):
+	# Pragmas applied to every read-only connection from the pool.
+	# They can be overridden through the 'db_pragmas' configuration key
+	DEFAULT_PRAGMAS = {
+		'query_only': 1,
+		'temp_store': 'memory',
+		# 256MiB of memory mapped I/O
+		'mmap_size': 268435456,
+		# Negative values are in KiB, so 64MiB of page cache
+		'cache_size': -65536,
+	}
+	
+	# The metrics instrumentation replaces it by a row counting one
+	cursor_factory = sqlite3.Cursor
+	
+	def __init__(self,dbpath,api,itersize=100,pragmas=None,result_cache_bytes=64*1024*1024,patient_graph_engine=False,sql_json_grouping=False,entity_sets_engine=True,shared_snapshot=True):
 		self.api = api
-		self.db = sqlite3.connect('file:'+urllib.parse.quote(dbpath)+'?mode=ro',uri=True, check_same_thread=False)
 		self.dbpath = dbpath
 		self.itersize = itersize
+		
+		# Results from the multi-id queries are cached, unless it is disabled
+		if result_cache_bytes:
+			self.result_cache = ResultCache(lambda: self.db_version,max_bytes=result_cache_bytes)
+		else:
+			self.result_cache = None
+		
+		self.pragmas = dict(self.DEFAULT_PRAGMAS)
+		if pragmas:
+			self.pragmas.update(pragmas)
+		
+		# One read-only connection per thread, lazily opened
+		self._local = threading.local()
+		self._pool = weakref.WeakSet()
+		
+		# The database file can be atomically replaced by a new build
+		self._generation = None
+		self._generation_lock = threading.Lock()
+		
+		# The in-memory patient graph engine is optional
+		self.patient_graph_engine = patient_graph_engine
+		
+		# When enabled, the grouped queries return the JSON built by SQLite
+		self.sql_json_grouping = sql_json_grouping
+		
+		# The set operations are answered through SQL when NumPy is not available
+		self.entity_sets_engine = entity_sets_engine and ENTITY_SETS_ENGINE_AVAILABLE
+		
+		# The structures held by the shared snapshot (by default, the one next to
+		# the database) are memory mapped instead of loaded by every process
+		if shared_snapshot is True:
+			shared_snapshot = snapshot_path(dbpath)
+		self.shared_snapshot_path = shared_snapshot  if shared_snapshot  else None
+	
+	def _fileVersion(self):
+		'''An identifier of the database file contents, based on its inode, size and modification time'''
+		st = os.stat(self.dbpath)
+		return '{:x}-{:x}-{:x}'.format(st.st_ino,st.st_size,st.st_mtime_ns)
+	
+	def _currentGeneration(self):
+		version = self._fileVersion()
+		generation = self._generation
+		if generation is None or generation.version != version:
+			with self._generation_lock:
+				generation = self._generation
+				if generation is None or generation.version != version:
+					generation = DatabaseGeneration(version)
+					if self.shared_snapshot_path is not None:
+						generation.shared = SharedSnapshot.open(self.shared_snapshot_path,version)
+					self._generation = generation
+		
+		return generation
+	
+	def begin_request(self):
+		'''It pins the current database generation to the calling thread, so a
+		replaced database file is only noticed between requests. The connection
+		of the thread is opened on that same version of the file'''
+		self._local.generation = None
+		while True:
+			generation = self._currentGeneration()
+			conn = self._connection(generation.version)
+			if conn.version == generation.version:
+				break
+		
+		self._local.generation = generation
+	
+	@property
+	def generation(self):
+		generation = getattr(self._local,'generation',None)
+		if generation is None:
+			generation = self._currentGeneration()
+		
+		return generation
+	
+	@property
+	def db_version(self):
+		'''The version of the database file being used by the calling thread'''
+		return self.generation.version
+	
+	def _connect(self):
+		'''It opens a connection, along with the version of the database file it was opened on'''
+		while True:
+			version = self._fileVersion()
+			db = sqlite3.connect('file:'+urllib.parse.quote(self.dbpath)+'?mode=ro',uri=True, check_same_thread=False)
+			for pragma, value in self.pragmas.items():
+				db.execute('PRAGMA {} = {}'.format(pragma,value))
+			
+			if self._fileVersion() == version:
+				return db, version
+			
+			# The file was replaced while it was being opened
+			db.close()
+	
+	def _connection(self,version):
+		conn = getattr(self._local,'conn',None)
+		# The connection is reopened when it is on a different version than the
+		# requested one, unless it is already on the current file
+		if conn is not None and conn.version != version and conn.version != self._fileVersion():
+			conn.close()
+			conn = None
+		
+		if conn is None:
+			conn = PooledConnection(*self._connect())
+			self._local.conn = conn
+			self._pool.add(conn)
+		
+		return conn
+	
+	@property
+	def db(self):
+		return self._connection(self.generation.version).db
+	
+	def close(self):
+		'''It closes all the pooled connections, whatever the thread which opened them'''
+		for conn in list(self._pool):
+			conn.close()
+		
+		# New connections are opened on next use
+		self._local = threading.local()
 	
 	def _getCursor(self):
-		cur = self.db.cursor()
+		cur = self.db.cursor(self.cursor_factory)
 		cur.arraysize = self.itersize
 		return cur
 		
+	@property
+	def snapshot(self):
+		'''The in-memory snapshot of the reference tables, loaded on first use'''
+		generation = self.generation
+		snapshot = generation.snapshot
+		if snapshot is None:
+			with generation.lock:
+				snapshot = generation.snapshot
+				if snapshot is None:
+					if generation.shared is not None and generation.shared.header['reference']:
+						snapshot = MappedReferenceSnapshot(generation.shared)
+					else:
+						snapshot = ReferenceSnapshot(self.db)
+					generation.snapshot = snapshot
+		
+		return snapshot
+	
+	@property
+	def patient_graph(self):
+		'''The in-memory patient graph, when the engine is enabled'''
+		if not self.patient_graph_engine:
+			return None
+		
+		generation = self.generation
+		patient_graph = generation.patient_graph
+		if patient_graph is None:
+			with generation.lock:
+				patient_graph = generation.patient_graph
+				if patient_graph is None:
+					if generation.shared is not None:
+						patient_graph = PatientGraph.from_shared(generation.shared)
+					if patient_graph is None:
+						patient_graph = PatientGraph(self.db)
+					generation.patient_graph = patient_graph
+		
+		return patient_graph
+	
+	@property
+	def disease_graph(self):
+		'''The in-memory disease comorbidity network, loaded on first use'''
+		generation = self.generation
+		disease_graph = generation.disease_graph
+		if disease_graph is None:
+			# The snapshot is needed to choose the source, and it takes the same lock
+			query = 'SELECT {0} FROM {1} ORDER BY id'.format(self.DISEASE_COMORBIDITY_COLUMNS,self._diseaseDigraphSource())
+			with generation.lock:
+				disease_graph = generation.disease_graph
+				if disease_graph is None:
+					disease_graph = DiseaseGraph(self.db,query,self._formatDiseaseComorbidity)
+					generation.disease_graph = disease_graph
+		
+		return disease_graph
+	
+	def preload(self):
+		'''It loads the in-memory structures at startup, closing the used connections
+		so they are not shared with forked workers'''
+		self.snapshot
+		self.patient_graph
+		self.disease_graph
+		for name in self.ENTITY_SET_TABLES:
+			self.entity_sets(name)
+		self.close()
+	
 	def genes(self,symbol=None):
-		res = []
+		snapshot = self.snapshot
+		if symbol is not None:
+			gene = snapshot.genes_by_symbol.get(symbol)
+			if gene is None:
+				self.api.abort(404, "Gene {} is not found in the database".format(symbol))
+			return [ gene ]
+		
+		if len(snapshot.genes) == 0:
+			self.api.abort(500,"Empty comorbidities database")
+		
+		# flask_restx does not accept tuples as list responses
+		return list(snapshot.genes)
+		
+	def _keysetPage(self,query_template,key_column,mapper,limit,after=None):
+		'''It returns a window of at most limit mapped rows, whose key (the first column)
+		is greater than after, along with the key of the last row when there are more
+		rows to fetch. The query template gets the key condition in its {0} placeholder'''
+		key_filter = '1' if after is None else '{} > :after'.format(key_column)
+		query = query_template.format(key_filter) + '\nORDER BY {} LIMIT :limit'.format(key_column)
+		
 		cur = self._getCursor()
 		try:
-			if symbol is not None:
-				cur.execute('SELECT gene_symbol,ensembl_id,uniprot_id FROM gene WHERE gene_symbol = ?',(symbol,))
-			else:
-				cur.execute('SELECT gene_symbol,ensembl_id,uniprot_id FROM gene')
-			while True:
-				genes = cur.fetchmany()
-				if len(genes)==0:
-					if len(res) == 0:
-						if symbol is not None:
-							self.api.abort(404, "Gene {} is not found in the database".format(symbol))
-						else:
-							self.api.abort(500,"Empty comorbidities database")
-					break
-				
-				res.extend(map(lambda gene: {
-						'symbol': gene[0],
-						'ensembl_id': gene[1],
-						'uniprot_acc': gene[2]
-					},genes))
+			# One more row is fetched, to know whether there is a next page
+			cur.execute(query,{'after': after,'limit': limit + 1})
+			rows = cur.fetchall()
 		finally:
 			# Assuring the cursor is properly closed
 			cur.close()
 		
-		return res
+		if len(rows) == 0 and after is None:
+			self.api.abort(500,"Empty comorbidities database")
 		
+		next_after = rows[limit - 1][0]  if len(rows) > limit  else None
+		return list(map(mapper,rows[0:limit])), next_after
+	
+	def genes_page(self,limit,after=None):
+		return self._keysetPage('SELECT id,gene_symbol,ensembl_id,uniprot_id FROM gene WHERE {0}','id',lambda gene: {
+				'symbol': gene[1],
+				'ensembl_id': gene[2],
+				'uniprot_acc': gene[3]
+			},limit,after)
+	
 	def gene(self,symbol):
 		res = self.genes(symbol=symbol)
 		
 		return res[0]
 	
 	def drugs(self,drug_id=None):
-		res = []
-		cur = self._getCursor()
-		try:
-			if drug_id is not None:
-				cur.execute('SELECT id,name FROM drug WHERE id = ?',(drug_id,))
-			else:
-				cur.execute('SELECT id,name FROM drug')
-			while True:
-				drugs = cur.fetchmany()
-				if len(drugs)==0:
-					if len(res) == 0:
-						if drug_id is not None:
-							self.api.abort(404, "Drug {} is not found in the database".format(drug_id))
-						else:
-							self.api.abort(500,"Empty comorbidities database")
-					break
-				
-				res.extend(map(lambda drug: {'id': drug[0],'name': drug[1]},drugs))
-		finally:
-			# Assuring the cursor is properly closed
-			cur.close()
+		snapshot = self.snapshot
+		if drug_id is not None:
+			drug = snapshot.drugs_by_id.get(drug_id)
+			if drug is None:
+				self.api.abort(404, "Drug {} is not found in the database".format(drug_id))
+			return [ drug ]
 		
-		return res
+		if len(snapshot.drugs) == 0:
+			self.api.abort(500,"Empty comorbidities database")
+		
+		# flask_restx does not accept tuples as list responses
+		return list(snapshot.drugs)
 		
+	def drugs_page(self,limit,after=None):
+		return self._keysetPage('SELECT id,name FROM drug WHERE {0}','id',lambda drug: {'id': drug[0],'name': drug[1]},limit,after)
+	
 	def drug(self,id):
 		res = self.drugs(drug_id = id)
 		
 		return res[0]
-
-	@staticmethod
-	def _formatStudy(study_id):
-		return {'id': study_id,'source': 'GEO'  if study_id.startswith('GSE')  else 'ArrayExpress' }
 	
 	def studies(self,study_id=None):
-		res = []
-		cur = self._getCursor()
-		try:
-			if study_id is not None:
-				cur.execute('SELECT geo_arrayexpress_code FROM study WHERE geo_arrayexpress_code = ?',(study_id,))
-			else:
-				cur.execute('SELECT geo_arrayexpress_code FROM study')
-			while True:
-				studies = cur.fetchmany()
-				if len(studies)==0:
-					if len(res)==0:
-						if study_id is not None:
-							self.api.abort(404, "Study {} is not found in the database".format(study_id))
-						else:
-							self.api.abort(500,"Empty comorbidities database")
-					break
-				
-				res.extend(map(lambda study: ComorbiditiesNetwork._formatStudy(study[0]) ,studies))
-		finally:
-			# Assuring the cursor is properly closed
-			cur.close()
+		snapshot = self.snapshot
+		if study_id is not None:
+			study = snapshot.studies_by_id.get(study_id)
+			if study is None:
+				self.api.abort(404, "Study {} is not found in the database".format(study_id))
+			return [ study ]
 		
-		return res
+		if len(snapshot.studies) == 0:
+			self.api.abort(500,"Empty comorbidities database")
+		
+		# flask_restx does not accept tuples as list responses
+		return list(snapshot.studies)
 		
 	def study(self,study_id):
 		res = self.studies(study_id)
@@ -120,46 +340,18 @@ class ComorbiditiesNetwork(object):
 		return res[0]
 	
 	def disease_groups(self,disease_group_id=None):
-		res = []
-		cur = self._getCursor()
-		try:
-			if disease_group_id is not None:
-				cur.execute('SELECT dg.id,dg.name,dgp.property,dgp.value FROM disease_group dg LEFT JOIN disease_group_properties dgp ON dgp.disease_group_id = dg.id WHERE dg.id = ? ORDER BY 1',(disease_group_id,))
-			else:
-				cur.execute('SELECT dg.id,dg.name,dgp.property,dgp.value FROM disease_group dg LEFT JOIN disease_group_properties dgp ON dgp.disease_group_id = dg.id ORDER BY 1')
-			minires = None
-			while True:
-				dg_props = cur.fetchmany()
-				if len(dg_props) == 0:
-					# Empty dictionary?
-					if len(res) == 0:
-						if disease_group_id is not None:
-							self.api.abort(404, "Disease group {} is not found in the database".format(disease_group_id))
-						else:
-							self.api.abort(500,"Empty comorbidities database")
-					break
-				
-				for dgp in dg_props:
-					# Initializing common properties
-					if minires and minires.get('id') != dgp[0]:
-						minires = None
-					
-					if not minires:
-						minires = {
-							'id': dgp[0],
-							'name': dgp[1]
-						}
-						# In this way we do not have to setup an end condition
-						res.append(minires)
-					
-					if dgp[2] is not None:
-						minires[dgp[2]] = dgp[3]
+		snapshot = self.snapshot
+		if disease_group_id is not None:
+			disease_group = snapshot.disease_groups_by_id.get(disease_group_id)
+			if disease_group is None:
+				self.api.abort(404, "Disease group {} is not found in the database".format(disease_group_id))
+			return [ disease_group ]
 		
-		finally:
-			# Assuring the cursor is properly closed
-			cur.close()
+		if len(snapshot.disease_groups) == 0:
+			self.api.abort(500,"Empty comorbidities database")
 		
-		return res
+		# flask_restx does not accept tuples as list responses
+		return list(snapshot.disease_groups)
 	
 	def disease_group(self,id):
 		res = self.disease_groups(disease_group_id=id)
@@ -167,172 +359,247 @@ class ComorbiditiesNetwork(object):
 		return res[0]
 	
 	def diseases(self,disease_group_id=None,disease_id=None):
-		res = []
-		cur = self._getCursor()
-		try:
-			if disease_group_id is not None:
-				cur.execute('SELECT d.id,d.name,d.disease_group_id,dp.property,dp.value FROM disease d LEFT JOIN disease_properties dp ON dp.disease_id = d.id WHERE d.disease_group_id = ? ORDER BY 1',(disease_group_id,))
-			elif disease_id is not None:
-				cur.execute('SELECT d.id,d.name,d.disease_group_id,dp.property,dp.value FROM disease d LEFT JOIN disease_properties dp ON dp.disease_id = d.id WHERE d.id = ? ORDER BY 1',(disease_id,))
-			else:
-				cur.execute('SELECT d.id,d.name,d.disease_group_id,dp.property,dp.value FROM disease d LEFT JOIN disease_properties dp ON dp.disease_id = d.id ORDER BY 1')
-			minires = None
-			while True:
-				disease_props = cur.fetchmany()
-				if len(disease_props) == 0:
-					# Empty dictionary?
-					if len(res) == 0:
-						if disease_group_id is not None:
-							self.api.abort(404, "Disease group {} is not found in the database".format(disease_group_id))
-						elif disease_id is not None:
-							self.api.abort(404, "Disease {} is not found in the database".format(disease_id))
-						else:
-							self.api.abort(500,"Empty comorbidities database")
-					break
-				
-				for dp in disease_props:
-					# Initializing common properties
-					if minires and minires.get('id') != dp[0]:
-						minires = None
-					
-					if not minires:
-						minires = {
-							'id': dp[0],
-							'name': dp[1],
-							'disease_group_id': dp[2]
-						}
-						# In this way we do not have to setup an end condition
-						res.append(minires)
-					
-					if dp[3] is not None:
-						minires[dp[3]] = dp[4]
+		snapshot = self.snapshot
+		if disease_group_id is not None:
+			res = snapshot.diseases_by_group.get(disease_group_id)
+			if res is None:
+				self.api.abort(404, "Disease group {} is not found in the database".format(disease_group_id))
+			return list(res)
 		
-		finally:
-			# Assuring the cursor is properly closed
-			cur.close()
+		if disease_id is not None:
+			disease = snapshot.diseases_by_id.get(disease_id)
+			if disease is None:
+				self.api.abort(404, "Disease {} is not found in the database".format(disease_id))
+			return [ disease ]
 		
-		return res
+		if len(snapshot.diseases) == 0:
+			self.api.abort(500,"Empty comorbidities database")
+		
+		# flask_restx does not accept tuples as list responses
+		return list(snapshot.diseases)
 	
 	def disease(self,disease_id):
 		res = self.diseases(disease_id=disease_id)
 		
 		return res[0]
 	
-	def disease_comorbidities(self,id=None):
-		res = None
+	# Equivalent to the disease_digraph_wide table, for databases built before it was introduced
+	DISEASE_DIGRAPH_WIDE_SUBQUERY = '''(
+SELECT dd.id AS id, dd.disease_a_id AS disease_a_id, dd.disease_b_id AS disease_b_id, dd.relative_risk AS relative_risk,
+(SELECT json_group_object(ddp.property, ddp.value) FROM disease_digraph_properties ddp WHERE ddp.disease_digraph_id = dd.id) AS properties
+FROM disease_digraph dd
+)'''
+	
+	def _diseaseDigraphSource(self):
+		if 'disease_digraph_wide' in self.snapshot.tables:
+			return 'disease_digraph_wide'
+		
+		return self.DISEASE_DIGRAPH_WIDE_SUBQUERY
+	
+	# The comorbidity properties are stored as JSON, so they come with the edges
+	DISEASE_COMORBIDITY_COLUMNS = "disease_a_id,disease_b_id,relative_risk,json_extract(properties,'$.appears_in')"
+	
+	@staticmethod
+	def _formatDiseaseComorbidity(co):
+		return {'from_id': co[0], 'to_id': co[1], 'rel_risk': co[2], 'appears_in': co[3] }
+	
+	# The relative risk orderings which can be requested
+	REL_RISK_ORDERINGS = {
+		'rr_desc': 'DESC',
+		'rr_asc': 'ASC',
+	}
+	
+	def _relRiskClauses(self,column,min_rr=None,max_rr=None,order=None,limit=None,default_order=None):
+		'''It returns the relative risk conditions (to be appended to a WHERE clause),
+		and the ORDER BY and LIMIT clauses, so they are evaluated by SQLite through
+		the (entity, relative_risk) indexes. They use the :min_rr, :max_rr and :limit
+		named parameters. When no order is requested, the rows are sorted by the
+		default_order column, so the answer does not depend on the query plan'''
+		if min_rr is not None and max_rr is not None and max_rr < min_rr:
+			self.api.abort(400, "The maximum relative risk must not be lower than the minimum one")
+		
+		conditions = ''
+		if min_rr is not None:
+			conditions += '\nAND {} >= :min_rr'.format(column)
+		if max_rr is not None:
+			conditions += '\nAND {} <= :max_rr'.format(column)
+		
+		tail = ''
+		if order is not None:
+			tail += '\nORDER BY {} {}'.format(column,self.REL_RISK_ORDERINGS[order])
+		elif default_order is not None:
+			tail += '\nORDER BY {}'.format(default_order)
+		if limit is not None:
+			tail += '\nLIMIT :limit'
+		
+		return conditions, tail
+	
+	def iter_disease_comorbidities(self,id=None,min_rr=None,max_rr=None,order=None,limit=None):
+		rr_conditions, rr_tail = self._relRiskClauses('relative_risk',min_rr,max_rr,order,limit,default_order='id')
+		# When the comorbidities are thresholded, an empty answer is a valid one
+		thresholded = min_rr is not None or max_rr is not None
+		if thresholded and id is not None and id not in self.snapshot.diseases_by_id:
+			self.api.abort(404, "Disease {} is not found in the database".format(id))
+		
+		disease_filter = '1'  if id is None  else '(disease_a_id = :disease_id OR disease_b_id = :disease_id)'
+		query = 'SELECT {0} FROM {1}\nWHERE {2}{3}{4}'.format(self.DISEASE_COMORBIDITY_COLUMNS,self._diseaseDigraphSource(),disease_filter,rr_conditions,rr_tail)
+		query_params = {
+			'disease_id': id,
+			'min_rr': min_rr,
+			'max_rr': max_rr,
+			'limit': limit
+		}
+		
 		cur = self._getCursor()
 		try:
-			if id is not None:
-				cur.execute('SELECT disease_a_id,disease_b_id,relative_risk FROM disease_digraph WHERE disease_a_id = :disease_id OR disease_b_id = :disease_id',{'disease_id': id})
-			else:
-				cur.execute('SELECT disease_a_id,disease_b_id,relative_risk FROM disease_digraph')
-			res = []
+			cur.execute(query,query_params)
+			empty = True
 			while True:
 				disease_co = cur.fetchmany()
 				if len(disease_co) == 0:
 					# Empty dictionary?
-					if not res:
+					if empty and not thresholded:
 						if id is not None:
 							self.api.abort(404, "Disease {} has no comorbidities stored in the database".format(id))
 						else:
 							self.api.abort(500, "Empty comorbidities database")
 					break
 				
-				res.extend(map(lambda co: {'from_id': co[0], 'to_id': co[1], 'rel_risk': co[2] },disease_co))
+				empty = False
+				yield from map(self._formatDiseaseComorbidity,disease_co)
 		finally:
 			# Assuring the cursor is properly closed
 			cur.close()
+	
+	def disease_comorbidities(self,id=None,min_rr=None,max_rr=None,order=None,limit=None):
+		return list(self.iter_disease_comorbidities(id=id,min_rr=min_rr,max_rr=max_rr,order=order,limit=limit))
+	
+	def disease_comorbidities_page(self,limit,after=None):
+		query_template = 'SELECT id,{0} FROM {1} WHERE {{0}}'.format(self.DISEASE_COMORBIDITY_COLUMNS,self._diseaseDigraphSource())
+		return self._keysetPage(query_template,'id',lambda co: self._formatDiseaseComorbidity(co[1:]),limit,after)
+	
+	def _diseaseGraphNode(self,disease_graph,id):
+		if not disease_graph.has_node(id):
+			if id not in self.snapshot.diseases_by_id:
+				self.api.abort(404, "Disease {} is not found in the database".format(id))
+			self.api.abort(404, "Disease {} has no comorbidities stored in the database".format(id))
 		
-		return res
+		return id
+	
+	def disease_comorbidities_neighbourhood(self,id,hops=1,min_rel_risk=None):
+		disease_graph = self.disease_graph
+		return disease_graph.neighbourhood(self._diseaseGraphNode(disease_graph,id),hops,min_rel_risk)
+	
+	def top_disease_comorbidities(self,k,id=None):
+		disease_graph = self.disease_graph
+		if id is not None:
+			self._diseaseGraphNode(disease_graph,id)
+		
+		return disease_graph.top_edges(k,id)
+	
+	def disease_comorbidities_subgraph(self,min_rel_risk,max_rel_risk=None):
+		if max_rel_risk is not None and max_rel_risk < min_rel_risk:
+			self.api.abort(400, "The maximum relative risk must not be lower than the minimum one")
+		
+		return self.disease_graph.subgraph(min_rel_risk,max_rel_risk)
+	
+	def disease_comorbidity_path(self,from_id,to_id):
+		disease_graph = self.disease_graph
+		self._diseaseGraphNode(disease_graph,from_id)
+		self._diseaseGraphNode(disease_graph,to_id)
+		res = disease_graph.shortest_path(from_id,to_id)
+		if res is None:
+			self.api.abort(404, "There is no comorbidity path from disease {} to disease {}".format(from_id,to_id))
+		
+		path, distance = res
+		return {
+			'from_id': from_id,
+			'to_id': to_id,
+			'distance': distance,
+			'comorbidities': path
+		}
+	
+	# Every id list is bound as a single JSON array parameter, so each query
+	# keeps one stable (and cacheable) SQL text whatever the list length,
+	# and SQLite variable limits are not hit on large selections
+	ID_LIST_SUBQUERY = 'SELECT value FROM json_each(:ids)'
 	
-	def diseases_patient_subgroups_comorbidities(self,disease_ids,min_subgroup_size=None):
+	@staticmethod
+	def _idListParam(ids):
+		return json.dumps(list(ids))
+	
+	# Equivalent to the patient_subgroup_size table, for databases built before it was introduced
+	PATIENT_SUBGROUP_SIZE_SUBQUERY = '''(
+SELECT ps.id AS patient_subgroup_id, ps.disease_id AS disease_id, COUNT(p.id) AS size
+FROM patient_subgroup ps, patient p
+WHERE ps.id = p.patient_subgroup_id
+GROUP BY ps.id, ps.disease_id
+)'''
+	
+	def _patientSubgroupSizeSource(self):
+		if 'patient_subgroup_size' in self.snapshot.tables:
+			return 'patient_subgroup_size'
+		
+		return self.PATIENT_SUBGROUP_SIZE_SUBQUERY
+	
+	def iter_diseases_patient_subgroups_comorbidities(self,disease_ids,min_subgroup_size=None,min_rr=None,max_rr=None,order=None,limit=None):
 		disease_ids_set = set(disease_ids)
 		if len(disease_ids_set) < 2:
 			self.api.abort(400, "You must provide at least two different disease ids")
 		
-		res = None
+		rr_conditions, rr_tail = self._relRiskClauses('psd.relative_risk',min_rr,max_rr,order,limit)
+		# When the comorbidities are thresholded, an empty answer is a valid one
+		thresholded = min_rr is not None or max_rr is not None
 		
 		cur = self._getCursor()
 		try:
-			subquery_all = '''
-SELECT ps.id AS id, COUNT(p.id) AS ps_size
-FROM patient_subgroup ps, patient p
-WHERE ps.disease_id IN ({})
-AND ps.id = p.patient_subgroup_id
-GROUP BY ps.id
-			'''
-			
-			subquery_min = '''
-SELECT ps.id AS id, COUNT(p.id) AS ps_size
-FROM patient_subgroup ps, patient p
-WHERE ps.disease_id IN ({})
-AND ps.id = p.patient_subgroup_id
-GROUP BY ps.id
-HAVING ps_size >= ?
-			'''
+			size_filter = '' if min_subgroup_size is None else 'AND {0}.size >= :min_size'
 			
 			query_template = '''
-SELECT psd.patient_subgroup_a_id,
-	CASE
-		WHEN psd.patient_subgroup_a_id = dps_i.id THEN
-		dps_i.ps_size
-		ELSE dps_j.ps_size
-	END,
-	psd.patient_subgroup_b_id,
-	CASE
-		WHEN psd.patient_subgroup_b_id = dps_i.id THEN
-		dps_i.ps_size
-		ELSE dps_j.ps_size
-	END,
-	psd.relative_risk
-FROM
-(
-{0}
-) AS dps_i,
-(
-{0}
-) AS dps_j,
-	patient_subgroup_digraph psd
-WHERE  dps_i.id <> dps_j.id
-AND psd.patient_subgroup_a_id = dps_i.id
-AND psd.patient_subgroup_b_id = dps_j.id
+SELECT psd.patient_subgroup_a_id, pss_a.size, psd.patient_subgroup_b_id, pss_b.size, psd.relative_risk
+FROM {0} AS pss_a, {0} AS pss_b, patient_subgroup_digraph psd
+WHERE pss_a.disease_id IN ({1})
+{2}
+AND pss_b.disease_id IN ({1})
+{3}
+AND pss_a.patient_subgroup_id <> pss_b.patient_subgroup_id
+AND psd.patient_subgroup_a_id = pss_a.patient_subgroup_id
+AND psd.patient_subgroup_b_id = pss_b.patient_subgroup_id{4}{5}
 			'''
 			
+			query = query_template.format(self._patientSubgroupSizeSource(),self.ID_LIST_SUBQUERY,size_filter.format('pss_a'),size_filter.format('pss_b'),rr_conditions,rr_tail)
 			
-			subquery_template = subquery_all if min_subgroup_size is None else subquery_min
-			subquery = subquery_template.format(','.join(['?']*len(disease_ids_set)))
-			query = query_template.format(subquery)
-			
-			query_param_list_base = list(disease_ids_set)
-			if min_subgroup_size is not None:
-				query_param_list_base.append(min_subgroup_size)
-			
-			query_param_list = []
-			# Yes, it must be done twice, due limitations in
-			# the positional parameters manageable by SQLite Python driver
-			query_param_list.extend(query_param_list_base)
-			query_param_list.extend(query_param_list_base)
+			# Named parameters can be used more than once
+			query_params = {
+				'ids': self._idListParam(disease_ids_set),
+				'min_size': min_subgroup_size,
+				'min_rr': min_rr,
+				'max_rr': max_rr,
+				'limit': limit
+			}
 			
-			cur.execute(query,tuple(query_param_list))
-			res = []
+			cur.execute(query,query_params)
+			empty = True
 			while True:
 				pat_sub_co = cur.fetchmany()
 				if len(pat_sub_co) == 0:
 					# Empty dictionary?
-					if not res:
+					if empty and not thresholded:
 						self.api.abort(404, "No one of the {} different diseases have patient subgroup comorbidities stored in the database".format(len(disease_ids_set)))
 					break
 				
-				res.extend(map(lambda co: {'from_id': co[0], 'from_size':co[1], 'to_id': co[2], 'to_size': co[3], 'rel_risk': co[4] },pat_sub_co))
+				empty = False
+				yield from map(lambda co: {'from_id': co[0], 'from_size':co[1], 'to_id': co[2], 'to_size': co[3], 'rel_risk': co[4] },pat_sub_co)
 		finally:
 			# Assuring the cursor is properly closed
 			cur.close()
-		
-		return res
 	
+	@cached_result('disease_ids')
+	def diseases_patient_subgroups_comorbidities(self,disease_ids,min_subgroup_size=None,min_rr=None,max_rr=None,order=None,limit=None):
+		return list(self.iter_diseases_patient_subgroups_comorbidities(disease_ids=disease_ids,min_subgroup_size=min_subgroup_size,min_rr=min_rr,max_rr=max_rr,order=order,limit=limit))
 	
-	def patients(self,patient_id=None,patient_subgroup_id=None):
-		res = []
+	def iter_patients(self,patient_id=None,patient_subgroup_id=None):
+		empty = True
 		cur = self._getCursor()
 		try:
 			if patient_subgroup_id is not None:
@@ -344,7 +611,7 @@ AND psd.patient_subgroup_b_id = dps_j.id
 			while True:
 				patients = cur.fetchmany()
 				if len(patients)==0:
-					if(len(res)==0):
+					if empty:
 						if patient_subgroup_id is not None:
 							self.api.abort(404, "Patient subgroup {} is not found in the database".format(patient_subgroup_id))
 						elif patient_id is not None:
@@ -353,60 +620,149 @@ AND psd.patient_subgroup_b_id = dps_j.id
 							self.api.abort(500,"Empty comorbidities database")
 					break
 				
-				res.extend(map(lambda patient: {'id': patient[0],'patient_subgroup_id': patient[1],'study_id': patient[2]},patients))
+				empty = False
+				yield from map(lambda patient: {'id': patient[0],'patient_subgroup_id': patient[1],'study_id': patient[2]},patients)
 		finally:
 			# Assuring the cursor is properly closed
 			cur.close()
-		
-		return res
+	
+	def patients(self,patient_id=None,patient_subgroup_id=None):
+		return list(self.iter_patients(patient_id=patient_id,patient_subgroup_id=patient_subgroup_id))
+	
+	def patients_page(self,limit,after=None):
+		return self._keysetPage('SELECT p.id,p.patient_subgroup_id,s.geo_arrayexpress_code FROM patient p, study s WHERE p.study_id = s.id AND {0}','p.id',lambda patient: {'id': patient[0],'patient_subgroup_id': patient[1],'study_id': patient[2]},limit,after)
 	
 	def patient(self,patient_id):
 		res = self.patients(patient_id=patient_id)
 		return res[0]
 	
-	def patient_subgroups(self,patient_subgroup_id=None):
-		res = []
+	def iter_patient_subgroups(self,patient_subgroup_id=None):
+		empty = True
 		cur = self._getCursor()
 		try:
+			query_template = '''
+SELECT ps.id, ps.name, ps.disease_id, pss.size
+FROM patient_subgroup ps, {0} AS pss
+WHERE ps.id = pss.patient_subgroup_id
+{1}
+ORDER BY 1
+			'''
 			if patient_subgroup_id is not None:
-				query = '''
-SELECT ps.id AS id, ps.name AS name, ps.disease_id AS id, COUNT(p.id) AS size
-FROM patient_subgroup ps, patient p
-WHERE ps.id = ?
-AND ps.id = p.patient_subgroup_id
-GROUP BY ps.id,ps.name,ps.disease_id
-				'''
+				query = query_template.format(self._patientSubgroupSizeSource(),'AND ps.id = ?')
 				cur.execute(query,(patient_subgroup_id,))
 			else:
-				query = '''
-SELECT ps.id AS id, ps.name AS name, ps.disease_id AS id, COUNT(p.id) AS size
-FROM patient_subgroup ps, patient p
-WHERE ps.id = p.patient_subgroup_id
-GROUP BY ps.id,ps.name,ps.disease_id
-				'''
+				query = query_template.format(self._patientSubgroupSizeSource(),'')
 				cur.execute(query)
 			while True:
 				patient_subgroups = cur.fetchmany()
 				if len(patient_subgroups)==0:
-					if(len(res)==0):
+					if empty:
 						if patient_subgroup_id is not None:
 							self.api.abort(404, "Patient subgroup {} is not found in the database".format(patient_subgroup_id))
 						else:
 							self.api.abort(500,"Empty comorbidities database")
 					break
 				
-				res.extend(map(lambda ps: {'id': ps[0],'name': ps[1],'disease_id': ps[2], 'size': ps[3]},patient_subgroups))
+				empty = False
+				yield from map(lambda ps: {'id': ps[0],'name': ps[1],'disease_id': ps[2], 'size': ps[3]},patient_subgroups)
 		finally:
 			# Assuring the cursor is properly closed
 			cur.close()
+	
+	def patient_subgroups(self,patient_subgroup_id=None):
+		return list(self.iter_patient_subgroups(patient_subgroup_id=patient_subgroup_id))
+	
+	def patient_subgroups_page(self,limit,after=None):
+		query_template = '''
+SELECT ps.id, ps.name, ps.disease_id, pss.size
+FROM patient_subgroup ps, {0} AS pss
+WHERE ps.id = pss.patient_subgroup_id
+AND {{0}}'''.format(self._patientSubgroupSizeSource())
 		
-		return res
+		return self._keysetPage(query_template,'ps.id',lambda ps: {'id': ps[0],'name': ps[1],'disease_id': ps[2], 'size': ps[3]},limit,after)
 	
 	def patient_subgroup(self,patient_subgroup_id):
 		res = self.patient_subgroups(patient_subgroup_id=patient_subgroup_id)
 		return res[0]
 	
-	def patient_subgroup_intersect_genes(self,patient_subgroup_ids=None,disease_ids=None):
+	# Grouped queries return rows sorted by (group id, item key), whose
+	# columns are named after the keys of the returned objects
+	def _iterGrouped(self,query,query_params,not_found_message,group_key,list_key,item_keys):
+		item_a, item_b = item_keys
+		cur = self._getCursor()
+		try:
+			cur.execute(query,query_params)
+			grouping_id = None
+			grouping_list = None
+			while True:
+				rows = cur.fetchmany()
+				if len(rows) == 0:
+					# Empty dictionary?
+					if grouping_id is None:
+						self.api.abort(404, not_found_message)
+					break
+				
+				for row in rows:
+					if grouping_id != row[0]:
+						if grouping_id is not None:
+							yield {
+								group_key: grouping_id,
+								list_key: grouping_list
+							}
+						grouping_id = row[0]
+						grouping_list = []
+					grouping_list.append({item_a: row[1],item_b: row[2]})
+			
+			# The last group
+			if grouping_id is not None:
+				yield {
+					group_key: grouping_id,
+					list_key: grouping_list
+				}
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+	
+	# Aggregates accept their own ORDER BY since SQLite 3.44. Before it, the
+	# order of the aggregated rows is not guaranteed, so the grouping is done
+	# in Python
+	AGGREGATE_ORDER_BY = sqlite3.sqlite_version_info >= (3,44,0)
+	
+	def _groupedJSON(self,query,query_params,not_found_message,group_key,list_key,item_keys):
+		'''It returns the same documents as _iterGrouped, but built by SQLite
+		as a single serialized JSON array. It needs AGGREGATE_ORDER_BY'''
+		item_order = ' ORDER BY {}'.format(item_keys[0])
+		group_order = ' ORDER BY {}'.format(group_key)
+		json_query = '''
+SELECT CAST(json_group_array(json(grouped){4}) AS BLOB)
+FROM (
+	SELECT {0}, json_object('{0}', {0}, '{1}', json_group_array(json_object({2}){3})) AS grouped
+	FROM ({5})
+	GROUP BY {0}
+	ORDER BY {0}
+)
+'''.format(group_key,list_key,', '.join(map(lambda key: "'{0}', {0}".format(key),item_keys)),item_order,group_order,query)
+		
+		cur = self._getCursor()
+		try:
+			cur.execute(json_query,query_params)
+			res = cur.fetchone()[0]
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+		
+		if res == b'[]':
+			self.api.abort(404, not_found_message)
+		
+		return res
+	
+	def _groupedResult(self,query,query_params,not_found_message,group_key,list_key,item_keys):
+		if self.sql_json_grouping and self.AGGREGATE_ORDER_BY:
+			return self._groupedJSON(query,query_params,not_found_message,group_key,list_key,item_keys)
+		
+		return list(self._iterGrouped(query,query_params,not_found_message,group_key,list_key,item_keys))
+	
+	def _patientSubgroupIntersectGenesQuery(self,patient_subgroup_ids,disease_ids):
 		if patient_subgroup_ids is not None and disease_ids is not None:
 			self.api.abort(400, "You must provide either a list of patient subgroups or a list of diseases, not both")
 		
@@ -415,6 +771,7 @@ GROUP BY ps.id,ps.name,ps.disease_id
 				self.api.abort(400, "You must provide at least a patient subgroup")
 			
 			query_ids_set = set(patient_subgroup_ids)
+			not_found_message = "No one of the {} different patient subgroups have common behavioring drugs to all their patients stored in the database".format(len(query_ids_set))
 			
 			query_template = '''
 SELECT pig.patient_subgroup_id, g.gene_symbol, pig.regulation_sign
@@ -429,7 +786,8 @@ ORDER BY 1,2
 			if len(disease_ids) == 0:
 				self.api.abort(400, "You must provide at lease a disease")
 			
-			query_id_set = set(disease_ids)
+			query_ids_set = set(disease_ids)
+			not_found_message = "No one of the patient subgroups related to the {} different diseases have common behavioring drugs to all their patients stored in the database".format(len(query_ids_set))
 			
 			query_template = '''
 SELECT pig.patient_subgroup_id, g.gene_symbol, pig.regulation_sign
@@ -445,46 +803,18 @@ ORDER BY 1,2
 		else:
 			self.api.abort(400, "You must provide at least a list of patient subgroups or a list of diseases")
 		
-		res = None
-		
-		cur = self._getCursor()
-		try:
-			query = query_template.format(','.join(['?']*len(query_id_set)))
-			
-			query_param_list = list(query_id_set)
-			
-			cur.execute(query,tuple(query_param_list))
-			res = []
-			grouping_id = None
-			grouping_list = None
-			while True:
-				pat_sub_gen = cur.fetchmany()
-				if len(pat_sub_gen) == 0:
-					# Empty dictionary?
-					if not res:
-						if patient_subgroup_ids is not None:
-							self.api.abort(404, "No one of the {} different patient subgroups have common behavioring drugs to all their patients stored in the database".format(len(query_param_list)))
-						elif disease_ids is not None:
-							self.api.abort(404, "No one of the patient subgroups related to the {} different diseases have common behavioring drugs to all their patients stored in the database".format(len(query_param_list)))
-					break
-				
-				for inter in pat_sub_gen:
-					if grouping_id != inter[0]:
-						grouping_id = inter[0]
-						grouping_list = []
-						res.append({
-							'patient_subgroup_id': grouping_id,
-							'genes': grouping_list
-						})
-					grouping_list.append({'gene_symbol': inter[1],'regulation_sign': inter[2]})
-		finally:
-			# Assuring the cursor is properly closed
-			cur.close()
-		
-		return res
-
+		return query_template.format(self.ID_LIST_SUBQUERY), {'ids': self._idListParam(query_ids_set)}, not_found_message
 	
-	def patient_subgroup_intersect_drugs(self,patient_subgroup_ids=None,disease_ids=None):
+	def iter_patient_subgroup_intersect_genes(self,patient_subgroup_ids=None,disease_ids=None):
+		query, query_params, not_found_message = self._patientSubgroupIntersectGenesQuery(patient_subgroup_ids,disease_ids)
+		return self._iterGrouped(query,query_params,not_found_message,'patient_subgroup_id','genes',('gene_symbol','regulation_sign'))
+	
+	@cached_result('patient_subgroup_ids','disease_ids')
+	def patient_subgroup_intersect_genes(self,patient_subgroup_ids=None,disease_ids=None):
+		query, query_params, not_found_message = self._patientSubgroupIntersectGenesQuery(patient_subgroup_ids,disease_ids)
+		return self._groupedResult(query,query_params,not_found_message,'patient_subgroup_id','genes',('gene_symbol','regulation_sign'))
+	
+	def _patientSubgroupIntersectDrugsQuery(self,patient_subgroup_ids,disease_ids):
 		if patient_subgroup_ids is not None and disease_ids is not None:
 			self.api.abort(400, "You must provide either a list of patient subgroups or a list of diseases, not both")
 		
@@ -493,6 +823,7 @@ ORDER BY 1,2
 				self.api.abort(400, "You must provide at least a patient subgroup")
 			
 			query_ids_set = set(patient_subgroup_ids)
+			not_found_message = "No one of the {} different patient subgroups have common behavioring drugs to all their patients stored in the database".format(len(query_ids_set))
 			
 			query_template = '''
 SELECT patient_subgroup_id, drug_id, regulation_sign
@@ -505,7 +836,8 @@ ORDER BY 1,2
 			if len(disease_ids) == 0:
 				self.api.abort(400, "You must provide at lease a disease")
 			
-			query_id_set = set(disease_ids)
+			query_ids_set = set(disease_ids)
+			not_found_message = "No one of the patient subgroups related to the {} different diseases have common behavioring drugs to all their patients stored in the database".format(len(query_ids_set))
 			
 			query_template = '''
 SELECT psdi.patient_subgroup_id, psdi.drug_id, psdi.regulation_sign
@@ -519,46 +851,18 @@ ORDER BY 1,2
 		else:
 			self.api.abort(400, "You must provide at least a list of patient subgroups or a list of diseases")
 		
-		res = None
-		
-		cur = self._getCursor()
-		try:
-			query = query_template.format(','.join(['?']*len(query_id_set)))
-			
-			query_param_list = list(query_id_set)
-			
-			cur.execute(query,tuple(query_param_list))
-			res = []
-			grouping_id = None
-			grouping_list = None
-			while True:
-				pat_sub_drug = cur.fetchmany()
-				if len(pat_sub_drug) == 0:
-					# Empty dictionary?
-					if not res:
-						if patient_subgroup_ids is not None:
-							self.api.abort(404, "No one of the {} different patient subgroups have common behavioring drugs to all their patients stored in the database".format(len(query_param_list)))
-						elif disease_ids is not None:
-							self.api.abort(404, "No one of the patient subgroups related to the {} different diseases have common behavioring drugs to all their patients stored in the database".format(len(query_param_list)))
-					break
-				
-				for inter in pat_sub_drug:
-					if grouping_id != inter[0]:
-						grouping_id = inter[0]
-						grouping_list = []
-						res.append({
-							'patient_subgroup_id': grouping_id,
-							'drugs': grouping_list
-						})
-					grouping_list.append({'drug_id': inter[1],'regulation_sign': inter[2]})
-		finally:
-			# Assuring the cursor is properly closed
-			cur.close()
-		
-		return res
-
+		return query_template.format(self.ID_LIST_SUBQUERY), {'ids': self._idListParam(query_ids_set)}, not_found_message
 	
-	def patient_map_genes(self,patient_subgroup_ids=None,patient_ids=None):
+	def iter_patient_subgroup_intersect_drugs(self,patient_subgroup_ids=None,disease_ids=None):
+		query, query_params, not_found_message = self._patientSubgroupIntersectDrugsQuery(patient_subgroup_ids,disease_ids)
+		return self._iterGrouped(query,query_params,not_found_message,'patient_subgroup_id','drugs',('drug_id','regulation_sign'))
+	
+	@cached_result('patient_subgroup_ids','disease_ids')
+	def patient_subgroup_intersect_drugs(self,patient_subgroup_ids=None,disease_ids=None):
+		query, query_params, not_found_message = self._patientSubgroupIntersectDrugsQuery(patient_subgroup_ids,disease_ids)
+		return self._groupedResult(query,query_params,not_found_message,'patient_subgroup_id','drugs',('drug_id','regulation_sign'))
+	
+	def _patientMapGenesQuery(self,patient_subgroup_ids,patient_ids):
 		if patient_subgroup_ids is not None and patient_ids is not None:
 			self.api.abort(400, "You must provide either a list of patient subgroups or a list of patients, not both")
 		
@@ -566,6 +870,7 @@ ORDER BY 1,2
 			if len(patient_subgroup_ids) == 0:
 				self.api.abort(400, "You must provide at least a patient subgroup")
 			query_ids_set = set(patient_subgroup_ids)
+			not_found_message = "No patient from the {} different patient subgroups has common behavioring genes on their analyses".format(len(query_ids_set))
 			query_template = '''
 SELECT pgm.patient_id, g.gene_symbol, pgm.regulation_sign
 FROM patient p, patient_gene_maps pgm, gene g
@@ -581,6 +886,7 @@ ORDER BY 1,2
 			if len(patient_ids) == 0:
 				self.api.abort(400, "You must provide at least a patient")
 			query_ids_set = set(patient_ids)
+			not_found_message = "No one of the {} different patients has common behavioring genes on their analyses".format(len(query_ids_set))
 			query_template = '''
 SELECT pgm.patient_id, g.gene_symbol, pgm.regulation_sign
 FROM patient_gene_maps pgm, gene g
@@ -593,46 +899,18 @@ ORDER BY 1,2
 		else:
 			self.api.abort(400, "You must provide at least a list of patient subgroups or a list of patients")
 		
-		res = None
-		
-		cur = self._getCursor()
-		try:
-			query = query_template.format(','.join(['?']*len(query_ids_set)))
-			
-			query_param_list = list(query_ids_set)
-			
-			cur.execute(query,tuple(query_param_list))
-			res = []
-			grouping_id = None
-			grouping_list = None
-			while True:
-				pat_gen = cur.fetchmany()
-				if len(pat_gen) == 0:
-					# Empty dictionary?
-					if not res:
-						if patient_ids is not None:
-							self.api.abort(404, "No one of the {} different patients has common behavioring genes on their analyses".format(len(query_param_list)))
-						elif patient_subgroup_ids is not None:
-							self.api.abort(404, "No patient from the {} different patient subgroups has common behavioring genes on their analyses".format(len(query_param_list)))
-					break
-				
-				for inter in pat_gen:
-					if grouping_id != inter[0]:
-						grouping_id = inter[0]
-						grouping_list = []
-						res.append({
-							'patient_id': grouping_id,
-							'genes': grouping_list
-						})
-					grouping_list.append({'gene_symbol': inter[1],'regulation_sign': inter[2]})
-		finally:
-			# Assuring the cursor is properly closed
-			cur.close()
-		
-		return res
-
+		return query_template.format(self.ID_LIST_SUBQUERY), {'ids': self._idListParam(query_ids_set)}, not_found_message
 	
-	def patient_map_drugs(self,patient_subgroup_ids=None,patient_ids=None):
+	def iter_patient_map_genes(self,patient_subgroup_ids=None,patient_ids=None):
+		query, query_params, not_found_message = self._patientMapGenesQuery(patient_subgroup_ids,patient_ids)
+		return self._iterGrouped(query,query_params,not_found_message,'patient_id','genes',('gene_symbol','regulation_sign'))
+	
+	@cached_result('patient_subgroup_ids','patient_ids')
+	def patient_map_genes(self,patient_subgroup_ids=None,patient_ids=None):
+		query, query_params, not_found_message = self._patientMapGenesQuery(patient_subgroup_ids,patient_ids)
+		return self._groupedResult(query,query_params,not_found_message,'patient_id','genes',('gene_symbol','regulation_sign'))
+	
+	def _patientMapDrugsQuery(self,patient_subgroup_ids,patient_ids):
 		if patient_subgroup_ids is not None and patient_ids is not None:
 			self.api.abort(400, "You must provide either a list of patient subgroups or a list of patients, not both")
 		
@@ -640,6 +918,7 @@ ORDER BY 1,2
 			if len(patient_subgroup_ids) == 0:
 				self.api.abort(400, "You must provide at least a patient subgroup")
 			query_ids_set = set(patient_subgroup_ids)
+			not_found_message = "No patient from the {} different patient subgroups has common behavioring drugs on their analyses".format(len(query_ids_set))
 			query_template = '''
 SELECT pdm.patient_id, pdm.drug_id, pdm.regulation_sign
 FROM patient p, patient_drug_maps pdm
@@ -653,6 +932,7 @@ ORDER BY 1,2
 			if len(patient_ids) == 0:
 				self.api.abort(400, "You must provide at least a patient")
 			query_ids_set = set(patient_ids)
+			not_found_message = "No one of the {} different patients has common behavioring drugs on their analyses".format(len(query_ids_set))
 			query_template = '''
 SELECT patient_id, drug_id, regulation_sign
 FROM patient_drug_maps
@@ -663,46 +943,18 @@ ORDER BY 1,2
 		else:
 			self.api.abort(400, "You must provide at least a list of patient subgroups or a list of patients")
 		
-		res = None
-		
-		cur = self._getCursor()
-		try:
-			query = query_template.format(','.join(['?']*len(query_ids_set)))
-			
-			query_param_list = list(query_ids_set)
-			
-			cur.execute(query,tuple(query_param_list))
-			res = []
-			grouping_id = None
-			grouping_list = None
-			while True:
-				pat_drug = cur.fetchmany()
-				if len(pat_drug) == 0:
-					# Empty dictionary?
-					if not res:
-						if patient_ids is not None:
-							self.api.abort(404, "No one of the {} different patients has common behavioring drugs on their analyses".format(len(query_param_list)))
-						elif patient_subgroup_ids is not None:
-							self.api.abort(404, "No patient from the {} different patient subgroups has common behavioring drugs on their analyses".format(len(query_param_list)))
-					break
-				
-				for inter in pat_drug:
-					if grouping_id != inter[0]:
-						grouping_id = inter[0]
-						grouping_list = []
-						res.append({
-							'patient_id': grouping_id,
-							'drugs': grouping_list
-						})
-					grouping_list.append({'drug_id': inter[1],'regulation_sign': inter[2]})
-		finally:
-			# Assuring the cursor is properly closed
-			cur.close()
-		
-		return res
-
+		return query_template.format(self.ID_LIST_SUBQUERY), {'ids': self._idListParam(query_ids_set)}, not_found_message
 	
-	def patients_interactions(self,patient_subgroup_ids=None,patient_ids=None):
+	def iter_patient_map_drugs(self,patient_subgroup_ids=None,patient_ids=None):
+		query, query_params, not_found_message = self._patientMapDrugsQuery(patient_subgroup_ids,patient_ids)
+		return self._iterGrouped(query,query_params,not_found_message,'patient_id','drugs',('drug_id','regulation_sign'))
+	
+	@cached_result('patient_subgroup_ids','patient_ids')
+	def patient_map_drugs(self,patient_subgroup_ids=None,patient_ids=None):
+		query, query_params, not_found_message = self._patientMapDrugsQuery(patient_subgroup_ids,patient_ids)
+		return self._groupedResult(query,query_params,not_found_message,'patient_id','drugs',('drug_id','regulation_sign'))
+	
+	def iter_patients_interactions(self,patient_subgroup_ids=None,patient_ids=None):
 		if patient_subgroup_ids is not None and patient_ids is not None:
 			self.api.abort(400, "You must provide either a list of patient subgroups or a list of patients, not both")
 		
@@ -737,36 +989,279 @@ AND
 		else:
 			self.api.abort(400, "You must provide at least a list of patient subgroups or a list of patients")
 		
-		res = None
+		patient_graph = self.patient_graph
+		if patient_graph is not None:
+			yield from self._iterPatientsInteractionsInMemory(patient_graph,patient_subgroup_ids,patient_ids)
+			return
 		
 		cur = self._getCursor()
 		try:
-			placeholders = ','.join(['?']*len(query_ids_set))
-			query = query_template.format(placeholders)
-			
-			in_query_param_list = list(query_ids_set)
-			query_param_list = []
+			query = query_template.format(self.ID_LIST_SUBQUERY)
 			
-			# It must be done twice, as it is repeated
-			query_param_list.extend(in_query_param_list)
-			query_param_list.extend(in_query_param_list)
+			# The same named parameter is used twice
+			query_params = {'ids': self._idListParam(query_ids_set)}
 			
-			cur.execute(query,tuple(query_param_list))
-			res = []
+			cur.execute(query,query_params)
+			empty = True
 			while True:
 				pat_int = cur.fetchmany()
 				if len(pat_int) == 0:
 					# Empty dictionary?
-					if not res:
+					if empty:
 						if patient_ids is not None:
-							self.api.abort(404, "No interactions among the {} different patients, based on their analyses".format(len(in_query_param_list)))
+							self.api.abort(404, "No interactions among the {} different patients, based on their analyses".format(len(query_ids_set)))
 						elif patient_subgroup_ids is not None:
-							self.api.abort(404, "No interactions among the patients from the {} different patient subgroups, based on their analyses".format(len(in_query_param_list)))
+							self.api.abort(404, "No interactions among the patients from the {} different patient subgroups, based on their analyses".format(len(query_ids_set)))
 					break
 				
-				res.extend(map(lambda pi: {'patient_i_id': pi[0],'patient_j_id': pi[1],'interaction_sign': pi[2]},pat_int))
+				empty = False
+				yield from map(lambda pi: {'patient_i_id': pi[0],'patient_j_id': pi[1],'interaction_sign': pi[2]},pat_int)
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+	
+	@cached_result('patient_subgroup_ids','patient_ids')
+	def patients_interactions(self,patient_subgroup_ids=None,patient_ids=None):
+		return list(self.iter_patients_interactions(patient_subgroup_ids=patient_subgroup_ids,patient_ids=patient_ids))
+	
+	def _iterPatientsInteractionsInMemory(self,patient_graph,patient_subgroup_ids=None,patient_ids=None):
+		if patient_subgroup_ids is not None:
+			query_patient_ids = patient_graph.patients_from_subgroups(set(patient_subgroup_ids))
+		else:
+			query_patient_ids = set(patient_ids)
+		
+		a_ids, b_ids, signs = patient_graph.induced_subgraph(query_patient_ids)
+		if len(a_ids) == 0:
+			if patient_ids is not None:
+				self.api.abort(404, "No interactions among the {} different patients, based on their analyses".format(len(set(patient_ids))))
+			elif patient_subgroup_ids is not None:
+				self.api.abort(404, "No interactions among the patients from the {} different patient subgroups, based on their analyses".format(len(set(patient_subgroup_ids))))
+		
+		yield from map(lambda pi: {'patient_i_id': pi[0],'patient_j_id': pi[1],'interaction_sign': pi[2]},zip(a_ids.tolist(),b_ids.tolist(),signs.tolist()))
+	
+	# Tables holding the (entity, item, regulation sign) rows of each kind of entity set
+	ENTITY_SET_TABLES = {
+		'patient_subgroup_drugs': ('patient_subgroup_drug_intersect','patient_subgroup_id','drug_id'),
+		'patient_subgroup_genes': ('patient_subgroup_gene_intersect','patient_subgroup_id','gene_id'),
+		'patient_drugs': ('patient_drug_maps','patient_id','drug_id'),
+		'patient_genes': ('patient_gene_maps','patient_id','gene_id'),
+	}
+	
+	def entity_sets(self,name):
+		'''The in-memory entity sets of the given kind, when the engine is enabled'''
+		if not self.entity_sets_engine:
+			return None
+		
+		generation = self.generation
+		entity_sets = generation.entity_sets.get(name)
+		if entity_sets is None:
+			with generation.lock:
+				entity_sets = generation.entity_sets.get(name)
+				if entity_sets is None:
+					table, entity_column, item_column = self.ENTITY_SET_TABLES[name]
+					if generation.shared is not None:
+						entity_sets = EntitySets.from_shared(generation.shared,name,self.ENTITY_SET_TABLES[name])
+					if entity_sets is None:
+						entity_sets = EntitySets(self.db,'SELECT {1}, {2}, regulation_sign FROM {0}'.format(table,entity_column,item_column))
+					generation.entity_sets[name] = entity_sets
+		
+		return entity_sets
+	
+	def _setAlgebra(self,name,entity_ids,operation,not_found_message):
+		'''It returns the (item id, regulation sign) pairs, sorted by item id, from the
+		intersection, union or difference (the first entity minus the other ones)
+		of the sets of the entities'''
+		if operation not in SET_OPERATIONS:
+			self.api.abort(400, "Unknown set operation {}. It must be one of {}".format(operation,', '.join(SET_OPERATIONS)))
+		
+		if len(entity_ids) == 0:
+			self.api.abort(400, "You must provide at least an id")
+		
+		# The order matters for the difference
+		entity_ids = list(dict.fromkeys(entity_ids))
+		
+		entity_sets = self.entity_sets(name)
+		if entity_sets is not None:
+			if not entity_sets.has_elements(entity_ids):
+				self.api.abort(404, not_found_message)
+			
+			item_ids, signs = EntitySets.decode(getattr(entity_sets,operation)(entity_ids))
+			return list(zip(item_ids.tolist(),signs.tolist()))
+		
+		table, entity_column, item_column = self.ENTITY_SET_TABLES[name]
+		query_params = {'ids': self._idListParam(entity_ids),'num_ids': len(entity_ids)}
+		if operation == 'intersection':
+			query_template = 'SELECT {2}, regulation_sign FROM {0} WHERE {1} IN ({3}) GROUP BY 1, 2 HAVING COUNT(DISTINCT {1}) = :num_ids ORDER BY 1, 2'
+		elif operation == 'union':
+			query_template = 'SELECT DISTINCT {2}, regulation_sign FROM {0} WHERE {1} IN ({3}) ORDER BY 1, 2'
+		else:
+			query_template = 'SELECT {2}, regulation_sign FROM {0} WHERE {1} = :first_id EXCEPT SELECT {2}, regulation_sign FROM {0} WHERE {1} IN ({3}) ORDER BY 1, 2'
+			query_params['first_id'] = entity_ids[0]
+			query_params['ids'] = self._idListParam(entity_ids[1:])
+		
+		cur = self._getCursor()
+		try:
+			cur.execute('SELECT EXISTS (SELECT 1 FROM {0} WHERE {1} IN ({2}))'.format(table,entity_column,self.ID_LIST_SUBQUERY),{'ids': self._idListParam(entity_ids)})
+			if not cur.fetchone()[0]:
+				self.api.abort(404, not_found_message)
+			
+			cur.execute(query_template.format(table,entity_column,item_column,self.ID_LIST_SUBQUERY),query_params)
+			return cur.fetchall()
 		finally:
 			# Assuring the cursor is properly closed
 			cur.close()
+	
+	def _drugSet(self,name,entity_ids,operation,not_found_message):
+		return list(map(lambda ds: {'drug_id': ds[0],'regulation_sign': ds[1]},self._setAlgebra(name,entity_ids,operation,not_found_message)))
+	
+	def _geneSet(self,name,entity_ids,operation,not_found_message):
+		gene_set = self._setAlgebra(name,entity_ids,operation,not_found_message)
 		
+		cur = self._getCursor()
+		try:
+			cur.execute('SELECT id, gene_symbol FROM gene WHERE id IN ({})'.format(self.ID_LIST_SUBQUERY),{'ids': self._idListParam(set(map(lambda gs: gs[0],gene_set)))})
+			gene_symbols = dict(cur.fetchall())
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+		
+		res = list(map(lambda gs: {'gene_symbol': gene_symbols.get(gs[0]),'regulation_sign': gs[1]},gene_set))
+		# Sorted by symbol, as the other gene lists (NULL symbols first, like SQLite does)
+		res.sort(key=lambda gene: (gene['gene_symbol'] is not None,gene['gene_symbol'] or '',gene['regulation_sign']))
 		return res
+	
+	def patient_subgroups_drug_set(self,patient_subgroup_ids,operation):
+		return self._drugSet('patient_subgroup_drugs',patient_subgroup_ids,operation,"No one of the {} different patient subgroups have common behavioring drugs to all their patients stored in the database".format(len(set(patient_subgroup_ids))))
+	
+	def patient_subgroups_gene_set(self,patient_subgroup_ids,operation):
+		return self._geneSet('patient_subgroup_genes',patient_subgroup_ids,operation,"No one of the {} different patient subgroups have common behavioring genes to all their patients stored in the database".format(len(set(patient_subgroup_ids))))
+	
+	def patients_drug_set(self,patient_ids,operation):
+		return self._drugSet('patient_drugs',patient_ids,operation,"No one of the {} different patients has common behavioring drugs on their analyses".format(len(set(patient_ids))))
+	
+	def patients_gene_set(self,patient_ids,operation):
+		return self._geneSet('patient_genes',patient_ids,operation,"No one of the {} different patients has common behavioring genes on their analyses".format(len(set(patient_ids))))
+	
+	# The relations whose items are compared by the similarity queries
+	SIMILARITY_RELATIONS = {
+		'patient_subgroup': {
+			'genes': ('patient_subgroup_genes',),
+			'drugs': ('patient_subgroup_drugs',),
+			'all': ('patient_subgroup_genes','patient_subgroup_drugs'),
+		},
+		'patient': {
+			'genes': ('patient_genes',),
+			'drugs': ('patient_drugs',),
+			'all': ('patient_genes','patient_drugs'),
+		},
+	}
+	
+	def _similar(self,kind,entity_id,k,metric,based_on,not_found_message):
+		'''It returns the (entity id, similarity, number of shared items) of the
+		k entities most similar to the input one, from the most similar'''
+		if metric not in SIMILARITY_METRICS:
+			self.api.abort(400, "Unknown similarity metric {}. It must be one of {}".format(metric,', '.join(SIMILARITY_METRICS)))
+		
+		names = self.SIMILARITY_RELATIONS[kind].get(based_on)
+		if names is None:
+			self.api.abort(400, "Unknown items {}. They must be one of {}".format(based_on,', '.join(self.SIMILARITY_RELATIONS[kind].keys())))
+		
+		if self.entity_sets_engine:
+			return self._similarInMemory(kind,names,entity_id,k,metric,not_found_message)
+		
+		# Shared items and set sizes are gathered through SQL
+		same = {}
+		opposite = {}
+		sizes = {}
+		cur = self._getCursor()
+		try:
+			for name in names:
+				table, entity_column, item_column = self.ENTITY_SET_TABLES[name]
+				cur.execute('''
+SELECT f.{1},
+	COUNT(DISTINCT CASE WHEN f.regulation_sign = e.regulation_sign THEN f.{2} * 2 + (f.regulation_sign > 0) END),
+	COUNT(DISTINCT CASE WHEN f.regulation_sign != e.regulation_sign THEN f.{2} * 2 + (f.regulation_sign > 0) END)
+FROM {0} e, {0} f
+WHERE
+	e.{1} = :entity_id
+AND
+	f.{2} = e.{2}
+AND
+	f.{1} != :entity_id
+GROUP BY f.{1}
+'''.format(table,entity_column,item_column),{'entity_id': entity_id})
+				for other_id, num_same, num_opposite in cur.fetchall():
+					same[other_id] = same.get(other_id,0) + num_same
+					opposite[other_id] = opposite.get(other_id,0) + num_opposite
+			
+			# The sizes are gathered once all the candidates are known
+			for name in names:
+				table, entity_column, item_column = self.ENTITY_SET_TABLES[name]
+				# Repeated rows are counted once, as in the in-memory engine
+				cur.execute('SELECT {1}, COUNT(*) FROM (SELECT DISTINCT {1}, {2}, regulation_sign FROM {0} WHERE {1} IN ({3})) GROUP BY 1'.format(table,entity_column,item_column,self.ID_LIST_SUBQUERY),{'ids': self._idListParam([entity_id] + list(same.keys()))})
+				for other_id, size in cur.fetchall():
+					sizes[other_id] = sizes.get(other_id,0) + size
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+		
+		query_size = sizes.get(entity_id,0)
+		if query_size == 0:
+			return self._similarToNone(kind,entity_id,not_found_message)
+		
+		scored = map(lambda other_id: (other_id, similarity(metric,same[other_id],opposite[other_id],sizes[other_id],query_size), same[other_id]),same.keys())
+		return sorted(scored,key=lambda sim: (-sim[1],sim[0]))[0:k]
+	
+	def _similarToNone(self,kind,entity_id,not_found_message):
+		'''An entity without items is similar to no one, but an unknown one is not found'''
+		cur = self._getCursor()
+		try:
+			cur.execute('SELECT 1 FROM {} WHERE id = :entity_id'.format(kind),{'entity_id': entity_id})
+			found = cur.fetchone() is not None
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+		
+		if not found:
+			self.api.abort(404, not_found_message)
+		
+		return []
+	
+	def _similarInMemory(self,kind,names,entity_id,k,metric,not_found_message):
+		all_entity_sets = list(map(self.entity_sets,names))
+		num_entities = max(map(lambda entity_sets: entity_sets.num_entities,all_entity_sets))
+		# Ids beyond the sets are not sized from, as they have no items
+		if entity_id < 0 or entity_id >= num_entities:
+			return self._similarToNone(kind,entity_id,not_found_message)
+		
+		same = numpy.zeros(num_entities,dtype=numpy.int64)
+		opposite = numpy.zeros(num_entities,dtype=numpy.int64)
+		sizes = numpy.zeros(num_entities,dtype=numpy.int64)
+		for entity_sets in all_entity_sets:
+			entity_same, entity_opposite = entity_sets.overlaps(entity_id)
+			same[0:entity_sets.num_entities] += entity_same
+			opposite[0:entity_sets.num_entities] += entity_opposite
+			sizes[0:entity_sets.num_entities] += entity_sets.sizes
+		
+		query_size = int(sizes[entity_id])
+		if query_size == 0:
+			return self._similarToNone(kind,entity_id,not_found_message)
+		
+		# Only the entities sharing items are candidates
+		same[entity_id] = 0
+		opposite[entity_id] = 0
+		candidates = numpy.nonzero((same + opposite) > 0)[0]
+		similarities = similarity(metric,same[candidates],opposite[candidates],sizes[candidates],query_size)
+		top = numpy.lexsort((candidates,-similarities))[0:k]
+		
+		return list(zip(candidates[top].tolist(),similarities[top].tolist(),same[candidates[top]].tolist()))
+	
+	@cached_result()
+	def similar_patient_subgroups(self,patient_subgroup_id,k=10,metric='jaccard',based_on='all'):
+		similar = self._similar('patient_subgroup',patient_subgroup_id,k,metric,based_on,"Patient subgroup {} is not found in the database".format(patient_subgroup_id))
+		return list(map(lambda sim: {'patient_subgroup_id': sim[0],'similarity': sim[1],'shared': sim[2]},similar))
+	
+	@cached_result()
+	def similar_patients(self,patient_id,k=10,metric='jaccard',based_on='all'):
+		similar = self._similar('patient',patient_id,k,metric,based_on,"Patient {} is not found in the database".format(patient_id))
+		return list(map(lambda sim: {'patient_id': sim[0],'similarity': sim[1],'shared': sim[2]},similar))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+import bisect
+import heapq
+import itertools
+from types import MappingProxyType
+
+# This class holds an immutable, in-memory adjacency structure of the
+# disease comorbidity network, loaded once per database version. Every
+# adjacency tuple is sorted by decreasing relative risk, and it holds
+# the positions of the edges. The edge dictionaries are shared among
+# requests, so they must not be modified
+class DiseaseGraph(object):
+	def __init__(self,db,query,formatter,itersize=1000):
+		'''The query returns the edges (with the disease A and B ids
+		as their first columns, and the relative risk as the third one),
+		which are transformed to dictionaries by formatter'''
+		cur = db.cursor()
+		cur.arraysize = itersize
+		try:
+			cur.execute(query)
+			rows = cur.fetchall()
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+		
+		self.edges = tuple(map(formatter,rows))
+		self.sources = tuple(map(lambda row: row[0],rows))
+		self.targets = tuple(map(lambda row: row[1],rows))
+		self.rel_risks = tuple(map(lambda row: row[2]  if row[2] is not None  else float('-inf'),rows))
+		
+		by_rel_risk = sorted(range(len(rows)),key=lambda i: (-self.rel_risks[i],i))
+		self.by_rel_risk = tuple(by_rel_risk)
+		# Negated, so bisect works on an ascending sequence
+		self._neg_rel_risks = tuple(map(lambda i: -self.rel_risks[i],by_rel_risk))
+		
+		outgoing = {}
+		incident = {}
+		for i in by_rel_risk:
+			outgoing.setdefault(self.sources[i],[]).append(i)
+			incident.setdefault(self.sources[i],[]).append(i)
+			if self.targets[i] != self.sources[i]:
+				incident.setdefault(self.targets[i],[]).append(i)
+		
+		self.outgoing = MappingProxyType({ node: tuple(edges) for node, edges in outgoing.items() })
+		self.incident = MappingProxyType({ node: tuple(edges) for node, edges in incident.items() })
+	
+	def has_node(self,node):
+		return node in self.incident
+	
+	def _threshold(self,edge_ids,min_rel_risk):
+		'''The prefix of the edges (sorted by decreasing relative risk) over the threshold'''
+		if min_rel_risk is None:
+			return edge_ids
+		
+		return tuple(itertools.takewhile(lambda i: self.rel_risks[i] >= min_rel_risk,edge_ids))
+	
+	def top_edges(self,k,node=None):
+		'''The k edges with the highest relative risk, either in the whole
+		network or among the ones touching the node'''
+		edge_ids = self.by_rel_risk  if node is None  else self.incident.get(node,())
+		return list(map(self.edges.__getitem__,edge_ids[0:k]))
+	
+	def subgraph(self,min_rel_risk,max_rel_risk=None):
+		'''The edges whose relative risk is within the bounds, sorted by decreasing relative risk'''
+		end = bisect.bisect_right(self._neg_rel_risks,-min_rel_risk)
+		start = 0  if max_rel_risk is None  else bisect.bisect_left(self._neg_rel_risks,-max_rel_risk)
+		return list(map(self.edges.__getitem__,self.by_rel_risk[start:end]))
+	
+	def neighbourhood(self,node,hops,min_rel_risk=None):
+		'''The edges among the diseases reachable from the node in at most
+		the given number of hops, in both directions, through the edges
+		over the threshold. They are sorted by their position in the network'''
+		reached = { node }
+		frontier = [ node ]
+		for _ in range(hops):
+			next_frontier = []
+			for current in frontier:
+				for i in self._threshold(self.incident.get(current,()),min_rel_risk):
+					other = self.targets[i]  if self.sources[i] == current  else self.sources[i]
+					if other not in reached:
+						reached.add(other)
+						next_frontier.append(other)
+			if len(next_frontier) == 0:
+				break
+			frontier = next_frontier
+		
+		edge_ids = set()
+		for current in reached:
+			for i in self._threshold(self.outgoing.get(current,()),min_rel_risk):
+				if self.targets[i] in reached:
+					edge_ids.add(i)
+		
+		return list(map(self.edges.__getitem__,sorted(edge_ids)))
+	
+	def shortest_path(self,from_node,to_node):
+		'''The path of edges, following their direction, minimizing the sum
+		of the inverse of their relative risks (so the strongest comorbidities
+		give the shortest paths), along with that distance. Edges whose relative
+		risk is not positive are not traversed. It returns None when there is no path'''
+		distances = { from_node: 0.0 }
+		previous = {}
+		queue = [ (0.0, from_node) ]
+		while len(queue) > 0:
+			distance, current = heapq.heappop(queue)
+			if current == to_node:
+				break
+			if distance > distances[current]:
+				continue
+			
+			for i in self.outgoing.get(current,()):
+				rel_risk = self.rel_risks[i]
+				if rel_risk <= 0:
+					# The remaining edges have even lower relative risks
+					break
+				
+				other = self.targets[i]
+				other_distance = distance + 1.0 / rel_risk
+				if other_distance < distances.get(other,float('inf')):
+					distances[other] = other_distance
+					previous[other] = i
+					heapq.heappush(queue,(other_distance, other))
+		
+		if to_node not in distances:
+			return None
+		
+		path = []
+		current = to_node
+		while current != from_node:
+			i = previous[current]
+			path.append(self.edges[i])
+			current = self.sources[i]
+		path.reverse()
+		
+		return path, distances[to_node]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+from .patient_graph import numpy, fetch_columns
+
+ENGINE_AVAILABLE = numpy is not None
+
+SET_OPERATIONS = ('intersection','union','difference')
+
+SIMILARITY_METRICS = ('jaccard','cosine')
+
+def similarity(metric,same,opposite,sizes,query_size):
+	'''It computes the similarity from the number of shared items with the same
+	and with the opposite regulation sign, and the sizes of the sets. It works
+	both on scalars and on NumPy arrays'''
+	if metric == 'jaccard':
+		return same / (query_size + sizes - same)
+	
+	# Signed cosine, where each set is a vector of +1 / -1 regulation signs
+	return (same - opposite) / (query_size * sizes) ** 0.5
+
+# This class holds, in CSR form, which items (drugs or genes) are related to
+# each entity (patient or patient subgroup), along with their regulation sign.
+# Each element is the (item, sign) pair encoded as item * 2 + (sign > 0), so
+# the same item with opposite signs gives two different elements. The sorted
+# elements of entity e are elements[indptr[e]:indptr[e+1]]
+class EntitySets(object):
+	def __init__(self,db,query,itersize=100000):
+		'''The query returns the entity id, item id and regulation sign columns'''
+		if numpy is None:
+			raise RuntimeError('NumPy is needed by the in-memory entity sets engine')
+		
+		cur = db.cursor()
+		cur.arraysize = itersize
+		try:
+			entity_ids, item_ids, signs = fetch_columns(cur,query,3)
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+		
+		# Rows with unknown entities or items cannot be answered
+		known = (entity_ids >= 0) & (item_ids >= 0)
+		entity_ids = entity_ids[known]
+		elements = item_ids[known] * 2 + (signs[known] > 0)
+		
+		self.num_entities = int(entity_ids.max()) + 1  if len(entity_ids) > 0  else 0
+		
+		# Sorting by entity and element, and removing duplicates
+		stride = int(elements.max()) + 1  if len(elements) > 0  else 1
+		pairs = numpy.unique(entity_ids * stride + elements)
+		degrees = numpy.bincount(pairs // stride,minlength=self.num_entities)
+		self.indptr = numpy.zeros(self.num_entities + 1,dtype=numpy.int64)
+		numpy.cumsum(degrees,out=self.indptr[1:])
+		self.elements = pairs % stride
+		
+		# The transposed relation: the entities having element x
+		# are entities[element_indptr[x]:element_indptr[x+1]]
+		order = numpy.argsort(self.elements,kind='stable')
+		self.entities = (pairs // stride)[order]
+		element_degrees = numpy.bincount(self.elements,minlength=stride + 1)
+		self.element_indptr = numpy.zeros(len(element_degrees) + 1,dtype=numpy.int64)
+		numpy.cumsum(element_degrees,out=self.element_indptr[1:])
+	
+	@classmethod
+	def from_shared(cls,shared,name,definition):
+		'''The entity sets over the memory mapped arrays of a shared snapshot,
+		when it holds them, built from the same (table, entity column, item column)'''
+		if shared.entity_sets_definition(name) != definition:
+			return None
+		
+		entity_sets = cls.__new__(cls)
+		entity_sets.indptr = shared.array(name + '.indptr')
+		entity_sets.elements = shared.array(name + '.elements')
+		entity_sets.element_indptr = shared.array(name + '.element_indptr')
+		entity_sets.entities = shared.array(name + '.entities')
+		entity_sets.num_entities = len(entity_sets.indptr) - 1
+		return entity_sets
+	
+	@property
+	def nbytes(self):
+		return self.indptr.nbytes + self.elements.nbytes + self.element_indptr.nbytes + self.entities.nbytes
+	
+	@property
+	def sizes(self):
+		'''The number of elements of each entity'''
+		return numpy.diff(self.indptr)
+	
+	def elements_of(self,entity_id):
+		if entity_id < 0 or entity_id >= self.num_entities:
+			return self.elements[0:0]
+		
+		return self.elements[self.indptr[entity_id]:self.indptr[entity_id + 1]]
+	
+	def has_elements(self,entity_ids):
+		return any(len(self.elements_of(entity_id)) > 0 for entity_id in entity_ids)
+	
+	def intersection(self,entity_ids):
+		'''The elements shared by all the entities'''
+		entity_ids = list(entity_ids)
+		res = self.elements_of(entity_ids[0])
+		for entity_id in entity_ids[1:]:
+			if len(res) == 0:
+				break
+			res = numpy.intersect1d(res,self.elements_of(entity_id),assume_unique=True)
+		
+		return res
+	
+	def union(self,entity_ids):
+		'''The elements of any of the entities'''
+		return numpy.unique(numpy.concatenate([ self.elements_of(entity_id) for entity_id in entity_ids ]))
+	
+	def difference(self,entity_ids):
+		'''The elements of the first entity which are not in any of the other ones'''
+		entity_ids = list(entity_ids)
+		res = self.elements_of(entity_ids[0])
+		if len(entity_ids) > 1:
+			res = res[~numpy.isin(res,self.union(entity_ids[1:]),assume_unique=True)]
+		
+		return res
+	
+	def _countEntities(self,elements):
+		'''It counts, for every entity, how many of the elements it has. It is the
+		product of the sparse entity x element matrix by the elements vector'''
+		elements = elements[elements < len(self.element_indptr) - 1]
+		starts = self.element_indptr[elements]
+		lengths = self.element_indptr[elements + 1] - starts
+		total = int(lengths.sum())
+		if total == 0:
+			return numpy.zeros(self.num_entities,dtype=numpy.int64)
+		
+		row_offsets = numpy.cumsum(lengths) - lengths
+		positions = numpy.repeat(starts - row_offsets,lengths) + numpy.arange(total)
+		return numpy.bincount(self.entities[positions],minlength=self.num_entities)
+	
+	def overlaps(self,entity_id):
+		'''It returns, for every entity, the number of items shared with the input
+		entity with the same regulation sign, and with the opposite one'''
+		elements = self.elements_of(entity_id)
+		# Flipping the sign bit of the elements
+		return self._countEntities(elements), self._countEntities(elements ^ 1)
+	
+	@staticmethod
+	def decode(elements):
+		'''It returns the item ids and the regulation signs of the elements'''
+		return elements // 2, numpy.where(elements % 2 == 1,1,-1)
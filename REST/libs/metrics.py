@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+import atexit
+import bisect
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask import Response, g, request
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+METRICS_PREFIX = 'disease_perception_'
+
+# The exported metrics: their kind, help text and, for histograms, their buckets
+METRIC_DEFINITIONS = {
+	'request_duration_seconds': ('histogram','Time spent answering the API requests, until the response is completely sent',LATENCY_BUCKETS),
+	'response_size_bytes': ('histogram','Size of the API responses, as sent',SIZE_BUCKETS),
+	'query_duration_seconds': ('histogram','Time spent inside the comorbidities network query methods',LATENCY_BUCKETS),
+	'query_rows_fetched_total': ('counter','Rows fetched from the database by the comorbidities network query methods',None),
+	'result_cache_hits_total': ('counter','Lookups answered by the query result cache',None),
+	'result_cache_misses_total': ('counter','Lookups not answered by the query result cache',None),
+	'result_cache_evictions_total': ('counter','Entries evicted from the query result cache',None),
+}
+
+# ComorbiditiesNetwork public methods which are not queries
+NOT_QUERY_METHODS = ('begin_request','preload','close','entity_sets')
+
+# Per thread state: the stack of the query methods being run (holding their
+# fetched rows), and the profile of the request being answered, if any
+_local = threading.local()
+
+def _frames():
+	frames = getattr(_local,'stack',None)
+	if frames is None:
+		frames = []
+		_local.stack = frames
+	
+	return frames
+
+def current_profile():
+	return getattr(_local,'profile',None)
+
+def set_current_profile(profile):
+	_local.profile = profile
+
+# This class accumulates where the time of a request is spent: in SQLite
+# (statements execution and row fetching) and inside the query methods.
+# When requested, it also keeps the executed statements
+class RequestProfile(object):
+	MAX_STATEMENTS = 100
+	
+	def __init__(self,keep_statements=False):
+		self.start = time.perf_counter()
+		self.view_end = None
+		self.sql_time = 0.0
+		self.query_time = 0.0
+		self.statements = []  if keep_statements  else None
+	
+	def add_statement(self,sql,parameters,elapsed):
+		self.sql_time += elapsed
+		if self.statements is None or len(self.statements) >= self.MAX_STATEMENTS:
+			return None
+		
+		statement = {
+			'sql': sql,
+			'parameters': parameters,
+			'rows': 0,
+			'seconds': elapsed
+		}
+		self.statements.append(statement)
+		return statement
+
+# The executed statements and fetched rows are accounted in the query frames
+# and the request profile. Only the rows fetched through fetchone, fetchmany
+# and fetchall are counted
+class InstrumentedCursor(sqlite3.Cursor):
+	_statement = None
+	
+	def execute(self,sql,parameters=()):
+		start = time.perf_counter()
+		try:
+			return super().execute(sql,parameters)
+		finally:
+			profile = current_profile()
+			if profile is not None:
+				self._statement = profile.add_statement(sql,parameters,time.perf_counter() - start)
+	
+	def _fetched(self,num_rows,elapsed):
+		frames = getattr(_local,'stack',None)
+		if frames:
+			frames[-1][0] += num_rows
+		profile = current_profile()
+		if profile is not None:
+			profile.sql_time += elapsed
+			statement = self._statement
+			if statement is not None:
+				statement['rows'] += num_rows
+				statement['seconds'] += elapsed
+	
+	def fetchone(self):
+		start = time.perf_counter()
+		row = super().fetchone()
+		self._fetched(0  if row is None  else 1,time.perf_counter() - start)
+		return row
+	
+	def fetchmany(self,size=None):
+		start = time.perf_counter()
+		rows = super().fetchmany()  if size is None  else super().fetchmany(size)
+		self._fetched(len(rows),time.perf_counter() - start)
+		return rows
+	
+	def fetchall(self):
+		start = time.perf_counter()
+		rows = super().fetchall()
+		self._fetched(len(rows),time.perf_counter() - start)
+		return rows
+
+def _timedIterator(name,iterator,frame,elapsed,metrics):
+	'''Only the time spent producing the elements is accounted, not the one
+	spent by the consumer (for instance, sending them to the client)'''
+	frames = _frames()
+	try:
+		while True:
+			outermost = len(frames) == 0
+			frames.append(frame)
+			num_rows = frame[0]
+			start = time.perf_counter()
+			try:
+				elem = next(iterator)
+			except StopIteration:
+				break
+			finally:
+				step = time.perf_counter() - start
+				elapsed += step
+				frames.pop()
+				if not outermost:
+					frames[-1][0] += frame[0] - num_rows
+				else:
+					profile = current_profile()
+					if profile is not None:
+						profile.query_time += step
+			yield elem
+	finally:
+		if metrics is not None:
+			metrics.record_query(name,elapsed,frame[0])
+
+def _timedMethod(name,method,metrics):
+	@functools.wraps(method)
+	def wrapper(*args,**kwargs):
+		frames = _frames()
+		outermost = len(frames) == 0
+		frame = [ 0 ]
+		frames.append(frame)
+		res = None
+		start = time.perf_counter()
+		try:
+			res = method(*args,**kwargs)
+		finally:
+			elapsed = time.perf_counter() - start
+			frames.pop()
+			# Rows fetched by nested query methods are also accounted to the caller
+			if not outermost:
+				frames[-1][0] += frame[0]
+			else:
+				profile = current_profile()
+				if profile is not None:
+					profile.query_time += elapsed
+			if metrics is not None and not inspect.isgenerator(res):
+				metrics.record_query(name,elapsed,frame[0])
+		
+		if inspect.isgenerator(res):
+			return _timedIterator(name,res,frame,elapsed,metrics)
+		
+		return res
+	
+	return wrapper
+
+def instrument_network(cmn,metrics=None):
+	'''It wraps the query methods of the ComorbiditiesNetwork instance, so their
+	time (and the one of their cursors) is accounted in the request profile and,
+	when given, recorded in the metrics'''
+	for name, _ in inspect.getmembers(type(cmn),inspect.isfunction):
+		if name.startswith('_') or name in NOT_QUERY_METHODS:
+			continue
+		setattr(cmn,name,_timedMethod(name,getattr(cmn,name),metrics))
+	cmn.cursor_factory = InstrumentedCursor
+
+def default_spool_dir(dbpath):
+	'''Each served database gets its own spool directory, shared by all the workers'''
+	digest = hashlib.sha1(os.path.abspath(dbpath).encode('utf-8')).hexdigest()[0:12]
+	return os.path.join(tempfile.gettempdir(),'disease_perception_metrics-' + digest)
+
+# The totals of the finished processes, folded in a single spool file
+ARCHIVED_SPOOL_FILE = 'archived.json'
+
+def _processAlive(pid):
+	try:
+		os.kill(pid,0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass
+	
+	return True
+
+# This class keeps the metrics of the process in memory. They are periodically
+# saved to a spool directory, one file per process, so the metrics endpoint
+# served by any of the workers (uwsgi, mod_wsgi) aggregates all of them.
+# Each file is named after the pid and the start of the process, so a new
+# worker reusing the pid of a finished one does not overwrite it. The files of
+# the finished workers are folded into an archived one, so the counters stay
+# monotonic while the spool does not grow with each recycled worker
+class Metrics(object):
+	def __init__(self,spool_dir,flush_interval=5.0):
+		self.spool_dir = spool_dir
+		self.flush_interval = flush_interval
+		os.makedirs(spool_dir,exist_ok=True)
+		
+		self._spool_pid = None
+		self._spool_file = None
+		self._lock = threading.Lock()
+		self._histograms = {}
+		self._counters = {}
+		self._collectors = []
+		self._last_flush = time.monotonic()
+		atexit.register(self.flush)
+	
+	def observe(self,name,labels,value):
+		'''It records a value in the histogram. The labels are a tuple of (name, value) pairs'''
+		buckets = METRIC_DEFINITIONS[name][2]
+		slot = bisect.bisect_left(buckets,value)
+		key = (name, labels)
+		with self._lock:
+			histogram = self._histograms.get(key)
+			if histogram is None:
+				# Bucket counts (the last one is +Inf) and the sum of the values
+				histogram = [ 0 ] * (len(buckets) + 2)
+				self._histograms[key] = histogram
+			histogram[slot] += 1
+			histogram[-1] += value
+	
+	def inc(self,name,labels,value=1):
+		key = (name, labels)
+		with self._lock:
+			self._counters[key] = self._counters.get(key,0) + value
+	
+	def add_collector(self,collector):
+		'''The collector returns (name, labels, value) counters, which
+		are gathered from the process state when the metrics are saved'''
+		self._collectors.append(collector)
+	
+	def _snapshot(self):
+		counters = []
+		for collector in self._collectors:
+			for name, labels, value in collector():
+				counters.append([ name, dict(labels), value ])
+		
+		with self._lock:
+			histograms = [ [ name, dict(labels), list(histogram) ] for (name, labels), histogram in self._histograms.items() ]
+			counters.extend([ name, dict(labels), value ] for (name, labels), value in self._counters.items())
+		
+		return {
+			'pid': os.getpid(),
+			'histograms': histograms,
+			'counters': counters
+		}
+	
+	def reset(self):
+		'''It removes the metrics saved by a previous run of the server. When
+		any other process of this run is alive (lazy-apps in uwsgi, mod_wsgi
+		daemon processes), the spool is kept, as it holds their metrics'''
+		with self._spoolLock():
+			spool_names = os.listdir(self.spool_dir)
+			own_prefix = '{}-'.format(os.getpid())
+			for spool_name in spool_names:
+				if spool_name.endswith('.json') and spool_name != ARCHIVED_SPOOL_FILE and not spool_name.startswith(own_prefix) and self._isLiveSpool(spool_name):
+					return
+			
+			for spool_name in spool_names:
+				if spool_name.endswith(('.json', '.json.tmp')) and not spool_name.startswith(own_prefix):
+					try:
+						os.unlink(os.path.join(self.spool_dir,spool_name))
+					except OSError:
+						pass
+			
+			# The saved file tells the processes started later that this run is live
+			self.flush()
+	
+	def _spoolLock(self):
+		'''An exclusive lock over the spool directory, shared by all the processes'''
+		return _SpoolLock(os.path.join(self.spool_dir,'.lock'))
+	
+	def _isLiveSpool(self,spool_name):
+		pid = spool_name[0:-len('.json')].split('-')[0]
+		return not pid.isdigit() or _processAlive(int(pid))
+	
+	def _archiveFinished(self):
+		'''It folds the files of the finished processes into the archived one'''
+		if fcntl is None:
+			return
+		
+		with self._spoolLock():
+			finished = [ spool_name for spool_name in os.listdir(self.spool_dir) if spool_name.endswith('.json') and spool_name != ARCHIVED_SPOOL_FILE and not self._isLiveSpool(spool_name) ]
+			if len(finished) == 0:
+				return
+			
+			histograms = {}
+			counters = {}
+			for spool_name in [ ARCHIVED_SPOOL_FILE ] + finished:
+				_mergeSpoolFile(os.path.join(self.spool_dir,spool_name),histograms,counters)
+			
+			archived_file = os.path.join(self.spool_dir,ARCHIVED_SPOOL_FILE)
+			try:
+				with open(archived_file + '.tmp','w',encoding='utf-8') as sf:
+					json.dump({
+						'histograms': [ [ name, dict(labels), histogram ] for (name, labels), histogram in histograms.items() ],
+						'counters': [ [ name, dict(labels), value ] for (name, labels), value in counters.items() ]
+					},sf)
+				os.replace(archived_file + '.tmp',archived_file)
+				for spool_name in finished:
+					os.unlink(os.path.join(self.spool_dir,spool_name))
+			except OSError:
+				pass
+	
+	def flush(self):
+		'''It saves the metrics of this process, atomically replacing its previous file'''
+		self._last_flush = time.monotonic()
+		pid = os.getpid()
+		if self._spool_pid != pid:
+			# First flush of this process (the workers inherit the instance through fork)
+			self._spool_pid = pid
+			self._spool_file = os.path.join(self.spool_dir,'{}-{}.json'.format(pid,time.time_ns()))
+		spool_file = self._spool_file
+		tmp_file = spool_file + '.tmp'
+		try:
+			with open(tmp_file,'w',encoding='utf-8') as sf:
+				json.dump(self._snapshot(),sf)
+			os.replace(tmp_file,spool_file)
+		except OSError:
+			# Metrics must never break the API
+			pass
+	
+	def maybe_flush(self):
+		if time.monotonic() - self._last_flush >= self.flush_interval:
+			self.flush()
+	
+	def _aggregate(self):
+		'''It merges the saved metrics of all the processes'''
+		self.flush()
+		self._archiveFinished()
+		histograms = {}
+		counters = {}
+		with self._spoolLock():
+			for spool_name in os.listdir(self.spool_dir):
+				if spool_name.endswith('.json'):
+					_mergeSpoolFile(os.path.join(self.spool_dir,spool_name),histograms,counters)
+		
+		return histograms, counters
+	
+	def render(self):
+		'''The aggregated metrics, in Prometheus text exposition format'''
+		histograms, counters = self._aggregate()
+		lines = []
+		for name, (kind, help_text, buckets) in METRIC_DEFINITIONS.items():
+			full_name = METRICS_PREFIX + name
+			lines.append('# HELP {} {}'.format(full_name,help_text))
+			lines.append('# TYPE {} {}'.format(full_name,kind))
+			if kind == 'histogram':
+				for (h_name, labels), histogram in sorted(histograms.items()):
+					if h_name != name:
+						continue
+					cumulative = 0
+					for le, count in zip(buckets + ('+Inf',),histogram):
+						cumulative += count
+						lines.append('{}_bucket{} {}'.format(full_name,_formatLabels(labels + (('le',le),)),cumulative))
+					lines.append('{}_sum{} {}'.format(full_name,_formatLabels(labels),histogram[-1]))
+					lines.append('{}_count{} {}'.format(full_name,_formatLabels(labels),cumulative))
+			else:
+				for (c_name, labels), value in sorted(counters.items()):
+					if c_name == name:
+						lines.append('{}{} {}'.format(full_name,_formatLabels(labels),value))
+		
+		# The hit ratio of the result caches of all the workers
+		hits = sum(value for (name, _), value in counters.items() if name == 'result_cache_hits_total')
+		lookups = hits + sum(value for (name, _), value in counters.items() if name == 'result_cache_misses_total')
+		lines.append('# HELP {}result_cache_hit_ratio Ratio of the result cache lookups which were hits'.format(METRICS_PREFIX))
+		lines.append('# TYPE {}result_cache_hit_ratio gauge'.format(METRICS_PREFIX))
+		lines.append('{}result_cache_hit_ratio {}'.format(METRICS_PREFIX,hits / lookups  if lookups > 0  else 0.0))
+		
+		return '\n'.join(lines) + '\n'
+	
+	def response(self):
+		return Response(self.render(),mimetype='text/plain; version=0.0.4')
+	
+	def record_query(self,name,elapsed,num_rows):
+		labels = (('query',name),)
+		self.observe('query_duration_seconds',labels,elapsed)
+		if num_rows > 0:
+			self.inc('query_rows_fetched_total',labels,num_rows)
+	
+	def instrument_network(self,cmn):
+		'''It records the latencies and fetched rows of the query methods of the
+		ComorbiditiesNetwork instance, and its result cache counters'''
+		instrument_network(cmn,self)
+		
+		result_cache = cmn.result_cache
+		if result_cache is not None:
+			self.add_collector(lambda: (
+				('result_cache_hits_total', (), result_cache.hits),
+				('result_cache_misses_total', (), result_cache.misses),
+				('result_cache_evictions_total', (), result_cache.evictions),
+			))
+	
+	def instrument_blueprint(self,blueprint):
+		'''It times every request handled by the blueprint, until its response is closed'''
+		@blueprint.before_request
+		def start_request_timer():
+			g.metrics_start = time.perf_counter()
+		
+		@blueprint.after_request
+		def record_request(response):
+			start = g.get('metrics_start')
+			if start is None:
+				return response
+			
+			url_rule = request.url_rule
+			labels = (
+				('method',request.method),
+				('route',url_rule.rule  if url_rule is not None  else ''),
+				('status',str(response.status_code)),
+			)
+			sent = [ 0 ]
+			if response.is_streamed:
+				response.response = count_bytes(response.response,sent)
+			
+			def on_close():
+				self.observe('request_duration_seconds',labels,time.perf_counter() - start)
+				size = sent[0]  if response.is_streamed  else response.content_length
+				self.observe('response_size_bytes',labels,size or 0)
+				self.maybe_flush()
+			
+			response.call_on_close(on_close)
+			return response
+
+class _SpoolLock(object):
+	def __init__(self,lock_path):
+		self.lock_path = lock_path
+		self._fh = None
+	
+	def __enter__(self):
+		if fcntl is not None:
+			try:
+				self._fh = open(self.lock_path,'a')
+				fcntl.flock(self._fh,fcntl.LOCK_EX)
+			except OSError:
+				self._fh = None
+		return self
+	
+	def __exit__(self,exc_type,exc_value,traceback):
+		if self._fh is not None:
+			# Closing the file releases the lock
+			self._fh.close()
+			self._fh = None
+
+def _mergeSpoolFile(spool_path,histograms,counters):
+	'''It adds the metrics saved in the spool file to the merged ones'''
+	try:
+		with open(spool_path,'r',encoding='utf-8') as sf:
+			snapshot = json.load(sf)
+	except (OSError, ValueError):
+		return
+	
+	for name, labels, histogram in snapshot['histograms']:
+		key = (name, tuple(sorted(labels.items())))
+		merged = histograms.get(key)
+		if merged is None:
+			histograms[key] = histogram
+		else:
+			histograms[key] = [ a + b for a, b in zip(merged,histogram) ]
+	
+	for name, labels, value in snapshot['counters']:
+		key = (name, tuple(sorted(labels.items())))
+		counters[key] = counters.get(key,0) + value
+
+def count_bytes(iterable,sent):
+	for chunk in iterable:
+		sent[0] += len(chunk)
+		yield chunk
+
+def _formatLabels(labels):
+	if len(labels) == 0:
+		return ''
+	
+	return '{' + ','.join('{}="{}"'.format(name,_escapeLabel(value)) for name, value in labels) + '}'
+
+def _escapeLabel(value):
+	return str(value).replace('\\','\\\\').replace('"','\\"').replace('\n','\\n')
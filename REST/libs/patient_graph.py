@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+# NumPy is an optional dependency. When it is not available,
+# the interactions are always answered through SQL
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+def smallest_uint_dtype(max_value):
+	for dtype in (numpy.uint8, numpy.uint16, numpy.uint32):
+		if max_value <= numpy.iinfo(dtype).max:
+			return dtype
+	
+	return numpy.uint64
+
+def fetch_columns(cur,query,num_columns):
+	'''It fetches the integer columns of the query results as NumPy arrays'''
+	cur.execute(query)
+	chunks = []
+	while True:
+		rows = cur.fetchmany()
+		if len(rows) == 0:
+			break
+		
+		# NULL values are mapped to -1
+		chunks.append(numpy.array(rows,dtype=numpy.float64))
+	
+	if len(chunks) == 0:
+		return [ numpy.zeros(0,dtype=numpy.int64) for _ in range(num_columns) ]
+	
+	matrix = numpy.nan_to_num(numpy.concatenate(chunks),nan=-1).astype(numpy.int64)
+	return [ matrix[:,i] for i in range(num_columns) ]
+
+# This class holds the patient interaction graph in CSR form:
+# the neighbours of patient a are indices[indptr[a]:indptr[a+1]],
+# with their interaction signs in the same positions of signs
+class PatientGraph(object):
+	def __init__(self,db,itersize=100000):
+		if numpy is None:
+			raise RuntimeError('NumPy is needed by the in-memory patient graph engine')
+		
+		cur = db.cursor()
+		cur.arraysize = itersize
+		try:
+			patient_ids, patient_subgroup_ids = fetch_columns(cur,'SELECT id, patient_subgroup_id FROM patient',2)
+			a_ids, b_ids, signs = fetch_columns(cur,'SELECT patient_a_id, patient_b_id, interaction_sign FROM patient_graph',3)
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+		
+		# Edges with unknown ends cannot be answered
+		known = (a_ids >= 0) & (b_ids >= 0)
+		a_ids = a_ids[known]
+		b_ids = b_ids[known]
+		signs = signs[known]
+		
+		max_id = 0
+		for ids in (patient_ids, a_ids, b_ids):
+			if len(ids) > 0:
+				max_id = max(max_id,int(ids.max()))
+		self.num_nodes = max_id + 1
+		
+		# Patients without subgroup get -1
+		self.patient_subgroup = numpy.full(self.num_nodes,-1,dtype=numpy.int32)
+		self.patient_subgroup[patient_ids] = patient_subgroup_ids
+		
+		order = numpy.lexsort((b_ids,a_ids))
+		degrees = numpy.bincount(a_ids,minlength=self.num_nodes)
+		self.indptr = numpy.zeros(self.num_nodes + 1,dtype=numpy.int64)
+		numpy.cumsum(degrees,out=self.indptr[1:])
+		self.indices = b_ids[order].astype(smallest_uint_dtype(max_id))
+		self.signs = signs[order].astype(numpy.int8)
+	
+	@classmethod
+	def from_shared(cls,shared):
+		'''The graph over the memory mapped arrays of a shared snapshot, when it holds them'''
+		if not shared.has('patient_graph.indptr'):
+			return None
+		
+		patient_graph = cls.__new__(cls)
+		patient_graph.patient_subgroup = shared.array('patient_graph.patient_subgroup')
+		patient_graph.indptr = shared.array('patient_graph.indptr')
+		patient_graph.indices = shared.array('patient_graph.indices')
+		patient_graph.signs = shared.array('patient_graph.signs')
+		patient_graph.num_nodes = len(patient_graph.indptr) - 1
+		return patient_graph
+	
+	@property
+	def nbytes(self):
+		return self.patient_subgroup.nbytes + self.indptr.nbytes + self.indices.nbytes + self.signs.nbytes
+	
+	def patients_from_subgroups(self,patient_subgroup_ids):
+		'''It returns the sorted patient ids belonging to the input patient subgroups'''
+		subgroup_ids = numpy.fromiter(patient_subgroup_ids,dtype=numpy.int64)
+		return numpy.nonzero(numpy.isin(self.patient_subgroup,subgroup_ids))[0]
+	
+	def induced_subgraph(self,patient_ids):
+		'''It returns the (patient_a_ids, patient_b_ids, signs) arrays of the edges
+		whose both ends are in the input patient set, sorted by patient_a_id and patient_b_id'''
+		ids = numpy.unique(numpy.fromiter(patient_ids,dtype=numpy.int64))
+		ids = ids[(ids >= 0) & (ids < self.num_nodes)]
+		
+		mask = numpy.zeros(self.num_nodes,dtype=bool)
+		mask[ids] = True
+		
+		starts = self.indptr[ids]
+		lengths = self.indptr[ids + 1] - starts
+		total = int(lengths.sum())
+		if total == 0:
+			return ids[0:0], ids[0:0], self.signs[0:0]
+		
+		# Positions of all the edges starting from the selected patients
+		row_offsets = numpy.cumsum(lengths) - lengths
+		positions = numpy.repeat(starts - row_offsets,lengths) + numpy.arange(total)
+		
+		b_ids = self.indices[positions]
+		selected = mask[b_ids]
+		
+		return numpy.repeat(ids,lengths)[selected], b_ids[selected], self.signs[positions[selected]]
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+'''
+Query plan audit of the comorbidities network database.
+
+Usage: python -m libs.query_audit [-o report.json] path/to/net_comorbidity.db
+
+Every query method from ComorbiditiesNetwork is run with representative
+parameters, and the plan of each issued statement is obtained through
+EXPLAIN QUERY PLAN. Full table scans, temporary B-tree sorts and automatic
+indexes are flagged. For the flagged statements, candidate composite and
+covering indexes are tried on an empty copy of the schema (keeping the
+ANALYZE statistics), and the ones which remove issues are suggested.
+The report is saved next to the database, unless another path is given.
+'''
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import re
+import sqlite3
+import sys
+
+from .cm_queries import ComorbiditiesNetwork
+
+# Maximum number of columns of a candidate index
+MAX_INDEX_COLUMNS = 4
+
+# Maximum number of suggested indexes for a single statement
+MAX_SUGGESTIONS = 2
+
+ISSUE_PATTERNS = (
+	('full_scan', re.compile(r'^SCAN (\w+)(?: USING (?:COVERING )?INDEX \w+)?$')),
+	('temp_btree', re.compile(r'^USE TEMP B-TREE')),
+	('automatic_index', re.compile(r'AUTOMATIC (?:PARTIAL )?(?:COVERING )?INDEX')),
+)
+
+TABLE_REF_RE = re.compile(r'(?:\bFROM|\bJOIN|,)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?',re.IGNORECASE)
+SQL_KEYWORDS = frozenset(['WHERE','ON','ORDER','GROUP','LIMIT','INNER','LEFT','CROSS','JOIN','AND','OR','USING','HAVING','UNION'])
+
+class AuditAbort(Exception):
+	pass
+
+class AuditAPI(object):
+	'''Replacement of the flask_restx Api, as only abort is used'''
+	def abort(self,code,message):
+		raise AuditAbort('{}: {}'.format(code,message))
+
+# This subclass records every statement issued by the query methods
+class TracedNetwork(ComorbiditiesNetwork):
+	def __init__(self,dbpath):
+		super().__init__(dbpath,AuditAPI(),result_cache_bytes=0)
+		self.label = None
+		self.statements = []
+	
+	def _connect(self):
+		db = super()._connect()
+		db.set_trace_callback(self._trace)
+		return db
+	
+	def _trace(self,statement):
+		# Statements issued outside the audited calls are not recorded
+		if self.label is not None and not statement.lstrip().upper().startswith('PRAGMA'):
+			self.statements.append((self.label,statement.strip()))
+
+def sample_parameters(db):
+	'''Representative parameters, chosen among the most connected entities'''
+	def column(query):
+		return list(map(lambda row: row[0],db.execute(query).fetchall()))
+	
+	disease_ids = column('SELECT disease_id FROM patient_subgroup GROUP BY disease_id ORDER BY COUNT(*) DESC LIMIT 5')
+	patient_subgroup_ids = column('SELECT patient_subgroup_id FROM patient GROUP BY patient_subgroup_id ORDER BY COUNT(*) DESC LIMIT 10')
+	patient_ids = column('SELECT patient_a_id FROM patient_graph GROUP BY patient_a_id ORDER BY COUNT(*) DESC LIMIT 50')
+	
+	return {
+		'gene_symbol': column('SELECT gene_symbol FROM gene WHERE gene_symbol IS NOT NULL LIMIT 1')[0],
+		'drug_id': column('SELECT id FROM drug LIMIT 1')[0],
+		'study_id': column('SELECT geo_arrayexpress_code FROM study LIMIT 1')[0],
+		'disease_group_id': column('SELECT id FROM disease_group LIMIT 1')[0],
+		'disease_id': disease_ids[0],
+		'disease_ids': disease_ids,
+		'patient_subgroup_id': patient_subgroup_ids[0],
+		'patient_subgroup_ids': patient_subgroup_ids,
+		'patient_id': patient_ids[0],
+		'patient_ids': patient_ids,
+	}
+
+AUDITED_CALLS = [
+	('genes', lambda cmn, p: cmn.genes()),
+	('gene', lambda cmn, p: cmn.gene(p['gene_symbol'])),
+	('genes_page', lambda cmn, p: cmn.genes_page(100,100)),
+	('drugs', lambda cmn, p: cmn.drugs()),
+	('drugs_page', lambda cmn, p: cmn.drugs_page(100,100)),
+	('studies', lambda cmn, p: cmn.study(p['study_id'])),
+	('diseases', lambda cmn, p: cmn.diseases(disease_group_id=p['disease_group_id'])),
+	('disease_comorbidities', lambda cmn, p: cmn.disease_comorbidities()),
+	('disease_comorbidities(id)', lambda cmn, p: cmn.disease_comorbidities(p['disease_id'])),
+	('disease_comorbidities(min_rr,order,limit)', lambda cmn, p: cmn.disease_comorbidities(min_rr=2.0,order='rr_desc',limit=100)),
+	('disease_comorbidities(id,min_rr,order)', lambda cmn, p: cmn.disease_comorbidities(p['disease_id'],min_rr=2.0,order='rr_desc')),
+	('disease_comorbidities_page', lambda cmn, p: cmn.disease_comorbidities_page(100,100)),
+	('diseases_patient_subgroups_comorbidities', lambda cmn, p: cmn.diseases_patient_subgroups_comorbidities(p['disease_ids'])),
+	('diseases_patient_subgroups_comorbidities(min_size)', lambda cmn, p: cmn.diseases_patient_subgroups_comorbidities(p['disease_ids'],3)),
+	('diseases_patient_subgroups_comorbidities(min_rr,order,limit)', lambda cmn, p: cmn.diseases_patient_subgroups_comorbidities(p['disease_ids'],min_rr=2.0,order='rr_desc',limit=100)),
+	('patients', lambda cmn, p: cmn.patients()),
+	('patient', lambda cmn, p: cmn.patient(p['patient_id'])),
+	('patients(patient_subgroup_id)', lambda cmn, p: cmn.patients(patient_subgroup_id=p['patient_subgroup_id'])),
+	('patients_page', lambda cmn, p: cmn.patients_page(100,100)),
+	('patient_subgroups', lambda cmn, p: cmn.patient_subgroups()),
+	('patient_subgroup', lambda cmn, p: cmn.patient_subgroup(p['patient_subgroup_id'])),
+	('patient_subgroups_page', lambda cmn, p: cmn.patient_subgroups_page(100,100)),
+	('patient_subgroup_intersect_genes(patient_subgroup_ids)', lambda cmn, p: cmn.patient_subgroup_intersect_genes(patient_subgroup_ids=p['patient_subgroup_ids'])),
+	('patient_subgroup_intersect_genes(disease_ids)', lambda cmn, p: cmn.patient_subgroup_intersect_genes(disease_ids=p['disease_ids'])),
+	('patient_subgroup_intersect_drugs(patient_subgroup_ids)', lambda cmn, p: cmn.patient_subgroup_intersect_drugs(patient_subgroup_ids=p['patient_subgroup_ids'])),
+	('patient_subgroup_intersect_drugs(disease_ids)', lambda cmn, p: cmn.patient_subgroup_intersect_drugs(disease_ids=p['disease_ids'])),
+	('patient_map_genes(patient_ids)', lambda cmn, p: cmn.patient_map_genes(patient_ids=p['patient_ids'])),
+	('patient_map_genes(patient_subgroup_ids)', lambda cmn, p: cmn.patient_map_genes(patient_subgroup_ids=p['patient_subgroup_ids'])),
+	('patient_map_drugs(patient_ids)', lambda cmn, p: cmn.patient_map_drugs(patient_ids=p['patient_ids'])),
+	('patient_map_drugs(patient_subgroup_ids)', lambda cmn, p: cmn.patient_map_drugs(patient_subgroup_ids=p['patient_subgroup_ids'])),
+	('patients_interactions(patient_ids)', lambda cmn, p: cmn.patients_interactions(patient_ids=p['patient_ids'])),
+	('patients_interactions(patient_subgroup_ids)', lambda cmn, p: cmn.patients_interactions(patient_subgroup_ids=p['patient_subgroup_ids'])),
+]
+
+def collect_statements(dbpath):
+	'''It runs the audited calls, returning the issued statements along with the calls issuing them'''
+	cmn = TracedNetwork(dbpath)
+	try:
+		params = sample_parameters(cmn.db)
+		
+		cmn.label = 'reference snapshot'
+		cmn.snapshot
+		
+		for label, call in AUDITED_CALLS:
+			cmn.label = label
+			try:
+				call(cmn,params)
+			except AuditAbort as e:
+				print('* {}: {}'.format(label,e),file=sys.stderr)
+	finally:
+		cmn.close()
+	
+	statements = {}
+	for label, statement in cmn.statements:
+		statements.setdefault(statement,[]).append(label)
+	
+	return statements
+
+def query_plan(db,statement):
+	return list(map(lambda row: row[3],db.execute('EXPLAIN QUERY PLAN ' + statement).fetchall()))
+
+def plan_issues(plan):
+	issues = []
+	for detail in plan:
+		for kind, pattern in ISSUE_PATTERNS:
+			if pattern.search(detail):
+				issues.append({'kind': kind,'detail': detail})
+	
+	return issues
+
+def schema_copy(db):
+	'''An empty in-memory copy of the database schema, with the same planner statistics'''
+	mem = sqlite3.connect(':memory:')
+	for (ddl,) in db.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type = 'index'"):
+		mem.execute(ddl)
+	
+	has_stats = db.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone()[0] > 0
+	if has_stats:
+		mem.execute('ANALYZE')
+		mem.execute('DELETE FROM sqlite_stat1')
+		mem.executemany('INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (?, ?, ?)',db.execute('SELECT tbl, idx, stat FROM sqlite_stat1'))
+		mem.commit()
+		# The planner reloads the statistics
+		mem.execute('ANALYZE sqlite_master')
+	
+	return mem
+
+def statement_tables(mem,statement):
+	'''It returns the referenced tables, and their columns referenced in the statement'''
+	table_columns = {}
+	for (name,) in mem.execute("SELECT name FROM sqlite_master WHERE type = 'table'"):
+		table_columns[name] = list(map(lambda row: row[1],mem.execute('PRAGMA table_info({})'.format(name))))
+	
+	aliases = {}
+	for table, alias in TABLE_REF_RE.findall(statement):
+		if table in table_columns:
+			if alias == '' or alias.upper() in SQL_KEYWORDS:
+				alias = table
+			aliases[alias] = table
+	
+	referenced = {}
+	for alias, table in aliases.items():
+		if len(aliases) == 1:
+			pattern = re.compile(r'\b(\w+)\b')
+		else:
+			pattern = re.compile(r'\b{}\.(\w+)\b'.format(re.escape(alias)))
+		
+		columns = referenced.setdefault(table,[])
+		for column in pattern.findall(statement):
+			if column in table_columns[table] and column not in columns:
+				columns.append(column)
+	
+	return referenced
+
+def candidate_indexes(referenced):
+	for table, columns in referenced.items():
+		columns = columns[0:MAX_INDEX_COLUMNS]
+		seen = set()
+		for size in range(1,len(columns) + 1):
+			for candidate in itertools.permutations(columns,size):
+				if candidate not in seen:
+					seen.add(candidate)
+					yield table, list(candidate)
+
+def issue_score(issues):
+	return len(issues)
+
+def advise(mem,statement,issues):
+	'''It greedily looks for the indexes which remove most of the issues of the statement'''
+	suggestions = []
+	referenced = statement_tables(mem,statement)
+	for i in range(MAX_SUGGESTIONS):
+		best = None
+		for table, columns in candidate_indexes(referenced):
+			index_name = 'audit_candidate_{}'.format(i)
+			mem.execute('CREATE INDEX {} ON {} ({})'.format(index_name,table,', '.join(columns)))
+			try:
+				candidate_issues = plan_issues(query_plan(mem,statement))
+				used = any(index_name in detail for detail in query_plan(mem,statement))
+			finally:
+				mem.execute('DROP INDEX {}'.format(index_name))
+			
+			if used and issue_score(candidate_issues) < issue_score(issues):
+				# Shorter indexes win on ties
+				if best is None or issue_score(candidate_issues) < issue_score(best[2]):
+					best = (table, columns, candidate_issues)
+		
+		if best is None:
+			break
+		
+		table, columns, remaining = best
+		removed = [ issue['detail'] for issue in issues if issue not in remaining ]
+		mem.execute('CREATE INDEX audit_suggested_{}_{} ON {} ({})'.format(table,'_'.join(columns),table,', '.join(columns)))
+		suggestions.append({
+			'table': table,
+			'columns': columns,
+			'ddl': 'CREATE INDEX {0}_fk_{1} ON {0} ({2});'.format(table,'_'.join(columns),', '.join(columns)),
+			'removes': removed
+		})
+		issues = remaining
+	
+	# The schema copy is left as it was
+	for suggestion in suggestions:
+		mem.execute('DROP INDEX audit_suggested_{}_{}'.format(suggestion['table'],'_'.join(suggestion['columns'])))
+	
+	return suggestions, issues
+
+def audit(dbpath):
+	statements = collect_statements(dbpath)
+	
+	db = sqlite3.connect('file:'+os.path.abspath(dbpath)+'?mode=ro',uri=True)
+	try:
+		mem = schema_copy(db)
+		entries = []
+		suggested_indexes = {}
+		for statement, labels in statements.items():
+			plan = query_plan(db,statement)
+			issues = plan_issues(plan)
+			suggestions = []
+			remaining = issues
+			if len(issues) > 0:
+				suggestions, remaining = advise(mem,statement,issues)
+				for suggestion in suggestions:
+					table_indexes = suggested_indexes.setdefault(suggestion['table'],[])
+					if suggestion['columns'] not in table_indexes:
+						table_indexes.append(suggestion['columns'])
+			
+			entries.append({
+				'calls': sorted(set(labels)),
+				'sql': statement,
+				'plan': plan,
+				'issues': issues,
+				# Issues no index can remove, like full scans of listings
+				'unavoidable': remaining,
+				'suggestions': suggestions
+			})
+		mem.close()
+	finally:
+		db.close()
+	
+	return {
+		'database': os.path.abspath(dbpath),
+		'generated': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		'sqlite_version': sqlite3.sqlite_version,
+		'statements': entries,
+		# Ready to be added to the 'indexes' arrays from sql_create_tables.json
+		'suggested_indexes': suggested_indexes
+	}
+
+def main():
+	ap = argparse.ArgumentParser(description='EXPLAIN QUERY PLAN audit and index advisor of the comorbidities network queries')
+	ap.add_argument('-o','--output',help='The report file (by default, next to the database)')
+	ap.add_argument('dbpath',help='The comorbidities network database')
+	args = ap.parse_args()
+	
+	report = audit(args.dbpath)
+	output = args.output  if args.output  else os.path.splitext(args.dbpath)[0] + '.query_audit.json'
+	with open(output,mode='w',encoding='utf-8') as rh:
+		json.dump(report,rh,indent=4)
+	
+	num_issues = 0
+	for entry in report['statements']:
+		avoidable = [ issue for issue in entry['issues'] if issue not in entry['unavoidable'] ]
+		num_issues += len(avoidable)
+		if len(avoidable) > 0:
+			print('* {}'.format(', '.join(entry['calls'])))
+			for issue in avoidable:
+				print('\t- {}: {}'.format(issue['kind'],issue['detail']))
+			for suggestion in entry['suggestions']:
+				print('\t+ {}'.format(suggestion['ddl']))
+	
+	print('{} statements audited, {} avoidable issues. Report saved at {}'.format(len(report['statements']),num_issues,output))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+import json
+from types import MappingProxyType
+
+from .shared_snapshot import MappedRecords, SortedIndex
+
+# This class holds an immutable, in-memory copy of the small reference tables
+# (genes, drugs, studies, diseases and disease groups), indexed by their keys.
+# The entity dictionaries are shared among requests, so they must not be modified
+class ReferenceSnapshot(object):
+	# Equivalent to the disease_group_wide and disease_wide tables, for databases built before they were introduced
+	DISEASE_GROUP_WIDE_SUBQUERY = '''(
+SELECT dg.id AS id, dg.name AS name, (SELECT json_group_object(dgp.property, dgp.value) FROM disease_group_properties dgp WHERE dgp.disease_group_id = dg.id) AS properties
+FROM disease_group dg
+)'''
+
+	DISEASE_WIDE_SUBQUERY = '''(
+SELECT d.id AS id, d.name AS name, d.disease_group_id AS disease_group_id, (SELECT json_group_object(dp.property, dp.value) FROM disease_properties dp WHERE dp.disease_id = d.id) AS properties
+FROM disease d
+)'''
+
+	def __init__(self,db,itersize=1000):
+		self.itersize = itersize
+		cur = db.cursor()
+		cur.arraysize = itersize
+		try:
+			self.tables = self._loadTableNames(cur)
+			self.genes = self._loadGenes(cur)
+			self.drugs = self._loadDrugs(cur)
+			self.studies = self._loadStudies(cur)
+			self.disease_groups = self._loadDiseaseGroups(cur)
+			self.diseases = self._loadDiseases(cur)
+		finally:
+			# Assuring the cursor is properly closed
+			cur.close()
+		
+		self.genes_by_symbol = MappingProxyType({ gene['symbol']: gene for gene in self.genes })
+		self.drugs_by_id = MappingProxyType({ drug['id']: drug for drug in self.drugs })
+		self._indexSmallTables()
+	
+	def _indexSmallTables(self):
+		self.studies_by_id = MappingProxyType({ study['id']: study for study in self.studies })
+		self.disease_groups_by_id = MappingProxyType({ dg['id']: dg for dg in self.disease_groups })
+		self.diseases_by_id = MappingProxyType({ disease['id']: disease for disease in self.diseases })
+		
+		diseases_by_group = {}
+		for disease in self.diseases:
+			diseases_by_group.setdefault(disease['disease_group_id'],[]).append(disease)
+		self.diseases_by_group = MappingProxyType({ dg_id: tuple(dg_diseases) for dg_id, dg_diseases in diseases_by_group.items() })
+	
+	@staticmethod
+	def _fetchAll(cur):
+		while True:
+			rows = cur.fetchmany()
+			if len(rows) == 0:
+				break
+			
+			yield from rows
+	
+	@staticmethod
+	def _formatGene(symbol,ensembl_id,uniprot_acc):
+		return {
+			'symbol': symbol,
+			'ensembl_id': ensembl_id,
+			'uniprot_acc': uniprot_acc
+		}
+	
+	@staticmethod
+	def _formatDrug(drug_id,name):
+		return {'id': drug_id,'name': name}
+	
+	@staticmethod
+	def _formatStudy(study_id):
+		return {'id': study_id,'source': 'GEO'  if study_id.startswith('GSE')  else 'ArrayExpress' }
+	
+	@staticmethod
+	def _formatDiseaseGroup(disease_group_id,name,properties):
+		disease_group = {
+			'id': disease_group_id,
+			'name': name
+		}
+		disease_group.update(json.loads(properties))
+		return disease_group
+	
+	@staticmethod
+	def _formatDisease(disease_id,name,disease_group_id,properties):
+		disease = {
+			'id': disease_id,
+			'name': name,
+			'disease_group_id': disease_group_id
+		}
+		disease.update(json.loads(properties))
+		return disease
+	
+	def _loadTableNames(self,cur):
+		cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+		return frozenset(map(lambda table: table[0],self._fetchAll(cur)))
+	
+	def _loadGenes(self,cur):
+		cur.execute('SELECT gene_symbol,ensembl_id,uniprot_id FROM gene')
+		return tuple(map(lambda gene: ReferenceSnapshot._formatGene(*gene),self._fetchAll(cur)))
+	
+	def _loadDrugs(self,cur):
+		cur.execute('SELECT id,name FROM drug')
+		return tuple(map(lambda drug: ReferenceSnapshot._formatDrug(*drug),self._fetchAll(cur)))
+	
+	def _loadStudies(self,cur):
+		cur.execute('SELECT geo_arrayexpress_code FROM study')
+		return tuple(map(lambda study: ReferenceSnapshot._formatStudy(study[0]),self._fetchAll(cur)))
+	
+	def _wideSource(self,table_name,subquery):
+		if table_name in self.tables:
+			return table_name
+		
+		return subquery
+	
+	def _loadDiseaseGroups(self,cur):
+		cur.execute('SELECT id,name,properties FROM {0} ORDER BY 1'.format(self._wideSource('disease_group_wide',self.DISEASE_GROUP_WIDE_SUBQUERY)))
+		return tuple(map(lambda dg: ReferenceSnapshot._formatDiseaseGroup(*dg),self._fetchAll(cur)))
+	
+	def _loadDiseases(self,cur):
+		cur.execute('SELECT id,name,disease_group_id,properties FROM {0} ORDER BY 1'.format(self._wideSource('disease_wide',self.DISEASE_WIDE_SUBQUERY)))
+		return tuple(map(lambda d: ReferenceSnapshot._formatDisease(*d),self._fetchAll(cur)))
+
+# This class gives the same view of the reference tables from a shared snapshot.
+# The genes and drugs, the largest tables, are built from the memory mapped
+# columns on access, so the workers do not keep their own copies
+class MappedReferenceSnapshot(ReferenceSnapshot):
+	def __init__(self,shared):
+		self.tables = shared.tables
+		self.genes = MappedRecords(self._formatGene,shared.column('gene.symbol'),shared.column('gene.ensembl_id'),shared.column('gene.uniprot_id'))
+		self.drugs = MappedRecords(self._formatDrug,shared.column('drug.id'),shared.column('drug.name'))
+		self.studies = tuple(map(self._formatStudy,shared.column('study.code')))
+		self.disease_groups = tuple(MappedRecords(self._formatDiseaseGroup,shared.column('disease_group.id'),shared.column('disease_group.name'),shared.column('disease_group.properties')))
+		self.diseases = tuple(MappedRecords(self._formatDisease,shared.column('disease.id'),shared.column('disease.name'),shared.column('disease.disease_group_id'),shared.column('disease.properties')))
+		
+		self.genes_by_symbol = SortedIndex(shared.column('gene.symbol'),shared.array('gene.by_symbol'),self.genes)
+		self.drugs_by_id = SortedIndex(shared.column('drug.id'),shared.array('drug.by_id'),self.drugs)
+		self._indexSmallTables()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+import json
+import logging
+import re
+import sqlite3
+import time
+
+from flask import g, request
+
+from .metrics import RequestProfile, count_bytes, set_current_profile
+
+SLOW_QUERY_LOGGER = 'disease_perception.slow_queries'
+
+def _milliseconds(seconds):
+	return round(seconds * 1000.0,3)
+
+NAMED_PARAMETER_PATTERN = re.compile(r'[:@$](\w+)')
+
+def _numBoundParameters(sql,parameters):
+	'''Named parameters dictionaries can hold more values than the statement uses'''
+	if isinstance(parameters,dict):
+		return len(set(NAMED_PARAMETER_PATTERN.findall(sql)) & parameters.keys())
+	
+	return len(parameters)
+
+# This class splits the time spent answering each API request in phases,
+# which are sent in the Server-Timing header:
+#   sql: executing the statements and fetching their rows in SQLite
+#   python: the rest of the time inside the query methods (grouping, formatting)
+#   marshal: the rest of the time of the resource (marshalling, serialization)
+#   compress: response post-processing (CORS and Flask-Compress)
+#   total: the whole request, until the headers are sent
+# The requests slower than the threshold are logged, along with their statements
+# and query plans. Streamed responses are logged once completely sent
+class RequestTiming(object):
+	def __init__(self,server_timing=True,slow_threshold_ms=None,slow_log=None):
+		self.server_timing = server_timing
+		self.cmn = None
+		self.slow_threshold = slow_threshold_ms / 1000.0  if slow_threshold_ms is not None  else None
+		
+		self.logger = logging.getLogger(SLOW_QUERY_LOGGER)
+		if self.slow_threshold is not None:
+			if slow_log is not None:
+				handler = logging.FileHandler(slow_log,encoding='utf-8')
+			elif not self.logger.hasHandlers():
+				handler = logging.StreamHandler()
+			else:
+				handler = None
+			if handler is not None:
+				handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+				self.logger.addHandler(handler)
+			self.logger.setLevel(logging.WARNING)
+	
+	@property
+	def enabled(self):
+		return self.server_timing or self.slow_threshold is not None
+	
+	def instrument_app(self,app):
+		'''It must be called before CORS and Flask-Compress are attached to the app,
+		so this after_request function is run after theirs'''
+		@app.after_request
+		def send_server_timing(response):
+			profile = g.get('request_profile')
+			if profile is None:
+				return response
+			
+			headers_time = time.perf_counter()
+			phases = self._phases(profile,headers_time)
+			if self.server_timing:
+				response.headers['Server-Timing'] = ', '.join('{};dur={}'.format(phase,_milliseconds(duration)) for phase, duration in phases)
+			
+			if self.slow_threshold is not None:
+				entry = {
+					'method': request.method,
+					'url': request.full_path  if request.query_string  else request.path,
+					'status': response.status_code,
+				}
+				sent = [ 0 ]
+				if response.is_streamed:
+					response.response = count_bytes(response.response,sent)
+				
+				def log_if_slow():
+					total = time.perf_counter() - profile.start
+					if total >= self.slow_threshold:
+						entry['total_ms'] = _milliseconds(total)
+						entry['bytes'] = sent[0]  if response.is_streamed  else response.content_length
+						entry['phases'] = { phase: _milliseconds(duration) for phase, duration in phases }
+						entry['statements'] = self._describeStatements(profile.statements)
+						self.logger.warning(json.dumps(entry))
+				
+				response.call_on_close(log_if_slow)
+			
+			return response
+	
+	def instrument_blueprint(self,blueprint,cmn):
+		'''The requests handled by the blueprint are profiled. The query plans
+		of the slow ones are obtained through the cmn database connection'''
+		self.cmn = cmn
+		
+		@blueprint.before_request
+		def start_request_profile():
+			profile = RequestProfile(keep_statements=self.slow_threshold is not None)
+			g.request_profile = profile
+			# Streamed responses keep fetching rows after the request context is gone
+			set_current_profile(profile)
+		
+		@blueprint.after_request
+		def end_request_view(response):
+			profile = g.get('request_profile')
+			if profile is not None:
+				profile.view_end = time.perf_counter()
+			
+			return response
+	
+	@staticmethod
+	def _phases(profile,headers_time):
+		view_end = profile.view_end  if profile.view_end is not None  else headers_time
+		view_time = view_end - profile.start
+		query_time = min(profile.query_time,view_time)
+		sql_time = min(profile.sql_time,query_time)
+		return [
+			('sql', sql_time),
+			('python', query_time - sql_time),
+			('marshal', view_time - query_time),
+			('compress', headers_time - view_end),
+			('total', headers_time - profile.start),
+		]
+	
+	def _explain(self,sql,parameters):
+		try:
+			return [ row[3] for row in self.cmn.db.execute('EXPLAIN QUERY PLAN ' + sql,parameters) ]
+		except sqlite3.Error:
+			return None
+	
+	def _describeStatements(self,statements):
+		'''The bound values are not logged, only how many there were'''
+		return [
+			{
+				'sql': statement['sql'],
+				'num_parameters': _numBoundParameters(statement['sql'],statement['parameters']),
+				'rows': statement['rows'],
+				'ms': _milliseconds(statement['seconds']),
+				'plan': self._explain(statement['sql'],statement['parameters'])
+			}
+			for statement in statements
+		]
@@ -3,14 +3,211 @@
 # coding: utf-8
 
 import sys, os
+import functools
+import itertools
+import urllib.parse
 
-from flask_restx import Namespace, Api, Resource, fields
+from flask import request, Response
+from flask_restx import Namespace, Api, Resource, fields, inputs, reqparse
+
+from .model_encoder import ModelEncoder
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+# Streamed lines are sent in chunks of (at least) this size
+STREAM_CHUNK_SIZE = 65536
 
 class CMResource(Resource):
 	'''This class eases passing the instance of the comorbidity network query API'''
 	def __init__(self,api=None,*args,**kwargs):
 		super().__init__(api,*args,**kwargs)
 		self.cmn = kwargs['cmnetwork']
+		self.bodies = kwargs.get('bodies')
+	
+	@property
+	def streaming(self):
+		'''Streaming is requested either through ?stream=1 or through Accept: application/x-ndjson'''
+		if request.args.get('stream','').lower() in ('1','true','yes'):
+			return True
+		
+		return request.accept_mimetypes.best_match(['application/json',NDJSON_MIMETYPE]) == NDJSON_MIMETYPE
+
+def streamable_list_with(ns,model,description='Success'):
+	'''Like marshal_list_with, but when the decorated method returns an iterator
+	instead of a list, each element is encoded and sent as soon as it is
+	produced, as newline delimited JSON. Already serialized results
+	(bytes) are sent as they are'''
+	encoder = ModelEncoder(model)
+	
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(self,*args,**kwargs):
+			res = func(self,*args,**kwargs)
+			if isinstance(res,bytes):
+				return Response(res,mimetype='application/json')
+			
+			if isinstance(res,(list,tuple)):
+				return Response(encoder.dumps(res),mimetype='application/json')
+			
+			# The first element is fetched before the response starts,
+			# so validation and not found errors are properly reported
+			res = iter(res)
+			first = next(res,None)
+			
+			def generate():
+				if first is None:
+					return
+				
+				chunk = []
+				chunk_size = 0
+				for elem in itertools.chain((first,),res):
+					line = encoder.dumps(elem) + b'\n'
+					chunk.append(line)
+					chunk_size += len(line)
+					if chunk_size >= STREAM_CHUNK_SIZE:
+						yield b''.join(chunk)
+						chunk = []
+						chunk_size = 0
+				
+				if len(chunk) > 0:
+					yield b''.join(chunk)
+			
+			return Response(generate(),mimetype=NDJSON_MIMETYPE)
+		
+		stream_param = {
+			'stream': {
+				'description': 'When true, the results are streamed as newline delimited JSON (also through Accept: {})'.format(NDJSON_MIMETYPE),
+				'in': 'query',
+				'type': 'boolean'
+			}
+		}
+		return ns.doc(params=stream_param)(ns.response(200,description,[model])(wrapper))
+	
+	return decorator
+
+def encoded_list_with(ns,model,description='Success'):
+	'''Like marshal_list_with, but the list is serialized through the compiled model encoder'''
+	encoder = ModelEncoder(model)
+	
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(self,*args,**kwargs):
+			return Response(encoder.dumps(func(self,*args,**kwargs)),mimetype='application/json')
+		
+		return ns.response(200,description,[model])(wrapper)
+	
+	return decorator
+
+# Keyset pagination parameters. The cursor is the primary key of the last
+# entry from the previous page, and it is given in the 'next' Link header
+DEFAULT_PAGE_LIMIT = 1000
+MAX_PAGE_LIMIT = 10000
+
+page_parser = reqparse.RequestParser()
+page_parser.add_argument('limit',type=inputs.int_range(1,MAX_PAGE_LIMIT),location='args',help='The maximum number of entries of the page (up to {})'.format(MAX_PAGE_LIMIT))
+page_parser.add_argument('after',type=int,location='args',help='The cursor returned in the next Link of the previous page')
+
+# Parameters of the comorbidity network queries
+MAX_NEIGHBOURHOOD_HOPS = 5
+MAX_TOP_COMORBIDITIES = 10000
+
+neighbourhood_parser = reqparse.RequestParser()
+neighbourhood_parser.add_argument('hops',type=inputs.int_range(1,MAX_NEIGHBOURHOOD_HOPS),default=1,location='args',help='The maximum number of comorbidities between the disease and the reached ones (up to {})'.format(MAX_NEIGHBOURHOOD_HOPS))
+neighbourhood_parser.add_argument('min_rr',type=float,location='args',help='Only the comorbidities with at least this relative risk are followed')
+
+top_comorbidities_parser = reqparse.RequestParser()
+top_comorbidities_parser.add_argument('k',type=inputs.int_range(1,MAX_TOP_COMORBIDITIES),default=10,location='args',help='The number of comorbidities with the highest relative risk (up to {})'.format(MAX_TOP_COMORBIDITIES))
+
+subgraph_parser = reqparse.RequestParser()
+subgraph_parser.add_argument('min_rr',type=float,required=True,location='args',help='The minimum relative risk')
+subgraph_parser.add_argument('max_rr',type=float,location='args',help='The maximum relative risk')
+
+# Relative risk thresholding and ordering, evaluated by the database
+rel_risk_parser = reqparse.RequestParser()
+rel_risk_parser.add_argument('min_rr',type=float,location='args',help='The minimum relative risk (not combinable with after)')
+rel_risk_parser.add_argument('max_rr',type=float,location='args',help='The maximum relative risk (not combinable with after)')
+rel_risk_parser.add_argument('order',choices=('rr_desc','rr_asc'),location='args',help='Sort the comorbidities by relative risk (not combinable with after)')
+
+rel_risk_limit_parser = rel_risk_parser.copy()
+rel_risk_limit_parser.add_argument('limit',type=inputs.int_range(1,MAX_PAGE_LIMIT),location='args',help='The maximum number of comorbidities (up to {}). Along with the relative risk parameters, it truncates the answer instead of paginating it'.format(MAX_PAGE_LIMIT))
+
+def rel_risk_filtered_list_with(ns,model,description='Success'):
+	'''When any of the relative risk parameters is provided, the decorated list
+	method is bypassed, and the thresholded comorbidities are fetched through
+	disease_comorbidities. The limit parameter is then applied to them, instead
+	of being used for keyset pagination, so the after cursor is rejected'''
+	encoder = ModelEncoder(model)
+	filter_names = [ arg.name for arg in rel_risk_parser.args ]
+	
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(self,*args,**kwargs):
+			if not any(name in request.args for name in filter_names):
+				return func(self,*args,**kwargs)
+			
+			if 'after' in request.args:
+				ns.abort(400,"The after cursor cannot be combined with the relative risk parameters ({})".format(', '.join(filter_names)))
+			
+			rr_args = rel_risk_limit_parser.parse_args()
+			return Response(encoder.dumps(self.cmn.disease_comorbidities(**rr_args)),mimetype='application/json')
+		
+		return ns.expect(rel_risk_parser)(ns.response(200,description,[model])(wrapper))
+	
+	return decorator
+
+# Parameters of the similarity queries
+MAX_SIMILAR_K = 1000
+
+similarity_parser = reqparse.RequestParser()
+similarity_parser.add_argument('k',type=inputs.int_range(1,MAX_SIMILAR_K),default=10,location='args',help='The number of most similar entries (up to {})'.format(MAX_SIMILAR_K))
+similarity_parser.add_argument('metric',choices=('jaccard','cosine'),default='jaccard',location='args',help='Jaccard index over the (item, regulation sign) pairs, or cosine of the signed regulation vectors')
+similarity_parser.add_argument('based_on',choices=('genes','drugs','all'),default='all',location='args',help='The items being compared')
+
+def paginated_list_with(ns,model,page_method,description='Success'):
+	'''When either limit or after query parameters are provided, the decorated
+	list method is bypassed, and only the requested window is fetched through
+	the page_method of the comorbidities network instance'''
+	encoder = ModelEncoder(model)
+	
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(self,*args,**kwargs):
+			if 'limit' not in request.args and 'after' not in request.args:
+				return func(self,*args,**kwargs)
+			
+			page_args = page_parser.parse_args()
+			limit = page_args['limit']  if page_args['limit'] is not None  else DEFAULT_PAGE_LIMIT
+			page, next_after = getattr(self.cmn,page_method)(limit,page_args['after'])
+			
+			resp = Response(encoder.dumps(page),mimetype='application/json')
+			if next_after is not None:
+				next_query = urllib.parse.urlencode({'limit': limit,'after': next_after})
+				resp.headers['Link'] = '<{}?{}>; rel="next"'.format(request.base_url,next_query)
+			
+			return resp
+		
+		return ns.expect(page_parser)(ns.response(200,description,[model])(wrapper))
+	
+	return decorator
+
+def precomputed_list_with(ns,model,description='Success'):
+	'''Like marshal_list_with, but the marshalled list is serialized and compressed
+	only once per database version, and it is served with a strong ETag'''
+	encoder = ModelEncoder(model)
+	
+	def decorator(func):
+		key = func.__qualname__
+		
+		@functools.wraps(func)
+		def wrapper(self,*args,**kwargs):
+			def producer():
+				return encoder.dumps(func(self,*args,**kwargs))
+			
+			return self.bodies.get(key,producer).response(request)
+		
+		return ns.response(200,description,[model])(wrapper)
+	
+	return decorator
 
 
 
@@ -138,7 +335,15 @@ disease_model = DISEASE_NS.model('Disease', {
 disease_comorbidity_model = DISEASE_NS.model('DiseaseComorbidity', {
 	'from_id': fields.Integer(required=True, description = 'The internal id of the disease A (from)'),
 	'to_id': fields.Integer(required=True, description = 'The internal id of the disease B (to)'),
-	'rel_risk': fields.Float(required=True, description = 'The relative risk of comorbidity')
+	'rel_risk': fields.Float(required=True, description = 'The relative risk of comorbidity'),
+	'appears_in': fields.String(description = 'The space separated studies where this comorbidity was reported')
+})
+
+disease_comorbidity_path_model = DISEASE_NS.model('DiseaseComorbidityPath', {
+	'from_id': fields.Integer(required=True, description = 'The internal id of the disease where the path starts'),
+	'to_id': fields.Integer(required=True, description = 'The internal id of the disease where the path ends'),
+	'distance': fields.Float(required=True, description = 'The sum of the inverse of the relative risks of the comorbidities in the path'),
+	'comorbidities': fields.List(fields.Nested(disease_comorbidity_model), required=True, description = 'The comorbidities in the path, in order')
 })
 
 disease_patient_subgroup_comorbidity_model = DISEASE_NS.model('DiseasePatientSubgroupComorbidity', {
@@ -232,6 +437,18 @@ patient_map_genes_model = PATIENT_NS.model('PatientMapGenes',{
 })
 
 
+patient_subgroup_similarity_model = PATIENT_NS.model('PatientSubgroupSimilarity',{
+	'patient_subgroup_id': fields.Integer(required=True, description = 'The internal id of the similar patient subgroup'),
+	'similarity': fields.Float(required=True, description = 'The similarity to the queried patient subgroup'),
+	'shared': fields.Integer(required=True, description = 'The number of genes and drugs shared with the queried patient subgroup, with the same regulation sign')
+})
+
+patient_similarity_model = PATIENT_NS.model('PatientSimilarity',{
+	'patient_id': fields.Integer(required=True, description = 'The internal id of the similar patient'),
+	'similarity': fields.Float(required=True, description = 'The similarity to the queried patient'),
+	'shared': fields.Integer(required=True, description = 'The number of genes and drugs shared with the queried patient, with the same regulation sign')
+})
+
 patient_map_drugs_model = PATIENT_NS.model('PatientMapDrugs',{
 	'patient_id': fields.Integer(required=True, description = 'The internal id of the patient'),
 	'drugs': fields.List(fields.Nested(map_drugs_model), required=True, description = 'The list of drugs with common behavior in this patient')
@@ -4,12 +4,12 @@
 
 import sys, os
 
-from .api_models import CMResource, DISEASE_NS, disease_model, disease_comorbidity_model, disease_patient_subgroup_comorbidity_model, simple_disease_group_model, disease_group_model, patient_subgroup_intersect_genes_model, patient_subgroup_intersect_drugs_model
+from .api_models import CMResource, encoded_list_with, paginated_list_with, precomputed_list_with, rel_risk_filtered_list_with, rel_risk_limit_parser, streamable_list_with, DISEASE_NS, disease_model, disease_comorbidity_model, disease_comorbidity_path_model, neighbourhood_parser, top_comorbidities_parser, subgraph_parser, disease_patient_subgroup_comorbidity_model, simple_disease_group_model, disease_group_model, patient_subgroup_intersect_genes_model, patient_subgroup_intersect_drugs_model
 
 class DiseaseList(CMResource):
 	'''Shows a list of all the diseases'''
 	@DISEASE_NS.doc('list_diseases')
-	@DISEASE_NS.marshal_list_with(disease_model)
+	@precomputed_list_with(DISEASE_NS,disease_model)
 	def get(self):
 		'''List all the diseases present in the comorbidity network'''
 		return self.cmn.diseases()
@@ -27,7 +27,9 @@ class Disease(CMResource):
 class ListDiseaseComorbidities(CMResource):
 	'''Return the comorbidities network'''
 	@DISEASE_NS.doc('disease_comorbidities_network')
-	@DISEASE_NS.marshal_list_with(disease_comorbidity_model)
+	@rel_risk_filtered_list_with(DISEASE_NS,disease_comorbidity_model)
+	@paginated_list_with(DISEASE_NS,disease_comorbidity_model,'disease_comorbidities_page')
+	@precomputed_list_with(DISEASE_NS,disease_comorbidity_model)
 	def get(self):
 		'''It lists disease comorbidities network'''
 		return self.cmn.disease_comorbidities()
@@ -37,31 +39,99 @@ class ListDiseaseComorbidities(CMResource):
 class DiseaseComorbidities(CMResource):
 	'''Return the comorbidities of a disease'''
 	@DISEASE_NS.doc('disease_comorbidities')
-	@DISEASE_NS.marshal_list_with(disease_comorbidity_model)
+	@DISEASE_NS.expect(rel_risk_limit_parser)
+	@streamable_list_with(DISEASE_NS,disease_comorbidity_model)
 	def get(self,id):
 		'''It lists disease comorbidities information'''
-		return self.cmn.disease_comorbidities(id)
+		rr_args = rel_risk_limit_parser.parse_args()
+		if self.streaming:
+			return self.cmn.iter_disease_comorbidities(id,**rr_args)
+		
+		return self.cmn.disease_comorbidities(id,**rr_args)
 
 @DISEASE_NS.response(400, 'The number of different disease ids must be at least two')
+@DISEASE_NS.response(404, 'Disease not found or with no known comorbidity')
+@DISEASE_NS.param('id', 'The disease id')
+class DiseaseComorbidityNeighbourhood(CMResource):
+	'''Return the comorbidities among the diseases reachable from a disease'''
+	@DISEASE_NS.doc('disease_comorbidities_neighbourhood')
+	@DISEASE_NS.expect(neighbourhood_parser)
+	@encoded_list_with(DISEASE_NS,disease_comorbidity_model)
+	def get(self,id):
+		'''It lists the comorbidities among the diseases reachable in at most the given hops, in any direction'''
+		args = neighbourhood_parser.parse_args()
+		return self.cmn.disease_comorbidities_neighbourhood(id,args['hops'],args['min_rr'])
+
+@DISEASE_NS.response(404, 'Disease not found or with no known comorbidity')
+@DISEASE_NS.param('id', 'The disease id')
+class DiseaseTopComorbidities(CMResource):
+	'''Return the comorbidities of a disease with the highest relative risk'''
+	@DISEASE_NS.doc('disease_top_comorbidities')
+	@DISEASE_NS.expect(top_comorbidities_parser)
+	@encoded_list_with(DISEASE_NS,disease_comorbidity_model)
+	def get(self,id):
+		'''It lists the comorbidities of the disease, by decreasing relative risk'''
+		args = top_comorbidities_parser.parse_args()
+		return self.cmn.top_disease_comorbidities(args['k'],id)
+
+class TopComorbidities(CMResource):
+	'''Return the comorbidities with the highest relative risk'''
+	@DISEASE_NS.doc('top_comorbidities')
+	@DISEASE_NS.expect(top_comorbidities_parser)
+	@encoded_list_with(DISEASE_NS,disease_comorbidity_model)
+	def get(self):
+		'''It lists the comorbidities of the network, by decreasing relative risk'''
+		args = top_comorbidities_parser.parse_args()
+		return self.cmn.top_disease_comorbidities(args['k'])
+
+class ComorbiditiesSubgraph(CMResource):
+	'''Return the comorbidities within a relative risk range'''
+	@DISEASE_NS.doc('comorbidities_subgraph')
+	@DISEASE_NS.expect(subgraph_parser)
+	@encoded_list_with(DISEASE_NS,disease_comorbidity_model)
+	def get(self):
+		'''It lists the comorbidities whose relative risk is within the range, by decreasing relative risk'''
+		args = subgraph_parser.parse_args()
+		return self.cmn.disease_comorbidities_subgraph(args['min_rr'],args['max_rr'])
+
+@DISEASE_NS.response(404, 'Disease not found, or no path between the diseases')
+@DISEASE_NS.param('from_id', 'The id of the disease where the path starts')
+@DISEASE_NS.param('to_id', 'The id of the disease where the path ends')
+class DiseaseComorbidityPath(CMResource):
+	'''Return the strongest comorbidity path between two diseases'''
+	@DISEASE_NS.doc('disease_comorbidity_path')
+	@DISEASE_NS.marshal_with(disease_comorbidity_path_model)
+	def get(self,from_id,to_id):
+		'''It gets the path of comorbidities minimizing the sum of the inverse of their relative risks'''
+		return self.cmn.disease_comorbidity_path(from_id,to_id)
+
 @DISEASE_NS.response(404, 'No disease found or with no known patient subgroup comorbidity')
 @DISEASE_NS.param('disease_ids', 'The disease ids (at least, two), separated by commas')
 @DISEASE_NS.param('min_size', 'The minimum size of the subgroups')
 class DiseasePatientSubgroupComorbidities(CMResource):
 	'''Return the comorbidities of the patient subgroups of a couple of diseases'''
 	@DISEASE_NS.doc('disease_ps_comorbidities')
-	@DISEASE_NS.marshal_list_with(disease_patient_subgroup_comorbidity_model)
+	@DISEASE_NS.expect(rel_risk_limit_parser)
+	@streamable_list_with(DISEASE_NS,disease_patient_subgroup_comorbidity_model)
 	def get(self,disease_ids,min_size=None):
 		'''It lists disease comorbidities information'''
-		return self.cmn.diseases_patient_subgroups_comorbidities(disease_ids,min_size)
+		rr_args = rel_risk_limit_parser.parse_args()
+		if self.streaming:
+			return self.cmn.iter_diseases_patient_subgroups_comorbidities(disease_ids,min_size,**rr_args)
+		
+		return self.cmn.diseases_patient_subgroups_comorbidities(disease_ids,min_size,**rr_args)
 
 @DISEASE_NS.response(404, 'No disease found or with no known patient subgroup comorbidity')
 @DISEASE_NS.param('disease_ids', 'The disease ids (at least, two), separated by commas')
 class DiseasePatientSubgroupIntersectGenes(CMResource):
 	'''Return the genes which intersect with the patient subgroups from the diseases'''
 	@DISEASE_NS.doc('disease_ps_genes')
-	@DISEASE_NS.marshal_list_with(patient_subgroup_intersect_genes_model)
+	@streamable_list_with(DISEASE_NS,patient_subgroup_intersect_genes_model)
 	def get(self,disease_ids):
 		'''It gets the intersected genes for each patient subgroup related to the input diseases'''
+		if self.streaming:
+			return self.cmn.iter_patient_subgroup_intersect_genes(disease_ids=disease_ids)
+		
 		return self.cmn.patient_subgroup_intersect_genes(disease_ids=disease_ids)
 
 @DISEASE_NS.response(404, 'No disease found or with no known patient subgroup comorbidity')
@@ -69,16 +139,19 @@ class DiseasePatientSubgroupIntersectGenes(CMResource):
 class DiseasePatientSubgroupIntersectDrugs(CMResource):
 	'''Return the drugs which intersect with the patient subgroups from the diseases'''
 	@DISEASE_NS.doc('disease_ps_drugs')
-	@DISEASE_NS.marshal_list_with(patient_subgroup_intersect_drugs_model)
+	@streamable_list_with(DISEASE_NS,patient_subgroup_intersect_drugs_model)
 	def get(self,disease_ids):
 		'''It gets the intersected drugs for each patient subgroup related to the input diseases'''
+		if self.streaming:
+			return self.cmn.iter_patient_subgroup_intersect_drugs(disease_ids=disease_ids)
+		
 		return self.cmn.patient_subgroup_intersect_drugs(disease_ids=disease_ids)
 
 
 class DiseaseGroupList(CMResource):
 	'''Shows a list of all the disease groups'''
 	@DISEASE_NS.doc('list_disease_groups')
-	@DISEASE_NS.marshal_list_with(disease_group_model)
+	@precomputed_list_with(DISEASE_NS,disease_group_model)
 	def get(self):
 		'''List all the disease groups present in the comorbidity network'''
 		return self.cmn.disease_groups()
@@ -110,7 +183,12 @@ ROUTES={
 		(DiseaseList,''),
 		(Disease,'/<int:id>'),
 		(DiseaseComorbidities,'/<int:id>/comorbidities'),
+		(DiseaseComorbidityNeighbourhood,'/<int:id>/comorbidities/neighbourhood'),
+		(DiseaseTopComorbidities,'/<int:id>/comorbidities/top'),
+		(DiseaseComorbidityPath,'/<int:from_id>/comorbidities/path/<int:to_id>'),
 		(ListDiseaseComorbidities,'/comorbidities'),
+		(TopComorbidities,'/comorbidities/top'),
+		(ComorbiditiesSubgraph,'/comorbidities/subgraph'),
 		(DiseasePatientSubgroupComorbidities,'/<list(int,sep=","):disease_ids>/patients/subgroups/comorbidities'),
 		(DiseasePatientSubgroupComorbidities,'/<list(int,sep=","):disease_ids>/patients/subgroups/comorbidities/min_size/<int:min_size>'),
 		(DiseasePatientSubgroupIntersectGenes,'/<list(int,sep=","):disease_ids>/patients/subgroups/genes'),
@@ -4,12 +4,13 @@
 
 import sys, os
 
-from .api_models import CMResource, DRUGS_NS, drug_model
+from .api_models import CMResource, paginated_list_with, precomputed_list_with, DRUGS_NS, drug_model
 
 class DrugList(CMResource):
 	'''Shows a list of all the drugs related in comorbidity studies'''
 	@DRUGS_NS.doc('list_drugs')
-	@DRUGS_NS.marshal_list_with(drug_model)
+	@paginated_list_with(DRUGS_NS,drug_model,'drugs_page')
+	@precomputed_list_with(DRUGS_NS,drug_model)
 	def get(self):
 		'''List all drugs involved in the different studies'''
 		return self.cmn.drugs()
@@ -4,14 +4,15 @@
 
 import sys, os
 
-from .api_models import CMResource, GENES_NS, gene_model
+from .api_models import CMResource, paginated_list_with, precomputed_list_with, GENES_NS, gene_model
 
 # Now, the routes
 #@GENES_NS.route('',resource_class_kwargs={'cmnetwork': CMNetwork})
 class GeneList(CMResource):
 	'''Shows a list of all the genes related in comorbidities'''
 	@GENES_NS.doc('list_genes')
-	@GENES_NS.marshal_list_with(gene_model)
+	@paginated_list_with(GENES_NS,gene_model,'genes_page')
+	@precomputed_list_with(GENES_NS,gene_model)
 	def get(self):
 		'''List all genes'''
 		#return CMNetwork.genes()
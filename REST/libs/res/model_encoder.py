@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+import json
+
+from flask_restx import fields
+
+# orjson is an optional dependency. When it is not available,
+# the standard json module is used
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+def dumps(data):
+	'''It serializes the data as compact JSON bytes, through orjson (declared in
+	requirements.txt). When it is not installed, the slower standard json module
+	builds the same documents'''
+	if orjson is not None:
+		return orjson.dumps(data)
+	
+	return json.dumps(data,separators=(',',':')).encode('utf-8')
+
+def _scalarConverter(type_,default):
+	if default is None:
+		return lambda value: value  if value is None or value.__class__ is type_  else type_(value)
+	
+	return lambda value: type_(default)  if value is None  else (value  if value.__class__ is type_  else type_(value))
+
+# This class compiles a flask_restx model into a single function, which
+# builds the same dictionaries (keys, key order and value types) as
+# marshal does, without its field by field machinery. The models are
+# still the ones documented through Swagger
+class ModelEncoder(object):
+	SCALARS = (
+		(fields.Integer, int),
+		(fields.Float, float),
+		(fields.String, str),
+		(fields.Boolean, bool),
+	)
+	
+	def __init__(self,model):
+		self.model = model
+		
+		namespace = {}
+		entries = []
+		for i, (key, field) in enumerate(model.items()):
+			if isinstance(field,type):
+				field = field()
+			
+			converter_name = 'c{}'.format(i)
+			converter, plain = self._fieldConverter(key,field)
+			namespace[converter_name] = converter
+			# Fields with their own attribute or unknown kinds get the whole object
+			if plain:
+				entries.append('{!r}: {}(get({!r}))'.format(key,converter_name,key))
+			else:
+				entries.append('{!r}: {}(obj)'.format(key,converter_name))
+		
+		source = 'def encode(obj):\n\tget = obj.get\n\treturn {{{}}}\n'.format(', '.join(entries))
+		exec(compile(source,'<encoder {}>'.format(model.name),'exec'),namespace)
+		self.encode = namespace['encode']
+	
+	def _fieldConverter(self,key,field):
+		'''It returns the converter of the field, and whether it is applied
+		to the value of the key instead of the whole object'''
+		if field.attribute is None:
+			if isinstance(field,fields.List) and isinstance(field.container,fields.Nested):
+				nested_encode = ModelEncoder(field.container.nested).encode
+				default = field.default
+				return (lambda value: default  if value is None  else [ nested_encode(elem) for elem in value ]), True
+			
+			if isinstance(field,fields.Nested) and not field.as_list:
+				nested_encode = ModelEncoder(field.nested).encode
+				allow_null = field.allow_null
+				return (lambda value: None  if value is None and allow_null  else nested_encode(value  if value is not None  else {})), True
+			
+			for field_type, type_ in self.SCALARS:
+				if isinstance(field,field_type):
+					return _scalarConverter(type_,field.default), True
+		
+		# Any other kind of field is delegated to flask_restx
+		return (lambda obj: field.output(key,obj)), False
+	
+	def encode_list(self,data):
+		encode = self.encode
+		return [ encode(elem) for elem in data ]
+	
+	def dumps(self,data):
+		'''It serializes either an entry or a list of entries'''
+		if isinstance(data,(list,tuple)):
+			return dumps(self.encode_list(data))
+		
+		return dumps(self.encode(data))
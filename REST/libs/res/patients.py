@@ -4,14 +4,19 @@
 
 import sys, os
 
-from .api_models import CMResource, PATIENT_NS, patient_model, patient_subgroup_model, patient_subgroup_intersect_genes_model, patient_subgroup_intersect_drugs_model, patient_map_genes_model, patient_map_drugs_model, patients_interaction_model
+from ..entity_sets import SET_OPERATIONS
+from .api_models import CMResource, paginated_list_with, precomputed_list_with, streamable_list_with, PATIENT_NS, patient_model, patient_subgroup_model, patient_subgroup_intersect_genes_model, patient_subgroup_intersect_drugs_model, patient_map_genes_model, patient_map_drugs_model, patients_interaction_model, intersect_genes_model, intersect_drugs_model, patient_subgroup_similarity_model, patient_similarity_model, similarity_parser
 
 class PatientList(CMResource):
 	'''Shows a list of all the patient subgroups'''
 	@PATIENT_NS.doc('list_patients')
-	@PATIENT_NS.marshal_list_with(patient_model)
+	@paginated_list_with(PATIENT_NS,patient_model,'patients_page')
+	@streamable_list_with(PATIENT_NS,patient_model)
 	def get(self):
 		'''List all the patients present in the comorbidity network'''
+		if self.streaming:
+			return self.cmn.iter_patients()
+		
 		return self.cmn.patients()
 
 @PATIENT_NS.response(404, 'Patient not found')
@@ -29,9 +34,12 @@ class Patient(CMResource):
 class PatientsMapGenes(CMResource):
 	'''Return the list of genes which map with the queried patients'''
 	@PATIENT_NS.doc('patient_genes')
-	@PATIENT_NS.marshal_list_with(patient_map_genes_model)
+	@streamable_list_with(PATIENT_NS,patient_map_genes_model)
 	def get(self,ids):
 		'''It gets the mapped genes for each queried patient'''
+		if self.streaming:
+			return self.cmn.iter_patient_map_genes(patient_ids=ids)
+		
 		return self.cmn.patient_map_genes(patient_ids=ids)
 
 @PATIENT_NS.response(400, 'The number of different patient ids must be at least two')
@@ -40,9 +48,12 @@ class PatientsMapGenes(CMResource):
 class PatientsMapDrugs(CMResource):
 	'''Return the list of drugs which map with the queried patients'''
 	@PATIENT_NS.doc('patient_drugs')
-	@PATIENT_NS.marshal_list_with(patient_map_drugs_model)
+	@streamable_list_with(PATIENT_NS,patient_map_drugs_model)
 	def get(self,ids):
 		'''It gets the mapped drugs for each queried patient'''
+		if self.streaming:
+			return self.cmn.iter_patient_map_drugs(patient_ids=ids)
+		
 		return self.cmn.patient_map_drugs(patient_ids=ids)
 
 @PATIENT_NS.response(404, 'No patient was found')
@@ -50,15 +61,19 @@ class PatientsMapDrugs(CMResource):
 class PatientsInteraction(CMResource):
 	'''Return the interactions among the queried patients'''
 	@PATIENT_NS.doc('patients_interaction')
-	@PATIENT_NS.marshal_list_with(patients_interaction_model)
+	@streamable_list_with(PATIENT_NS,patients_interaction_model)
 	def get(self,ids):
 		'''It gets the interactions among the queried patients'''
+		if self.streaming:
+			return self.cmn.iter_patients_interactions(patient_ids=ids)
+		
 		return self.cmn.patients_interactions(patient_ids=ids)
 
 class PatientSubgroupList(CMResource):
 	'''Shows a list of all the patient subgroups'''
 	@PATIENT_NS.doc('list_patient_subgroups')
-	@PATIENT_NS.marshal_list_with(patient_subgroup_model)
+	@paginated_list_with(PATIENT_NS,patient_subgroup_model,'patient_subgroups_page')
+	@precomputed_list_with(PATIENT_NS,patient_subgroup_model)
 	def get(self):
 		'''List all the patient subgroups present in the comorbidity network'''
 		return self.cmn.patient_subgroups()
@@ -78,9 +93,12 @@ class PatientSubgroup(CMResource):
 class PatientSubgroupPatients(CMResource):
 	'''Return the list of patients in a patient subgroup'''
 	@PATIENT_NS.doc('patient_subgroup_list')
-	@PATIENT_NS.marshal_list_with(patient_model)
+	@streamable_list_with(PATIENT_NS,patient_model)
 	def get(self,id):
 		'''It gets the list of patients in this subgroup'''
+		if self.streaming:
+			return self.cmn.iter_patients(patient_subgroup_id=id)
+		
 		return self.cmn.patients(patient_subgroup_id=id)
 
 @PATIENT_NS.response(404, 'No patient subgroup was found')
@@ -88,9 +106,12 @@ class PatientSubgroupPatients(CMResource):
 class PatientSubgroupsIntersectGenes(CMResource):
 	'''Return the list of genes which intersect with the queried patient subgroups'''
 	@PATIENT_NS.doc('patient_subgroup_genes')
-	@PATIENT_NS.marshal_list_with(patient_subgroup_intersect_genes_model)
+	@streamable_list_with(PATIENT_NS,patient_subgroup_intersect_genes_model)
 	def get(self,ids):
 		'''It gets the intersected genes for each patient subgroup'''
+		if self.streaming:
+			return self.cmn.iter_patient_subgroup_intersect_genes(patient_subgroup_ids=ids)
+		
 		return self.cmn.patient_subgroup_intersect_genes(patient_subgroup_ids=ids)
 
 @PATIENT_NS.response(404, 'No patient subgroup was found')
@@ -98,9 +119,12 @@ class PatientSubgroupsIntersectGenes(CMResource):
 class PatientSubgroupsIntersectDrugs(CMResource):
 	'''Return the list of drugs which intersect with the queried patient subgroups'''
 	@PATIENT_NS.doc('patient_subgroup_drugs')
-	@PATIENT_NS.marshal_list_with(patient_subgroup_intersect_drugs_model)
+	@streamable_list_with(PATIENT_NS,patient_subgroup_intersect_drugs_model)
 	def get(self,ids):
 		'''It gets the intersected drugs for each patient subgroup'''
+		if self.streaming:
+			return self.cmn.iter_patient_subgroup_intersect_drugs(patient_subgroup_ids=ids)
+		
 		return self.cmn.patient_subgroup_intersect_drugs(patient_subgroup_ids=ids)
 
 @PATIENT_NS.response(404, 'No patient subgroup was found')
@@ -108,9 +132,12 @@ class PatientSubgroupsIntersectDrugs(CMResource):
 class PatientSubgroupPatientsMapGenes(CMResource):
 	'''Return the list of genes which map with the patients from the queried patient subgroups'''
 	@PATIENT_NS.doc('patient_genes')
-	@PATIENT_NS.marshal_list_with(patient_map_genes_model)
+	@streamable_list_with(PATIENT_NS,patient_map_genes_model)
 	def get(self,ids):
 		'''It gets the mapped genes for each patient of the query patient subgroup'''
+		if self.streaming:
+			return self.cmn.iter_patient_map_genes(patient_subgroup_ids=ids)
+		
 		return self.cmn.patient_map_genes(patient_subgroup_ids=ids)
 
 @PATIENT_NS.response(404, 'No patient subgroup was found')
@@ -118,9 +145,12 @@ class PatientSubgroupPatientsMapGenes(CMResource):
 class PatientSubgroupPatientsMapDrugs(CMResource):
 	'''Return the list of drugs which map with the patients from the queried patient subgroups'''
 	@PATIENT_NS.doc('patient_drugs')
-	@PATIENT_NS.marshal_list_with(patient_map_drugs_model)
+	@streamable_list_with(PATIENT_NS,patient_map_drugs_model)
 	def get(self,ids):
 		'''It gets the mapped drugs for each patient of the query patient subgroup'''
+		if self.streaming:
+			return self.cmn.iter_patient_map_drugs(patient_subgroup_ids=ids)
+		
 		return self.cmn.patient_map_drugs(patient_subgroup_ids=ids)
 
 @PATIENT_NS.response(404, 'No patient subgroup was found')
@@ -128,28 +158,107 @@ class PatientSubgroupPatientsMapDrugs(CMResource):
 class PatientSubgroupPatientsInteraction(CMResource):
 	'''Return the interactions among the patients from the queried patient subgroups'''
 	@PATIENT_NS.doc('patient_interactions')
-	@PATIENT_NS.marshal_list_with(patients_interaction_model)
+	@streamable_list_with(PATIENT_NS,patients_interaction_model)
 	def get(self,ids):
 		'''It gets the interactions among the patients of the query patient subgroup'''
+		if self.streaming:
+			return self.cmn.iter_patients_interactions(patient_subgroup_ids=ids)
+		
 		return self.cmn.patients_interactions(patient_subgroup_ids=ids)
 
+SET_OPERATION_DESCRIPTION = 'The set operation: intersection, union or difference (the elements of the first id which are not in the other ones). Each element is a (drug or gene, regulation sign) pair'
+
+@PATIENT_NS.response(404, 'No patient was found')
+@PATIENT_NS.param('ids', 'The patient id(s), separated by commas')
+@PATIENT_NS.param('operation', SET_OPERATION_DESCRIPTION, enum=list(SET_OPERATIONS))
+class PatientsGeneSet(CMResource):
+	'''Return the result of a set operation over the mapped genes of the queried patients'''
+	@PATIENT_NS.doc('patients_gene_set')
+	@PATIENT_NS.marshal_list_with(intersect_genes_model)
+	def get(self,ids,operation):
+		'''It gets the genes resulting from the set operation'''
+		return self.cmn.patients_gene_set(ids,operation)
+
+@PATIENT_NS.response(404, 'No patient was found')
+@PATIENT_NS.param('ids', 'The patient id(s), separated by commas')
+@PATIENT_NS.param('operation', SET_OPERATION_DESCRIPTION, enum=list(SET_OPERATIONS))
+class PatientsDrugSet(CMResource):
+	'''Return the result of a set operation over the mapped drugs of the queried patients'''
+	@PATIENT_NS.doc('patients_drug_set')
+	@PATIENT_NS.marshal_list_with(intersect_drugs_model)
+	def get(self,ids,operation):
+		'''It gets the drugs resulting from the set operation'''
+		return self.cmn.patients_drug_set(ids,operation)
+
+@PATIENT_NS.response(404, 'No patient subgroup was found')
+@PATIENT_NS.param('ids', 'The patient subgroup id(s), separated by commas')
+@PATIENT_NS.param('operation', SET_OPERATION_DESCRIPTION, enum=list(SET_OPERATIONS))
+class PatientSubgroupsGeneSet(CMResource):
+	'''Return the result of a set operation over the intersected genes of the queried patient subgroups'''
+	@PATIENT_NS.doc('patient_subgroups_gene_set')
+	@PATIENT_NS.marshal_list_with(intersect_genes_model)
+	def get(self,ids,operation):
+		'''It gets the genes resulting from the set operation'''
+		return self.cmn.patient_subgroups_gene_set(ids,operation)
+
+@PATIENT_NS.response(404, 'No patient subgroup was found')
+@PATIENT_NS.param('ids', 'The patient subgroup id(s), separated by commas')
+@PATIENT_NS.param('operation', SET_OPERATION_DESCRIPTION, enum=list(SET_OPERATIONS))
+class PatientSubgroupsDrugSet(CMResource):
+	'''Return the result of a set operation over the intersected drugs of the queried patient subgroups'''
+	@PATIENT_NS.doc('patient_subgroups_drug_set')
+	@PATIENT_NS.marshal_list_with(intersect_drugs_model)
+	def get(self,ids,operation):
+		'''It gets the drugs resulting from the set operation'''
+		return self.cmn.patient_subgroups_drug_set(ids,operation)
+
+@PATIENT_NS.response(404, 'Patient not found, or without genes or drugs')
+@PATIENT_NS.param('id', 'The patient id')
+class PatientSimilar(CMResource):
+	'''Return the patients most similar to a patient, based on their genes and drugs'''
+	@PATIENT_NS.doc('similar_patients')
+	@PATIENT_NS.expect(similarity_parser)
+	@PATIENT_NS.marshal_list_with(patient_similarity_model)
+	def get(self,id):
+		'''It gets the most similar patients, from the most similar'''
+		args = similarity_parser.parse_args()
+		return self.cmn.similar_patients(id,args['k'],args['metric'],args['based_on'])
+
+@PATIENT_NS.response(404, 'Patient subgroup not found, or without genes or drugs')
+@PATIENT_NS.param('id', 'The patient subgroup id')
+class PatientSubgroupSimilar(CMResource):
+	'''Return the patient subgroups most similar to a patient subgroup, based on their genes and drugs'''
+	@PATIENT_NS.doc('similar_patient_subgroups')
+	@PATIENT_NS.expect(similarity_parser)
+	@PATIENT_NS.marshal_list_with(patient_subgroup_similarity_model)
+	def get(self,id):
+		'''It gets the most similar patient subgroups, from the most similar'''
+		args = similarity_parser.parse_args()
+		return self.cmn.similar_patient_subgroups(id,args['k'],args['metric'],args['based_on'])
+
 ROUTES={
 	'ns': PATIENT_NS,
 	'path': '/patients',
 	'routes': [
 		(PatientList,''),
 		(Patient,'/<int:id>'),
+		(PatientSimilar,'/<int:id>/similar'),
 		(PatientsMapGenes,'/<list(int,sep=","):ids>/genes'),
 		(PatientsMapDrugs,'/<list(int,sep=","):ids>/drugs'),
 		(PatientsInteraction,'/<list(int,sep=","):ids>/interaction'),
+		(PatientsGeneSet,'/<list(int,sep=","):ids>/genes/<any(intersection,union,difference):operation>'),
+		(PatientsDrugSet,'/<list(int,sep=","):ids>/drugs/<any(intersection,union,difference):operation>'),
 		(PatientSubgroupList,'/subgroups'),
 		(PatientSubgroupPatients,'/subgroups/<int:id>'),
 		(PatientSubgroupPatients,'/subgroups/<int:id>/patients'),
 		(PatientSubgroupsIntersectGenes,'/subgroups/<list(int,sep=","):ids>/genes'),
 		(PatientSubgroupsIntersectDrugs,'/subgroups/<list(int,sep=","):ids>/drugs'),
+		(PatientSubgroupsGeneSet,'/subgroups/<list(int,sep=","):ids>/genes/<any(intersection,union,difference):operation>'),
+		(PatientSubgroupsDrugSet,'/subgroups/<list(int,sep=","):ids>/drugs/<any(intersection,union,difference):operation>'),
 		(PatientSubgroupPatientsMapGenes,'/subgroups/<list(int,sep=","):ids>/patients/genes'),
 		(PatientSubgroupPatientsMapDrugs,'/subgroups/<list(int,sep=","):ids>/patients/drugs'),
 		(PatientSubgroupPatientsInteraction,'/subgroups/<list(int,sep=","):ids>/patients/interaction'),
 		(PatientSubgroup,'/subgroups/<int:id>/info'),
+		(PatientSubgroupSimilar,'/subgroups/<int:id>/similar'),
 	]
-}
\ No newline at end of file
+}
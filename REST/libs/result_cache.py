@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+import collections
+import functools
+import inspect
+import sys
+import threading
+
+def estimate_size(obj):
+	'''It estimates the memory footprint (in bytes) of a query result'''
+	size = sys.getsizeof(obj)
+	if isinstance(obj,dict):
+		# Keys are usually interned strings shared by all the results
+		for value in obj.values():
+			size += estimate_size(value)
+	elif isinstance(obj,(list,tuple)):
+		for value in obj:
+			size += estimate_size(value)
+	
+	return size
+
+# Bounded LRU cache, whose eviction is based on the estimated size
+# of the cached results. It is emptied whenever the version
+# of the underlying database changes
+class ResultCache(object):
+	def __init__(self,version_getter,max_bytes=64*1024*1024,sizer=estimate_size):
+		self.version_getter = version_getter
+		self.max_bytes = max_bytes
+		self.sizer = sizer
+		
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+		self._version = None
+		self.nbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.invalidations = 0
+	
+	def _checkVersion(self):
+		version = self.version_getter()
+		if version != self._version:
+			if self._version is not None:
+				self.invalidations += 1
+			self._entries.clear()
+			self.nbytes = 0
+			self._version = version
+		
+		return version
+	
+	def get(self,key,producer):
+		with self._lock:
+			version = self._checkVersion()
+			entry = self._entries.get(key)
+			if entry is not None:
+				self._entries.move_to_end(key)
+				self.hits += 1
+				return entry[0]
+			
+			self.misses += 1
+		
+		# The query is run outside the lock, so concurrent misses
+		# on different keys are not serialized
+		result = producer()
+		size = self.sizer(result)
+		if size <= self.max_bytes:
+			with self._lock:
+				# Do not store results from a previous database version
+				if version == self._version and key not in self._entries:
+					self._entries[key] = (result, size)
+					self.nbytes += size
+					while self.nbytes > self.max_bytes:
+						_, (_, evicted_size) = self._entries.popitem(last=False)
+						self.nbytes -= evicted_size
+						self.evictions += 1
+		
+		return result
+	
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self.nbytes = 0
+	
+	def stats(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				'entries': len(self._entries),
+				'bytes': self.nbytes,
+				'max_bytes': self.max_bytes,
+				'hits': self.hits,
+				'misses': self.misses,
+				'hit_ratio': self.hits / lookups  if lookups > 0  else 0.0,
+				'evictions': self.evictions,
+				'invalidations': self.invalidations
+			}
+
+def cached_result(*id_list_params):
+	'''Decorator for ComorbiditiesNetwork query methods. The cache key is built
+	from the method name and its parameters, where the id list ones
+	(named in id_list_params) are canonicalized as sorted, de-duplicated tuples'''
+	def decorator(method):
+		signature = inspect.signature(method)
+		
+		@functools.wraps(method)
+		def wrapper(self,*args,**kwargs):
+			cache = self.result_cache
+			if cache is None:
+				return method(self,*args,**kwargs)
+			
+			bound = signature.bind(self,*args,**kwargs)
+			bound.apply_defaults()
+			key = [ method.__name__ ]
+			for param_name, value in bound.arguments.items():
+				if param_name == 'self':
+					continue
+				if param_name in id_list_params and value is not None:
+					value = tuple(sorted(set(value)))
+				key.append((param_name,value))
+			
+			return cache.get(tuple(key),lambda: method(self,*args,**kwargs))
+		
+		return wrapper
+	
+	return decorator
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# coding: utf-8
+
+import json
+import mmap
+import os
+import struct
+from collections.abc import Mapping, Sequence
+
+from .patient_graph import numpy
+
+# The binary snapshot written by DB/shared_snapshot.py next to the database
+SNAPSHOT_MAGIC = b'DPSNAP'
+SNAPSHOT_FORMAT = 1
+SNAPSHOT_SUFFIX = '.snapshot'
+
+# Type codes from the array module, stored little-endian
+ARRAY_DTYPES = {
+	'b': '<i1',
+	'B': '<u1',
+	'i': '<i4',
+	'q': '<i8',
+	'd': '<f8',
+}
+
+def snapshot_path(dbpath):
+	return os.path.splitext(dbpath)[0] + SNAPSHOT_SUFFIX
+
+# This class gives access to the arrays of a shared snapshot, memory mapped
+# read-only. The pages are shared through the page cache by all the processes
+# mapping the file (and inherited by the forked workers), so the arrays take
+# no private memory. They are NumPy views over the mapping, which cannot be modified
+class SharedSnapshot(object):
+	def __init__(self,path):
+		with open(path,'rb') as fh:
+			self._mmap = mmap.mmap(fh.fileno(),0,access=mmap.ACCESS_READ)
+		
+		prefix_len = len(SNAPSHOT_MAGIC) + 2
+		if self._mmap[0:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or struct.unpack('<H',self._mmap[len(SNAPSHOT_MAGIC):prefix_len])[0] != SNAPSHOT_FORMAT:
+			raise ValueError('{} is not a shared snapshot with format {}'.format(path,SNAPSHOT_FORMAT))
+		
+		header_len = struct.unpack('<Q',self._mmap[prefix_len:prefix_len + 8])[0]
+		self.header = json.loads(self._mmap[prefix_len + 8:prefix_len + 8 + header_len].decode('utf-8'))
+		self.db_version = self.header['db_version']
+		self.tables = frozenset(self.header['tables'])
+		self._arrays = self.header['arrays']
+	
+	@classmethod
+	def open(cls,path,db_version):
+		'''It returns the snapshot only when it was built from the given
+		version of the database file, and it can be used'''
+		if numpy is None or not os.path.exists(path):
+			return None
+		
+		try:
+			shared = cls(path)
+		except (OSError, ValueError):
+			return None
+		
+		return shared  if shared.db_version == db_version  else None
+	
+	def has(self,name):
+		return name in self._arrays
+	
+	def array(self,name):
+		desc = self._arrays[name]
+		return numpy.frombuffer(self._mmap,dtype=ARRAY_DTYPES[desc['type']],count=desc['length'],offset=desc['offset'])
+	
+	def column(self,name):
+		'''A column of Python values, where the strings are decoded on access'''
+		if self.has(name + '.offsets'):
+			data = self._arrays[name + '.data']
+			values = StringColumn(self._mmap,data['offset'],self.array(name + '.offsets'))
+		else:
+			values = ArrayColumn(self.array(name))
+		
+		if self.has(name + '.null'):
+			values = NullableColumn(values,self.array(name + '.null'))
+		
+		return values
+	
+	def entity_sets_definition(self,name):
+		definition = self.header['entity_sets'].get(name)
+		return tuple(definition)  if definition is not None  else None
+
+class ArrayColumn(Sequence):
+	def __init__(self,values):
+		self._values = values
+	
+	def __len__(self):
+		return len(self._values)
+	
+	def __getitem__(self,i):
+		return self._values[i].item()
+
+class StringColumn(Sequence):
+	def __init__(self,mapping,data_offset,offsets):
+		self._mapping = mapping
+		self._data_offset = data_offset
+		self._offsets = offsets
+	
+	def __len__(self):
+		return len(self._offsets) - 1
+	
+	def __getitem__(self,i):
+		if i < 0:
+			i += len(self)
+		if i < 0 or i >= len(self):
+			raise IndexError(i)
+		
+		return self._mapping[self._data_offset + int(self._offsets[i]):self._data_offset + int(self._offsets[i + 1])].decode('utf-8')
+
+class NullableColumn(Sequence):
+	def __init__(self,values,nulls):
+		self._values = values
+		self._nulls = nulls
+	
+	def __len__(self):
+		return len(self._values)
+	
+	def __getitem__(self,i):
+		return None  if self._nulls[i]  else self._values[i]
+
+# This sequence builds each record (a dictionary) from the snapshot columns
+# when it is accessed, so they are not kept in every worker
+class MappedRecords(Sequence):
+	def __init__(self,formatter,*columns):
+		self._formatter = formatter
+		self._columns = columns
+	
+	def __len__(self):
+		return len(self._columns[0])  if len(self._columns) > 0  else 0
+	
+	def __getitem__(self,i):
+		return self._formatter(*map(lambda column: column[i],self._columns))
+
+# This mapping finds the records through a binary search over their keys,
+# following the order of the sorted permutation
+class SortedIndex(Mapping):
+	def __init__(self,keys,order,records):
+		self._keys = keys
+		self._order = order
+		self._records = records
+	
+	def _position(self,key):
+		lo = 0
+		hi = len(self._order)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self._keys[int(self._order[mid])] < key:
+				lo = mid + 1
+			else:
+				hi = mid
+		
+		return lo
+	
+	def __getitem__(self,key):
+		try:
+			pos = self._position(key)
+		except TypeError:
+			raise KeyError(key)
+		
+		if pos < len(self._order):
+			i = int(self._order[pos])
+			if self._keys[i] == key:
+				return self._records[i]
+		
+		raise KeyError(key)
+	
+	def __iter__(self):
+		return map(lambda i: self._keys[int(i)],self._order)
+	
+	def __len__(self):
+		return len(self._order)